@@ -0,0 +1,109 @@
+"""
+Measure what the git side of `gen` costs.
+
+Run it from inside a git repository:
+
+    python benchmarks/bench_git.py [rounds]
+
+It compares resolving HEAD with a fresh `git rev-parse` per call against the
+warm `cat-file --batch-check` worker. That worker only serves rev_parse:
+every other git command still forks through run_git_command. So it counts
+how many git processes `gen` starts to take its snapshot, the first time
+and again on an unchanged repo. A first snapshot runs several (the
+fingerprint's `ls-files -m`, `add -u` and `write-tree` on a temporary
+index, `--numstat`, `check-attr` and the diff itself), where `gen` used to
+run two `git diff`s. What saves time is the cache: an unchanged repo only
+costs the fingerprint's one process. Last, it times reading the diff with
+one git process against the sharded, parallel read (only a large diff
+gets sharded).
+"""
+
+from __future__ import annotations
+
+import subprocess
+import sys
+import time
+from unittest.mock import patch
+
+from commizard import git_utils
+
+
+def time_it(func, rounds: int) -> float:
+    """
+    Returns:
+        average milliseconds per call
+    """
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) * 1000 / rounds
+
+
+def count_forks(func) -> int:
+    """
+    Count the git processes a function starts.
+    """
+    real_popen = subprocess.Popen
+    forks = 0
+
+    # subprocess.run goes through Popen too, so this catches every git call
+    def counting_popen(*args, **kwargs):
+        nonlocal forks
+        forks += 1
+        return real_popen(*args, **kwargs)
+
+    with patch("subprocess.Popen", counting_popen):
+        func()
+    return forks
+
+
+def main() -> int:
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    if not git_utils.is_inside_working_tree():
+        print("run this benchmark inside a git working tree")
+        return 1
+
+    def fork_rev_parse():
+        git_utils.run_git_command(["rev-parse", "HEAD"])
+
+    def worker_rev_parse():
+        git_utils.rev_parse("HEAD")
+
+    # warm the worker up so we only measure steady-state REPL usage
+    git_utils.rev_parse("HEAD")
+    forked = time_it(fork_rev_parse, rounds)
+    warm = time_it(worker_rev_parse, rounds)
+    git_utils.close_workers()
+
+    print(f"rev-parse HEAD, {rounds} rounds")
+    print(f"  fork per call:   {forked:8.3f} ms/call")
+    print(f"  warm cat-file:   {warm:8.3f} ms/call")
+    print(f"  saved per call:  {forked - warm:8.3f} ms")
+    git_utils.clear_diff_cache()
+    first = count_forks(git_utils.get_snapshot)
+    again = count_forks(git_utils.get_snapshot)
+    print("git processes per `gen` (two before snapshots)")
+    print(f"  first snapshot:  {first:8d}")
+    print(f"  unchanged repo:  {again:8d}")
+    git_utils.clear_diff_cache()
+    cold = time_it(git_utils.take_snapshot, 5)
+    git_utils.get_snapshot()
+    cached = time_it(git_utils.get_snapshot, 5)
+    print("taking the snapshot")
+    print(f"  from git:        {cold:8.3f} ms/call")
+    print(f"  cached:          {cached:8.3f} ms/call")
+
+    args = git_utils.diff_args()
+    workers = git_utils.diff_workers
+    git_utils.diff_workers = 1
+    serial = time_it(lambda: git_utils.read_diff_files(args), 5)
+    git_utils.diff_workers = workers
+    parallel = time_it(lambda: git_utils.read_diff_files(args), 5)
+    print(f"reading the diff ({workers} workers)")
+    print(f"  one git diff:    {serial:8.3f} ms/call")
+    print(f"  sharded:         {parallel:8.3f} ms/call")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+Measure what the pooled keep-alive session saves per Ollama request.
+
+    python benchmarks/bench_http.py [rounds]
+
+It starts a local stub server that answers like `/api/version`, and compares
+a fresh `requests.get` per call (a new connection every time, as before)
+against `llm_providers.http_request` on the shared session.
+"""
+
+from __future__ import annotations
+
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from commizard import llm_providers
+
+
+class StubOllama(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # like Ollama (Go sets TCP_NODELAY), or keep-alive hits delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = b'{"version": "0.0.0"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def time_it(func, rounds: int) -> float:
+    """
+    Returns:
+        average milliseconds per call
+    """
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) * 1000 / rounds
+
+
+def main() -> int:
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOllama)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/version"
+
+    def fresh():
+        requests.get(url, timeout=1).json()
+
+    def pooled():
+        llm_providers.http_request("GET", url)
+
+    # one warm-up call each, so imports and the first connect don't count
+    fresh()
+    pooled()
+    fresh_ms = time_it(fresh, rounds)
+    pooled_ms = time_it(pooled, rounds)
+    llm_providers.close_session()
+    server.shutdown()
+    server.server_close()
+
+    print(f"GET /api/version on a local stub, {rounds} rounds")
+    print(f"  new connection:  {fresh_ms:8.3f} ms/request")
+    print(f"  pooled session:  {pooled_ms:8.3f} ms/request")
+    print(f"  saved:           {fresh_ms - pooled_ms:8.3f} ms/request")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -89,3 +89,12 @@ def check_all(session):
     session.notify("lint")
     session.notify("test", ["cov"])
     session.notify("e2e_test")
+
+
+@nox.session(reuse_venv=True, venv_backend=venv_list)
+def bench(session):
+    """
+    run the benchmarks (inside a git working tree)
+    """
+    session.run("python", "benchmarks/bench_git.py", *session.posargs)
+    session.run("python", "benchmarks/bench_http.py")
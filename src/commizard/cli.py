@@ -4,17 +4,18 @@ import concurrent.futures
 import sys
 
 from . import __version__ as version
-from . import commands, output, start
+from . import commands, git_utils, llm_providers, output, speculate, start
 
 help_msg = """
 Commit writing wizard
 
 Usage:
-  commizard [-v | --version] [-h | --help]
+  commizard [-v | --version] [-h | --help] [-s | --staged]
 
 Options:
   -h, --help       Show help for commizard
   -v, --version    Show version information
+  -s, --staged     Describe and commit only the staged changes
 """
 
 
@@ -27,6 +28,9 @@ def handle_args():
     elif sys.argv[1] in ("-h", "--help"):
         print(help_msg.strip(), end="\n")
         sys.exit(0)
+    for arg in sys.argv[1:]:
+        if arg in ("-s", "--staged"):
+            git_utils.staged_only = True
 
 
 def main() -> int:
@@ -38,13 +42,24 @@ def main() -> int:
         int: Exit code (0 for success, non-zero for errors)
     """
     handle_args()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        fut_git = executor.submit(start.check_git_installed)
-        fut_ai = executor.submit(start.local_ai_available)
-        fut_worktree = executor.submit(start.is_inside_working_tree)
-        git_ok = fut_git.result()
-        ai_ok = fut_ai.result()
-        worktree_ok = fut_worktree.result()
+    executor = concurrent.futures.ThreadPoolExecutor()
+    # so `list` and `start` find the model list already fetched
+    llm_providers.catalog.refresh_async()
+    fut_git = executor.submit(start.check_git_installed)
+    fut_ai = executor.submit(start.local_ai_available)
+    fut_worktree = executor.submit(start.is_inside_working_tree)
+    git_ok = fut_git.result()
+    ai_ok = fut_ai.result()
+    worktree_ok = fut_worktree.result()
+    # only once the session is sure to start, so stop_lifecycle unloads it
+    model = llm_providers.default_model() if git_ok and worktree_ok else None
+    if model is not None:
+        # loading takes seconds; let it run while the user types
+        llm_providers.selected_model = model
+        llm_providers.preload = executor.submit(
+            llm_providers.preload_model, model
+        )
+    executor.shutdown(wait=False)
 
     if not git_ok:
         output.print_error("git not installed")
@@ -58,6 +73,10 @@ def main() -> int:
         return 1
 
     start.print_welcome()
+    if model is not None:
+        output.print_info(f"Loading {model} in the background.")
+    llm_providers.start_lifecycle()
+    speculate.start()
 
     try:
         while True:
@@ -70,6 +89,12 @@ def main() -> int:
             commands.parser(user_input)
     except (EOFError, KeyboardInterrupt):
         print("\nGoodbye!")
+    finally:
+        speculate.stop()
+        git_utils.close_workers()
+        # give the model's RAM back instead of leaving it to keep_alive
+        llm_providers.stop_lifecycle()
+        llm_providers.close_session()
 
     return 0
 
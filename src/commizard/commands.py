@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import argparse
 import os
 import platform
 import sys
@@ -7,20 +8,83 @@ from typing import TYPE_CHECKING
 
 import pyperclip
 
-from . import git_utils, llm_providers, output
+from . import (
+    git_utils,
+    llm_providers,
+    output,
+    packing,
+    speculate,
+    summarize,
+)
 
 if TYPE_CHECKING:
     from collections.abc import Callable
 
 
+class OptionParser(argparse.ArgumentParser):
+    """
+    An argparse parser for command options that raises ValueError on bad
+    input instead of exiting, since we're inside the REPL.
+    """
+
+    def __init__(self, prog: str):
+        super().__init__(prog=prog, add_help=False)
+
+    def error(self, message: str):  # type: ignore[override]
+        raise ValueError(message)
+
+
+def positive_int(value: str) -> int:
+    """
+    argparse type for options that only make sense above zero.
+    """
+    number = int(value)
+    if number <= 0:
+        raise ValueError(f"{value} is not a positive number")
+    return number
+
+
+gen_parser = OptionParser("gen")
+gen_parser.add_argument("--budget", type=positive_int, default=None)
+gen_parser.add_argument("-n", type=positive_int, default=1, dest="candidates")
+gen_parser.add_argument("--no-cache", action="store_true")
+gen_parser.add_argument("--summarize", action="store_true")
+gen_parser.add_argument("paths", nargs="*")
+
+commit_parser = OptionParser("commit")
+commit_parser.add_argument("paths", nargs="*")
+
+
 def handle_commit_req(opts: list[str]) -> None:
     """
     commits the generated prompt. prints an error message if commiting fails
+
+    Args:
+        opts: pathspecs limiting the commit to some files. They must match
+            the ones the message was generated for, if any.
     """
+    try:
+        args = commit_parser.parse_args(opts)
+    except ValueError as e:
+        output.print_error(str(e))
+        return
     if llm_providers.gen_message is None or llm_providers.gen_message == "":
         output.print_warning("No commit message detected. Skipping.")
         return
-    out, msg = git_utils.commit(llm_providers.gen_message)
+    snapshot = git_utils.snapshot
+    if snapshot is not None:
+        if args.paths and tuple(args.paths) != snapshot.pathspecs:
+            output.print_warning(
+                "The message was generated for other paths. Run "
+                f"`gen {' '.join(args.paths)}` first."
+            )
+            return
+        # commit exactly what the message describes
+        out, msg = git_utils.commit_snapshot(
+            snapshot, llm_providers.gen_message
+        )
+    else:
+        out, msg = git_utils.commit(llm_providers.gen_message, args.paths)
     if out == 0:
         output.print_success(msg)
     else:
@@ -62,9 +126,6 @@ def start_model(opts: list[str]) -> None:
     Get the model (either local or online) ready for generation based on the
     options passed.
     """
-    if llm_providers.available_models is None:
-        llm_providers.init_model_list()
-
     if opts == []:
         output.print_error("Please specify a model.")
         return
@@ -72,10 +133,12 @@ def start_model(opts: list[str]) -> None:
     # TODO: see issue #42
     model_name = opts[0]
 
-    if (
-        llm_providers.available_models
-        and model_name not in llm_providers.available_models
-    ):
+    models = llm_providers.catalog.names()
+    if models and model_name not in models:
+        # it may have been pulled since the list was fetched
+        llm_providers.catalog.refresh()
+        models = llm_providers.catalog.names()
+    if models and model_name not in models:
         output.print_error(f"{model_name} Not found.")
         return
     llm_providers.select_model(model_name)
@@ -85,40 +148,149 @@ def print_available_models(opts: list[str]) -> None:
     """
     prints the available models according to options passed.
     """
-    llm_providers.init_model_list()
-    if llm_providers.available_models is None:
+    models = llm_providers.catalog.names()
+    if models is None:
         output.print_error(
             "failed to list available local AI models. Is ollama running?"
         )
         return
-    elif not llm_providers.available_models:
+    elif not models:
         output.print_warning("No local AI models found.")
         return
-    for model in llm_providers.available_models:
+    for model in models:
         print(model)
 
 
 def generate_message(opts: list[str]) -> None:
     """
     Generate a message based on the current Git repository changes.
+
+    Args:
+        opts: ``--budget N`` caps how many tokens of diff go into the prompt,
+            ``-n N`` generates N messages at once to pick from,
+            ``--no-cache`` asks the model again even for a cached prompt,
+            ``--summarize`` summarizes the diff part by part first instead
+            of cutting it down to the budget, and any pathspecs limit the
+            message to the files they match
     """
-    diff = git_utils.get_clean_diff()
+    try:
+        args = gen_parser.parse_args(opts)
+    except ValueError as e:
+        output.print_error(str(e))
+        return
+
+    snapshot = git_utils.get_snapshot(args.paths)
+    files = snapshot.files
+    skipped, saved_bytes, saved_tokens = git_utils.skipped_savings(files)
+    if skipped:
+        output.print_info(
+            f"Left out {skipped} generated, vendored, binary or lock files "
+            f"(~{saved_bytes / 1024:.1f} KiB, ~{saved_tokens} tokens saved)"
+        )
+    diff = packing.pack_diff(files, args.budget)
     if diff == "":
         output.print_warning("No changes to the repository.")
         return
 
-    prompt = llm_providers.generation_prompt + diff
-    stat, res = llm_providers.generate(prompt)
+    preload = llm_providers.preload
+    if preload is not None and not preload.done():
+        output.print_info(
+            f"Waiting for {llm_providers.selected_model} to finish loading..."
+        )
+    if args.summarize:
+        stat, diff = summarize.summarize_diff(
+            files,
+            args.budget,
+            lambda n: output.print_info(
+                f"Summarizing {n} parts of the diff..."
+            ),
+            cache=not args.no_cache,
+        )
+        if stat != 0:
+            output.print_error(diff)
+            return
+    ready = None
+    if args.candidates == 1 and not (args.summarize or args.no_cache):
+        ready = speculate.take(diff)
+    if ready is not None:
+        output.print_info("Using the message written in the background.")
+        stat, res = 0, ready
+    elif args.candidates > 1:
+        stat, res = pick_candidate(diff, args.candidates)
+    else:
+        with output.live_text() as show:
+            stat, res = llm_providers.generate(
+                diff, show, cache=not args.no_cache
+            )
 
     if stat != 0:
         output.print_error(res)
         return
+    if ready is None and args.candidates == 1 and llm_providers.last_stats:
+        print_prompt_stats(llm_providers.last_stats, llm_providers.last_sizing)
 
     wrapped_res = output.wrap_text(res, 72)
     llm_providers.gen_message = wrapped_res
+    git_utils.snapshot = snapshot
     output.print_generated(wrapped_res)
 
 
+def print_prompt_stats(
+    stats: dict[str, int], sizing: dict[str, int] | None = None
+) -> None:
+    """
+    Show how much of the prompt the model had to evaluate, and how long that
+    took, if the server says. Once the instructions are cached, only the diff
+    counts. With sizing (llm_providers.last_sizing), also show the estimate
+    the context window was picked from.
+    """
+    count = stats.get("prompt_eval_count", 0)
+    if "prompt_eval_duration" not in stats:
+        line = f"Prompt: {count} tokens"
+    else:
+        seconds = stats["prompt_eval_duration"] / 1e9
+        line = f"Prompt: {count} tokens evaluated in {seconds:.2f}s"
+    if sizing:
+        line += (
+            f" (estimated ~{sizing['prompt_estimate']}, context window "
+            f"{sizing['num_ctx']}, at most {sizing['num_predict']} new)"
+        )
+    output.print_info(line)
+
+
+def pick_candidate(prompt: str, count: int) -> tuple[int, str]:
+    """
+    Generate several messages at once, show each as soon as it's ready, and
+    let the user pick one.
+
+    Returns:
+        a return code and the picked message, or an error message
+    """
+    shown: list[str] = []
+
+    def show(_: int, stat: int, res: str) -> None:
+        if stat != 0:
+            output.print_warning(f"A candidate failed: {res}")
+            return
+        shown.append(res)
+        output.print_info(f"[{len(shown)}]")
+        output.print_generated(output.wrap_text(res, 72))
+
+    results = llm_providers.generate_candidates(prompt, count, show)
+    if not shown:
+        return results[0]
+    while len(shown) > 1:
+        try:
+            choice = input(f"Pick a message [1-{len(shown)}]: ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return 1, "No message picked."
+        if choice.isdigit() and 1 <= int(choice) <= len(shown):
+            return 0, shown[int(choice) - 1]
+        output.print_warning(f"Enter a number from 1 to {len(shown)}.")
+    return 0, shown[0]
+
+
 def cmd_clear(opts: list[str]) -> None:
     """
     Clear terminal screen (Windows/macOS/Linux).
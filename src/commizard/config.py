@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+from pathlib import Path
+
+
+def config_path() -> Path:
+    """
+    The settings CommiZard remembers between sessions:
+    $XDG_CONFIG_HOME/commizard/config.json, or ~/.config/commizard/config.json.
+    """
+    base = os.environ.get("XDG_CONFIG_HOME") or Path.home() / ".config"
+    return Path(base) / "commizard" / "config.json"
+
+
+def load() -> dict:
+    """
+    Read the saved settings.
+
+    Returns:
+        the settings, empty if there are none or the file is unreadable
+    """
+    try:
+        with config_path().open(encoding="utf-8") as f:
+            settings = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return settings if isinstance(settings, dict) else {}
+
+
+def get(key: str, default=None):
+    """
+    Read one saved setting.
+    """
+    return load().get(key, default)
+
+
+def save(key: str, value) -> bool:
+    """
+    Remember a setting. The file is replaced atomically, so a crash or
+    another session writing at the same time can't leave it half written.
+
+    Returns:
+        whether it was saved
+    """
+    path = config_path()
+    settings = load()
+    settings[key] = value
+    tmp = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=path.parent, suffix=".tmp", delete=False
+        ) as f:
+            tmp = Path(f.name)
+            json.dump(settings, f, indent=2)
+        tmp.replace(path)
+    except OSError:
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+        return False
+    return True
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+hunk_header_re = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class LineRange:
+    """
+    A range of lines on one side of a hunk.
+    """
+
+    __slots__ = ("count", "start")
+
+    def __init__(self, start: int, count: int):
+        self.start = start
+        self.count = count
+
+    def __repr__(self) -> str:
+        return f"LineRange({self.start}, {self.count})"
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, LineRange):
+            return NotImplemented
+        return (self.start, self.count) == (other.start, other.count)
+
+    def __hash__(self) -> int:
+        return hash((self.start, self.count))
+
+
+class Hunk:
+    """
+    A single ``@@`` section of a file's diff.
+    """
+
+    __slots__ = ("added", "header", "lines", "new", "old", "removed")
+
+    def __init__(self, header: str, old: LineRange, new: LineRange):
+        self.header = header
+        self.old = old
+        self.new = new
+        self.lines: list[str] = []
+        self.added = 0
+        self.removed = 0
+
+    def append(self, line: str) -> None:
+        self.lines.append(line)
+        if line.startswith("+"):
+            self.added += 1
+        elif line.startswith("-"):
+            self.removed += 1
+
+
+class FileDiff:
+    """
+    Everything git printed for one file. ``headers`` holds the lines before
+    the first hunk (minus the ones we never show the model), in order.
+
+    A file whose text was never read (see ``git_utils.read_diff_files``) has
+    ``skipped`` set to the reason, and ``counts`` holds its (added, removed)
+    line counts instead of hunks.
+    """
+
+    __slots__ = (
+        "binary",
+        "counts",
+        "headers",
+        "hunks",
+        "new_path",
+        "old_path",
+        "skipped",
+        "truncated",
+    )
+
+    def __init__(
+        self, old_path: str | None = None, new_path: str | None = None
+    ):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.headers: list[str] = []
+        self.hunks: list[Hunk] = []
+        self.binary = False
+        self.truncated = False
+        self.skipped: str | None = None
+        self.counts: tuple[int, int] | None = None
+
+    @property
+    def path(self) -> str | None:
+        """
+        The path of the file after the change (before it, for deletions).
+        """
+        return self.new_path if self.new_path is not None else self.old_path
+
+    @property
+    def added(self) -> int:
+        if self.counts is not None:
+            return self.counts[0]
+        return sum(hunk.added for hunk in self.hunks)
+
+    @property
+    def removed(self) -> int:
+        if self.counts is not None:
+            return self.counts[1]
+        return sum(hunk.removed for hunk in self.hunks)
+
+
+def _strip_prefix(path: str) -> str | None:
+    """
+    turn "a/foo" or "b/foo" into "foo", and "/dev/null" into None
+    """
+    path = path.split("\t", 1)[0]
+    if path == "/dev/null":
+        return None
+    if path.startswith(("a/", "b/")):
+        return path[2:]
+    return path
+
+
+def _parse_git_header(line: str) -> FileDiff:
+    # "diff --git a/<old> b/<new>". Paths with " b/" in them are ambiguous
+    # here, but the ---/+++ lines that follow fix that up.
+    rest = line[len("diff --git ") :]
+    old, sep, new = rest.rpartition(" b/")
+    if not sep:
+        return FileDiff()
+    return FileDiff(_strip_prefix(old), new)
+
+
+def parse_diff(lines: Iterable[str]) -> list[FileDiff]:
+    """
+    Parse git diff output into FileDiff objects in a single pass.
+
+    Lines that don't belong to any ``diff --git`` section (like a bare hunk
+    body) are kept in a FileDiff without paths, so nothing git printed is lost
+    except the lines clean output drops anyway.
+
+    Args:
+        lines: the diff, one line per item, without line endings
+
+    Returns:
+        the files in the order git printed them
+    """
+    files: list[FileDiff] = []
+    current: FileDiff | None = None
+    hunk: Hunk | None = None
+    for line in lines:
+        if line.startswith("diff --git"):
+            current = _parse_git_header(line)
+            files.append(current)
+            hunk = None
+            continue
+        if line.startswith("warning:"):
+            continue
+        if current is None:
+            current = FileDiff()
+            files.append(current)
+        if line.startswith("@@"):
+            match = hunk_header_re.match(line)
+            if match:
+                old_start, old_count, new_start, new_count = match.groups()
+                hunk = Hunk(
+                    line,
+                    LineRange(int(old_start), int(old_count or 1)),
+                    LineRange(int(new_start), int(new_count or 1)),
+                )
+                current.hunks.append(hunk)
+                continue
+        if hunk is not None:
+            hunk.append(line)
+            continue
+        # still in the file's header
+        if line.startswith("index "):
+            continue
+        if line.startswith("--- "):
+            current.old_path = _strip_prefix(line[4:])
+        elif line.startswith("+++ "):
+            current.new_path = _strip_prefix(line[4:])
+        elif line.startswith("Binary files "):
+            current.binary = True
+        current.headers.append(line)
+    return files
+
+
+def iter_render(files: Iterable[FileDiff]) -> Iterator[str]:
+    """
+    Lazily render parsed files back into the sanitized diff text, one line at
+    a time.
+    """
+    for file in files:
+        if file.skipped is not None:
+            if file.binary:
+                yield f"{file.path} | binary (not shown)"
+            else:
+                yield (
+                    f"{file.path} | +{file.added} -{file.removed} "
+                    f"({file.skipped}, not shown)"
+                )
+            continue
+        yield from file.headers
+        for hunk in file.hunks:
+            yield hunk.header
+            yield from hunk.lines
+        if file.truncated:
+            yield "[diff truncated]"
+
+
+def render(files: Iterable[FileDiff]) -> str:
+    """
+    Render parsed files into the sanitized diff text we send to the model.
+    """
+    return "\n".join(iter_render(files)).strip()
@@ -1,22 +1,254 @@
 from __future__ import annotations
 
+import hashlib
+import os
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import TYPE_CHECKING
 
+from . import diff_parser, packing
 
-def run_git_command(args: list[str]) -> subprocess.CompletedProcess:
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator, Sequence
+
+# Describe and commit only what's staged, instead of every tracked change.
+# Chosen once per session (see `commizard --staged`).
+staged_only = False
+
+# Upper bound on how much of the diff we read. Nothing past this could fit in
+# a local model's context window anyway.
+max_diff_chars = 1 << 20
+
+# How many parsed diffs we keep around, keyed by repo fingerprint.
+diff_cache_size = 8
+diff_cache: OrderedDict[tuple, Snapshot] = OrderedDict()
+# speculate takes snapshots from its own thread
+_diff_cache_lock = threading.Lock()
+
+# Files modified this recently (in nanoseconds) might change again without
+# their stat data changing, so we don't trust a fingerprint that includes them.
+racy_window_ns = 2_000_000_000
+
+# Leave lockfiles, generated, vendored and binary files out of the diff we
+# read, and show the model a one-line summary of each instead.
+skip_generated = True
+vendored_dirs = {
+    "vendor",
+    "vendored",
+    "node_modules",
+    "bower_components",
+    "third_party",
+    "third-party",
+    "3rdparty",
+}
+# Estimated diff bytes per changed line of a skipped file. We never read the
+# text, so this is what savings are reported in.
+changed_line_bytes = 40
+# Past this, excluding skipped files on git's command line could hit OS
+# limits on argument length.
+max_pathspec_chars = 32_000
+
+# How many `git diff` processes may read a big diff in parallel, each for its
+# own shard of the changed paths. Defaults to the cores we may run on.
+diff_workers = (
+    len(os.sched_getaffinity(0))
+    if hasattr(os, "sched_getaffinity")
+    else os.cpu_count() or 1
+)
+# Below this many changed files per shard, starting another git process costs
+# more than it saves.
+min_shard_files = 200
+
+_repo_paths: dict[str, Path] | None = None
+
+# The snapshot behind the generated message, which `commit` records.
+snapshot: Snapshot | None = None
+
+
+def run_git_command(
+    args: list[str],
+    input_text: str | None = None,
+    index_file: Path | None = None,
+) -> subprocess.CompletedProcess:
     """
     Run a git command with the given args.
 
+    Args:
+        args: the arguments passed to git
+        input_text: sent to the command's stdin, if given
+        index_file: use this index file instead of the repository's
+
     Returns:
         a CompletedProcess object
     """
     # ignoring S603 because args is controlled internally so no injection risk
     cmd = ["git", *args]
+    env = None
+    if index_file is not None:
+        env = {**os.environ, "GIT_INDEX_FILE": str(index_file)}
     return subprocess.run(  # noqa: S603
-        cmd, capture_output=True, text=True, encoding="utf-8", errors="ignore"
+        cmd,
+        capture_output=True,
+        text=True,
+        encoding="utf-8",
+        errors="ignore",
+        input=input_text,
+        env=env,
     )
 
 
+class GitStream:
+    """
+    Run a git command and yield its stdout line by line as git produces it,
+    instead of buffering the whole output.
+
+    ``returncode`` is set once the stream is exhausted or closed.
+    """
+
+    def __init__(self, args: list[str]):
+        self.args = args
+        self.returncode: int | None = None
+        self._proc: subprocess.Popen | None = None
+
+    def __iter__(self) -> Iterator[str]:
+        # ignoring S603 because args is controlled internally
+        self._proc = subprocess.Popen(  # noqa: S603
+            ["git", *self.args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding="utf-8",
+            errors="ignore",
+        )
+        try:
+            if self._proc.stdout is not None:
+                for line in self._proc.stdout:
+                    yield line.rstrip("\r\n")
+            self.returncode = self._proc.wait()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """
+        Stop reading. git is killed if it's still producing output.
+        """
+        proc = self._proc
+        if proc is None:
+            return
+        self._proc = None
+        if proc.stdout is not None:
+            proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if self.returncode is None:
+            # stopped before git finished, so it doesn't count as success
+            self.returncode = -1
+
+
+class CatFile:
+    """
+    A long-lived ``git cat-file --batch-check`` process that answers object
+    queries over pipes, so looking up a rev doesn't fork a new git.
+    """
+
+    def __init__(self):
+        self._proc: subprocess.Popen | None = None
+        self._lock = threading.Lock()
+
+    def _process(self) -> subprocess.Popen:
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = subprocess.Popen(
+                ["git", "cat-file", "--batch-check"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        return self._proc
+
+    def query(self, rev: str) -> tuple[str, str, int] | None:
+        """
+        Look up a single object.
+
+        Returns:
+            a tuple of (object name, type, size), or None if the object
+            doesn't exist or the worker died.
+        """
+        if "\n" in rev:
+            return None
+        with self._lock:
+            proc = self._process()
+            if proc.stdin is None or proc.stdout is None:
+                return None
+            try:
+                proc.stdin.write(rev.encode() + b"\n")
+                proc.stdin.flush()
+                header = proc.stdout.readline().decode().split()
+                if len(header) != 3:
+                    # "<rev> missing", "<rev> ambiguous", or EOF
+                    return None
+                sha, obj_type, size = header[0], header[1], int(header[2])
+            except (OSError, ValueError):
+                self._proc = None
+                return None
+        return sha, obj_type, size
+
+    @property
+    def pid(self) -> int | None:
+        """
+        pid of the running worker process, None if it isn't running.
+        """
+        if self._proc is None or self._proc.poll() is not None:
+            return None
+        return self._proc.pid
+
+    def close(self) -> None:
+        """
+        Stop the worker process. It's restarted on the next query.
+        """
+        with self._lock:
+            if self._proc is None:
+                return
+            if self._proc.stdin is not None:
+                self._proc.stdin.close()
+            try:
+                self._proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+            self._proc = None
+
+
+# Warm workers shared by the whole REPL session.
+workers: dict[str, CatFile] = {
+    "check": CatFile(),
+}
+
+
+def close_workers() -> None:
+    """
+    Shut down every long-lived git worker.
+    """
+    for worker in workers.values():
+        worker.close()
+
+
+def rev_parse(rev: str) -> str | None:
+    """
+    Resolve a rev (like HEAD) to its object name without forking git.
+
+    Returns:
+        the full object name, or None if the rev doesn't resolve
+    """
+    info = workers["check"].query(rev)
+    return info[0] if info else None
+
+
 def is_inside_working_tree() -> bool:
     """
     Check if we're inside a working directory (can execute commit and diff
@@ -26,59 +258,795 @@ def is_inside_working_tree() -> bool:
     return out.returncode == 0 and out.stdout.strip() == "true"
 
 
-def is_changed() -> bool:
+def pathspec_args(pathspecs: Sequence[str]) -> list[str]:
     """
-    Check if we have changed files
+    The tail of a git command line limiting it to pathspecs, if there are any.
     """
-    out = run_git_command(["diff", "--name-only"])
+    return ["--", *pathspecs] if pathspecs else []
+
+
+def is_changed(pathspecs: Sequence[str] = ()) -> bool:
+    """
+    Check if we have changed files, within the pathspecs if given
+    """
+    cached = ["--cached"] if staged_only else []
+    out = run_git_command(
+        ["diff", *cached, "--name-only", *pathspec_args(pathspecs)]
+    )
     return (out.returncode == 0) and (out.stdout.strip() != "")
 
 
-def get_diff() -> str | None:
+def get_diff(pathspecs: Sequence[str] = ()) -> str | None:
     """
     Get the diff from the current working directory.
 
+    Args:
+        pathspecs: only diff the paths they match
+
     Returns:
         the diff as a string (raw Git output), or None if an error occurred
     """
-    if not is_changed():
-        return ""
-
-    out = run_git_command(["--no-pager", "diff", "--no-color"])
+    # no `is_changed` prepass: an empty diff already tells us that, and it
+    # saves a fork on every generation.
+    out = run_git_command([*diff_args(), *pathspec_args(pathspecs)])
 
     if out.returncode == 0:
         return out.stdout.strip()
     return None
 
 
-def commit(msg: str) -> tuple[int, str]:
+def commit(msg: str, pathspecs: Sequence[str] = ()) -> tuple[int, str]:
     """
-    commit with msg as the commit text.
+    commit with msg as the commit text. Commits every tracked change, or
+    exactly the index in staged_only mode. With pathspecs, only the matching
+    files are committed, as they are in the working tree (`git commit --only`).
+
     Returns:
         the return value from running the commit command, stdout, and stderr
     """
-    out = run_git_command(["commit", "-a", "-m", msg])
+    all_changes = [] if staged_only or pathspecs else ["-a"]
+    out = run_git_command(
+        ["commit", *all_changes, "-m", msg, *pathspec_args(pathspecs)]
+    )
+    clear_diff_cache()
     ret = out.stdout.strip() if out.stdout.strip() != "" else out.stderr.strip()
     return out.returncode, ret
 
 
+def repo_paths() -> dict[str, Path] | None:
+    """
+    Locate the files that describe the repository's state. Looked up once per
+    session.
+
+    Returns:
+        a dict with "git_dir", "common_dir", "index", "hooks" and "toplevel"
+        paths, or None if we're not in a working tree
+    """
+    global _repo_paths
+    if _repo_paths is None:
+        out = run_git_command(
+            [
+                "rev-parse",
+                "--absolute-git-dir",
+                "--git-common-dir",
+                "--git-path",
+                "index",
+                "--git-path",
+                "hooks",
+                "--show-toplevel",
+            ]
+        )
+        lines = out.stdout.splitlines()
+        if out.returncode != 0 or len(lines) != 5:
+            return None
+        git_dir, common_dir, index, hooks, toplevel = lines
+        _repo_paths = {
+            "git_dir": Path(git_dir),
+            "common_dir": Path(common_dir).absolute(),
+            "index": Path(index).absolute(),
+            "hooks": Path(hooks).absolute(),
+            "toplevel": Path(toplevel),
+        }
+    return _repo_paths
+
+
+def _stat_key(path: str | bytes | os.PathLike) -> tuple[int, ...] | None:
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino, st.st_mode
+
+
+def repo_fingerprint(worktree: bool = True) -> str | None:
+    """
+    Compute a cheap fingerprint of everything `git diff` depends on: the
+    index, HEAD, the refs, the config, and the stat data of every tracked
+    file that differs from the index. One `git ls-files -m` finds those: git
+    checks the stat data the index keeps for each file, which is several
+    times faster than stat-ing every tracked file from Python, and it's the
+    only git process this starts.
+
+    Args:
+        worktree: include the working tree. A diff of the index alone only
+            depends on its .gitattributes files, so it skips the rest.
+
+    Returns:
+        a hex digest, or None if the state can't be fingerprinted reliably
+        (git failed, or files modified a moment ago)
+    """
+    paths = repo_paths()
+    if paths is None:
+        return None
+    git_dir, common_dir = paths["git_dir"], paths["common_dir"]
+    try:
+        head = (git_dir / "HEAD").read_bytes()
+    except OSError:
+        return None
+    # diffing the index still reads attributes from the working tree
+    pathspec = ":/" if worktree else ":(top,glob)**/.gitattributes"
+    out = run_git_command(["ls-files", "-m", "-z", "--full-name", pathspec])
+    if out.returncode != 0:
+        return None
+    # an unmerged file is listed once per stage
+    modified = sorted({path for path in out.stdout.split("\0") if path})
+
+    stats = [
+        _stat_key(paths["index"]),
+        _stat_key(common_dir / "packed-refs"),
+        _stat_key(common_dir / "config"),
+        _stat_key(common_dir / "info" / "attributes"),
+        _stat_key(paths["toplevel"] / ".gitattributes"),
+    ]
+    if head.startswith(b"ref: "):
+        ref = head[5:].strip().decode(errors="ignore")
+        stats.append(_stat_key(common_dir / ref))
+        stats.append(_stat_key(git_dir / ref))
+    stats.extend(_stat_key(paths["toplevel"] / path) for path in modified)
+
+    cutoff = time.time_ns() - racy_window_ns
+    if any(st is not None and st[0] >= cutoff for st in stats):
+        return None
+
+    digest = hashlib.blake2b(head, digest_size=20)
+    digest.update(repr((modified, stats)).encode())
+    return digest.hexdigest()
+
+
+def clear_diff_cache() -> None:
+    """
+    Drop every cached diff.
+    """
+    diff_cache.clear()
+
+
 def clean_diff(diff: str | None) -> str:
     """
     Remove unnecessary information from the diff.
     """
     if diff is None:
         return ""
+    return diff_parser.render(diff_parser.parse_diff(diff.splitlines()))
+
+
+def diff_args() -> list[str]:
+    """
+    The git command that produces the diff we describe: the index against
+    HEAD in staged_only mode, the working tree against the index otherwise.
+    """
+    if staged_only:
+        return ["--no-pager", "diff", "--no-color", "--cached"]
+    return ["--no-pager", "diff", "--no-color"]
+
+
+def _bounded(lines: Iterable[str], limit: int, state: dict) -> Iterator[str]:
+    size = 0
+    for line in lines:
+        size += len(line) + 1
+        if size > limit:
+            state["truncated"] = True
+            return
+        yield line
+
+
+def numstat(
+    args: list[str], pathspecs: Sequence[str] = ()
+) -> list[tuple[int, int, str, str]] | None:
+    """
+    Cheaply list the changed files and their line counts, without the
+    diff text.
+
+    Args:
+        args: the diff command to list files for
+        pathspecs: only list the files they match
+
+    Returns:
+        (added, removed, path, old path) for every file, paths relative to
+        the top level. The old path differs from the path for renames.
+        Binary files count as (-1, -1). None if git failed.
+    """
+    out = run_git_command([*args, "--numstat", "-z", *pathspec_args(pathspecs)])
+    if out.returncode != 0:
+        return None
+    fields = out.stdout.split("\0")
+    stats = []
+    i = 0
+    while i < len(fields) - 1:
+        added, removed, path = fields[i].split("\t", 2)
+        old_path = path
+        i += 1
+        if path == "":
+            # renames are printed as "added\tremoved\t\0old\0new"
+            old_path, path = fields[i], fields[i + 1]
+            i += 2
+        if added == "-":
+            stats.append((-1, -1, path, old_path))
+        else:
+            stats.append((int(added), int(removed), path, old_path))
+    return stats
+
+
+def check_attrs(paths: list[str]) -> dict[str, dict[str, str]]:
+    """
+    Look up the gitattributes that matter for skipping files.
+
+    Args:
+        paths: paths relative to the top level
+
+    Returns:
+        the set attributes of each path
+    """
+    top = repo_paths()
+    if not paths or top is None:
+        return {}
+    out = run_git_command(
+        [
+            "-C",
+            str(top["toplevel"]),
+            "check-attr",
+            "-z",
+            "--stdin",
+            "linguist-generated",
+            "linguist-vendored",
+            "diff",
+        ],
+        input_text="\0".join(paths) + "\0",
+    )
+    attrs: dict[str, dict[str, str]] = {}
+    if out.returncode != 0:
+        return attrs
+    fields = out.stdout.split("\0")
+    for i in range(0, len(fields) - 2, 3):
+        path, attr, value = fields[i : i + 3]
+        if value != "unspecified":
+            attrs.setdefault(path, {})[attr] = value
+    return attrs
+
+
+def skip_reason(path: str, attrs: dict[str, str], binary: bool) -> str | None:
+    """
+    Decide whether a file's diff is worth reading.
+
+    Returns:
+        why the file should be left out, or None to keep it
+    """
+    if binary or attrs.get("diff") == "unset":
+        return "binary"
+    if attrs.get("linguist-generated") in ("set", "true"):
+        return "generated"
+    if attrs.get("linguist-vendored") in ("set", "true"):
+        return "vendored"
+    parts = PurePosixPath(path).parts
+    if parts and parts[-1] in packing.lockfile_names:
+        return "lockfile"
+    if path.endswith(packing.generated_suffixes):
+        return "generated"
+    if any(part in vendored_dirs for part in parts[:-1]):
+        return "vendored"
+    return None
+
+
+def skipped_savings(files: list[diff_parser.FileDiff]) -> tuple[int, int, int]:
+    """
+    Estimate what skipping files saved.
+
+    Returns:
+        (number of skipped files, estimated bytes, estimated tokens)
+    """
+    count = 0
+    saved = 0
+    for file in files:
+        if file.skipped is None:
+            continue
+        count += 1
+        if not file.binary:
+            saved += (file.added + file.removed) * changed_line_bytes
+    return count, saved, -(-saved // packing.chars_per_token)
+
+
+class Snapshot:
+    """
+    The exact changes a message describes: a tree written to the object
+    database, the commit it's based on, and the parsed diff between them.
+    ``pathspecs`` are the paths it was limited to, if any.
+
+    ``tree`` is None when the state couldn't be recorded (an index with
+    merge conflicts, say). The diff then comes from plain `git diff` and
+    committing falls back to porcelain.
+    """
+
+    def __init__(
+        self,
+        tree: str | None,
+        parent: str | None,
+        files: list[diff_parser.FileDiff],
+        pathspecs: tuple[str, ...] = (),
+    ):
+        self.tree = tree
+        self.parent = parent
+        self.files = files
+        self.pathspecs = pathspecs
+
+
+def take_snapshot(pathspecs: Sequence[str] = ()) -> Snapshot:
+    """
+    Record the tree that committing would create, and diff it against HEAD.
+
+    The tree is built in a temporary copy of the index, so the real index is
+    never touched: in staged_only mode it's the index as is, otherwise the
+    index plus every change to tracked files (what `git commit -a` records).
+    With pathspecs, everything outside them is left as it is in HEAD.
+    """
+    parent = rev_parse("HEAD")
+    tree = write_snapshot_tree(parent, pathspecs)
+    if tree is None:
+        files = read_diff_files(diff_args(), pathspecs)
+        return Snapshot(None, parent, files, tuple(pathspecs))
+    base = parent if parent is not None else empty_tree()
+    args = ["--no-pager", "diff", "--no-color", base, tree]
+    return Snapshot(tree, parent, read_diff_files(args), tuple(pathspecs))
+
+
+def write_snapshot_tree(
+    parent: str | None, pathspecs: Sequence[str] = ()
+) -> str | None:
+    """
+    Write the tree we'd commit to the object database.
+
+    Args:
+        parent: the commit the tree will be committed on top of
+        pathspecs: only take changes to the paths they match
+
+    Returns:
+        the tree's object name, or None if it can't be written
+    """
+    paths = repo_paths()
+    if paths is None:
+        return None
+    try:
+        tmp_index = temp_index(paths["git_dir"])
+    except OSError:
+        return None
+    try:
+        if pathspecs:
+            if not _scoped_index(tmp_index, parent, pathspecs):
+                return None
+        elif paths["index"].exists():
+            shutil.copyfile(paths["index"], tmp_index)
+        if not staged_only:
+            out = run_git_command(
+                ["add", "-u", "--", *(pathspecs or [":/"])],
+                index_file=tmp_index,
+            )
+            if out.returncode != 0:
+                return None
+        out = run_git_command(["write-tree"], index_file=tmp_index)
+    except OSError:
+        return None
+    finally:
+        tmp_index.unlink(missing_ok=True)
+    tree = out.stdout.strip()
+    return tree if out.returncode == 0 and tree else None
+
+
+def temp_index(git_dir: Path) -> Path:
+    """
+    Create an empty index file of our own in git_dir, for the caller to
+    delete. Each call gets a new one, so a snapshot taken in the background
+    can't clobber the index a gen or commit is building.
+    """
+    fd, name = tempfile.mkstemp(prefix="commizard-index-", dir=git_dir)
+    os.close(fd)
+    return Path(name)
+
+
+def _scoped_index(
+    index_file: Path, parent: str | None, pathspecs: Sequence[str]
+) -> bool:
+    """
+    Fill a temporary index with the parent commit's tree, except for the
+    paths matching pathspecs, which are taken from the real index.
+
+    Returns:
+        whether it worked
+    """
+    for args in (
+        ["read-tree", parent or "--empty"],
+        ["rm", "-r", "-q", "--cached", "--ignore-unmatch", "--", *pathspecs],
+    ):
+        if run_git_command(args, index_file=index_file).returncode != 0:
+            return False
+    staged = run_git_command(["ls-files", "-s", "-z", "--", *pathspecs])
+    if staged.returncode != 0:
+        return False
+    out = run_git_command(
+        ["update-index", "-z", "--index-info"],
+        staged.stdout,
+        index_file=index_file,
+    )
+    return out.returncode == 0
+
+
+def empty_tree() -> str:
+    """
+    The object name of the empty tree, the base of a repo's first commit.
+    """
+    out = run_git_command(["hash-object", "-t", "tree", "--stdin"], "")
+    return out.stdout.strip()
+
+
+def get_snapshot(pathspecs: Sequence[str] = ()) -> Snapshot:
+    """
+    Get a snapshot of the current changes. When the repo fingerprint hasn't
+    changed since an earlier call, the cached snapshot is returned, and the
+    only git process started is the fingerprint's `ls-files`.
+
+    Args:
+        pathspecs: only include changes to the paths they match
+
+    Returns:
+        the snapshot (shared with the cache, don't modify it)
+    """
+    fingerprint = repo_fingerprint(worktree=not staged_only)
+    key = (fingerprint, staged_only, skip_generated, tuple(pathspecs))
+    with _diff_cache_lock:
+        if fingerprint is not None and key in diff_cache:
+            diff_cache.move_to_end(key)
+            return diff_cache[key]
+
+    snap = take_snapshot(pathspecs)
+    if fingerprint is not None:
+        with _diff_cache_lock:
+            diff_cache[key] = snap
+            while len(diff_cache) > diff_cache_size:
+                diff_cache.popitem(last=False)
+    return snap
+
+
+def get_diff_files(
+    pathspecs: Sequence[str] = (),
+) -> list[diff_parser.FileDiff]:
+    """
+    Get the current git diff as parsed files.
+
+    Args:
+        pathspecs: only diff the paths they match
+
+    Returns:
+        the parsed files (shared with the cache, don't modify them), or an
+        empty list if git failed
+    """
+    return get_snapshot(pathspecs).files
+
+
+def has_commit_hooks() -> bool:
+    """
+    Whether committing would run hooks that only porcelain `git commit`
+    knows how to run.
+    """
+    paths = repo_paths()
+    if paths is None:
+        return False
+    return any(
+        os.access(paths["hooks"] / hook, os.X_OK)
+        for hook in (
+            "pre-commit",
+            "prepare-commit-msg",
+            "commit-msg",
+            "post-commit",
+        )
+    )
+
+
+def commit_snapshot(snap: Snapshot, msg: str) -> tuple[int, str]:
+    """
+    Commit exactly the tree recorded in a snapshot, with plumbing
+    (commit-tree and update-ref) so nothing is scanned again. The index is
+    then brought in line with the new commit for the files it changed.
+
+    Falls back to porcelain `git commit` if the snapshot has no tree, and
+    commits the tree through porcelain on a temporary index if the repo has
+    commit hooks, so they still run.
+
+    Returns:
+        a return code (0 on success) and a message describing the result
+    """
+    if snap.tree is None:
+        return commit(msg, snap.pathspecs)
+    if rev_parse("HEAD") != snap.parent:
+        return 1, "HEAD moved since the message was generated. Run gen again."
+    if has_commit_hooks():
+        code, out = _commit_tree_with_hooks(snap.tree, msg)
+    else:
+        code, out = _commit_tree(snap, msg)
+    if code != 0:
+        return code, out
+    if not staged_only:
+        _sync_index(snap)
+    clear_diff_cache()
+    return 0, out
+
+
+def _commit_tree(snap: Snapshot, msg: str) -> tuple[int, str]:
+    parents = ["-p", snap.parent] if snap.parent else []
+    out = run_git_command(
+        ["commit-tree", str(snap.tree), *parents, "-F", "-"], msg
+    )
+    new = out.stdout.strip()
+    if out.returncode != 0 or not new:
+        return out.returncode or 1, out.stderr.strip()
+    subject = msg.strip().split("\n", 1)[0]
+    # the old value makes this atomic: it fails if HEAD moved meanwhile
+    out = run_git_command(
+        [
+            "update-ref",
+            "-m",
+            f"commit: {subject}",
+            "HEAD",
+            new,
+            snap.parent or "",
+        ]
+    )
+    if out.returncode != 0:
+        return out.returncode, out.stderr.strip()
+    return 0, f"[{new[:7]}] {subject}"
+
+
+def _commit_tree_with_hooks(tree: str, msg: str) -> tuple[int, str]:
+    paths = repo_paths()
+    if paths is None:
+        return 1, "not inside a git repository"
+    try:
+        tmp_index = temp_index(paths["git_dir"])
+    except OSError as e:
+        return 1, str(e)
+    try:
+        out = run_git_command(["read-tree", tree], index_file=tmp_index)
+        if out.returncode == 0:
+            out = run_git_command(
+                ["commit", "-F", "-"], msg, index_file=tmp_index
+            )
+    finally:
+        tmp_index.unlink(missing_ok=True)
+    ret = out.stdout.strip() if out.stdout.strip() != "" else out.stderr.strip()
+    return out.returncode, ret
+
+
+def _sync_index(snap: Snapshot) -> None:
+    """
+    Point the real index at the new commit for every path we committed, so
+    the working tree changes don't show up as staged reverts.
+    """
+    base = snap.parent if snap.parent is not None else empty_tree()
+    out = run_git_command(
+        [
+            "diff-tree",
+            "-r",
+            "-z",
+            "--name-only",
+            "--no-renames",
+            base,
+            str(snap.tree),
+        ]
+    )
+    changed = [path for path in out.stdout.split("\0") if path]
+    if out.returncode != 0 or not changed:
+        return
+    run_git_command(
+        [
+            "reset",
+            "-q",
+            "--pathspec-from-file=-",
+            "--pathspec-file-nul",
+        ],
+        "\0".join(f":(top,literal){path}" for path in changed),
+    )
+
+
+def read_diff_files(
+    args: list[str], pathspecs: Sequence[str] = ()
+) -> list[diff_parser.FileDiff]:
+    """
+    Run a git diff, limited to pathspecs if given, and parse it. A --numstat
+    prepass finds the files first: if skip_generated is set, lockfiles,
+    generated, vendored and binary files are excluded from the real diff, so
+    their text is never read, and they come back as FileDiff stubs with
+    ``skipped`` set.
+
+    Reading stops once max_diff_chars have been read, and the last file is
+    marked as truncated.
+
+    Returns:
+        the parsed files followed by the skipped ones, or an empty list if
+        git failed or nothing changed
+    """
+    stats = numstat(args, pathspecs)
+    if not stats:
+        return []
+
+    skipped: list[diff_parser.FileDiff] = []
+    kept = stats
+    if skip_generated:
+        kept = []
+        attrs = check_attrs([stat[2] for stat in stats])
+        for stat in stats:
+            added, removed, path, old_path = stat
+            binary = added < 0
+            reason = skip_reason(path, attrs.get(path, {}), binary)
+            if reason is None:
+                kept.append(stat)
+                continue
+            stub = diff_parser.FileDiff(old_path, path)
+            stub.skipped = reason
+            stub.binary = binary
+            stub.counts = (max(added, 0), max(removed, 0))
+            skipped.append(stub)
+    if not kept:
+        return skipped
+
+    # a renamed file is left out under both names, or git shows its old
+    # name as a deletion of the whole file
+    kept_paths = {path for _, _, new, old in kept for path in (new, old)}
+    skipped_paths = {
+        path
+        for _, _, new, old in stats
+        for path in (new, old)
+        if path not in kept_paths
+    }
+    shards = shard_paths(kept)
+    if len(shards) > 1:
+        files = read_shards(args, shards)
+        return [] if files is None else files + skipped
+
+    excludes = [
+        f":(top,exclude,literal){path}" for path in sorted(skipped_paths)
+    ]
+    if sum(len(spec) for spec in excludes) > max_pathspec_chars:
+        # too long for a command line: read everything, drop the skipped
+        # files afterwards. Still keeps them out of the prompt.
+        excludes = []
+    files = _read_stream(
+        GitStream([*args, "--", *(pathspecs or [":/"]), *excludes])
+    )
+    if files is None:
+        return []
+    return [
+        f
+        for f in files
+        if f.old_path not in skipped_paths and f.new_path not in skipped_paths
+    ] + skipped
+
+
+def shard_paths(
+    stats: list[tuple[int, int, str, str]],
+) -> list[list[str]]:
+    """
+    Split the changed files into contiguous runs, one per parallel git diff.
+    A renamed file's old and new paths stay in the same shard, so git still
+    sees it as a rename.
+
+    Returns:
+        the pathspecs of each shard, a single shard if the diff is too small
+        to be worth splitting
+    """
+    count = min(diff_workers, len(stats) // min_shard_files)
+    if count <= 1:
+        return [[]]
+    per_shard = -(-len(stats) // count)
+    shards: list[list[str]] = []
+    size = 0
+    for i, (_, _, path, old_path) in enumerate(stats):
+        paths = [path] if old_path == path else [old_path, path]
+        specs = [f":(top,literal){p}" for p in paths]
+        spec_size = sum(len(spec) for spec in specs)
+        # a shard also ends before its pathspecs grow too long for a command
+        # line; the pool then runs more shards than workers
+        if i % per_shard == 0 or size > max_pathspec_chars:
+            shards.append([])
+            size = 0
+        shards[-1].extend(specs)
+        size += spec_size
+    return shards
+
+
+def read_shards(
+    args: list[str], shards: list[list[str]]
+) -> list[diff_parser.FileDiff] | None:
+    """
+    Run one git diff per shard in a thread pool and merge the results in
+    shard order, so the output is the same whatever order they finish in.
+
+    Returns:
+        the parsed files, cut off after max_diff_chars, or None if git failed
+    """
+
+    def read(shard: list[str]) -> list[diff_parser.FileDiff] | None:
+        return _read_stream(GitStream([*args, "--", *shard]))
+
+    with ThreadPoolExecutor(max_workers=diff_workers) as pool:
+        results = list(pool.map(read, shards))
+    if any(files is None for files in results):
+        return None
+
+    merged: list[diff_parser.FileDiff] = []
+    remaining = max_diff_chars
+    for files in results:
+        for file in files or ():
+            remaining -= trim_file(file, remaining)
+            merged.append(file)
+            if file.truncated:
+                # past the cap, like a serial read would have stopped
+                return merged
+    return merged
+
+
+def trim_file(file: diff_parser.FileDiff, limit: int) -> int:
+    """
+    Cut a parsed file down to at most ``limit`` characters of diff, marking
+    it truncated if anything was cut.
+
+    Returns:
+        how many characters the file takes up
+    """
+    size = 0
+    for n, line in enumerate(file.headers):
+        size += len(line) + 1
+        if size > limit:
+            file.headers = file.headers[:n]
+            file.hunks = []
+            file.truncated = True
+            return size - len(line) - 1
+    for h, hunk in enumerate(file.hunks):
+        for n, line in enumerate([hunk.header, *hunk.lines]):
+            size += len(line) + 1
+            if size <= limit:
+                continue
+            del file.hunks[h:]
+            if n > 0:
+                kept = diff_parser.Hunk(hunk.header, hunk.old, hunk.new)
+                for kept_line in hunk.lines[: n - 1]:
+                    kept.append(kept_line)
+                file.hunks.append(kept)
+            file.truncated = True
+            return size - len(line) - 1
+    return size
+
 
-    lines = diff.splitlines()
-    for line in lines[:]:
-        if line.startswith(("diff --git", "index ", "warning:")):
-            lines.remove(line)
-    return "\n".join(lines)
+def _read_stream(stream: GitStream) -> list[diff_parser.FileDiff] | None:
+    state = {"truncated": False}
+    files = diff_parser.parse_diff(_bounded(stream, max_diff_chars, state))
+    if state["truncated"]:
+        stream.close()
+        if files:
+            files[-1].truncated = True
+        return files
+    if stream.returncode != 0:
+        return None
+    return files
 
 
 def get_clean_diff() -> str:
     """
     Get the current git diff, sanitized for LLM consumption.
     """
-    diff = get_diff()
-    return clean_diff(diff)
+    return diff_parser.render(get_diff_files())
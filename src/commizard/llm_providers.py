@@ -1,13 +1,137 @@
 from __future__ import annotations
 
+import contextlib
+import json
+import math
+import os
+import queue
+import random
+import secrets
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+from urllib.parse import urlsplit
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import config, output, packing, response_cache
 
-from . import output
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from concurrent.futures import Future
 
-available_models: list[str] | None = None
 selected_model: str | None = None
 gen_message: str | None = None
 
+# (connect, read) timeouts in seconds for each Ollama endpoint. Probes give up
+# quickly; a generation can think for minutes on a CPU before it answers.
+timeouts: dict[str, tuple[float, float]] = {
+    "/api/version": (0.3, 2.0),
+    "/api/tags": (1.0, 5.0),
+    "/api/generate": (2.0, 600.0),
+    "/v1/models": (1.0, 5.0),
+    "/v1/chat/completions": (2.0, 600.0),
+}
+default_timeout = (2.0, 30.0)
+# Connections kept open to each host, so concurrent requests don't queue up.
+pool_size = 8
+
+# A request that can't connect, times out reading (GET only, a POST may have
+# been acted on) or gets a 503 is tried again up to `retries` times, after a
+# random pause of up to backoff_base * 2**attempt seconds (at most
+# backoff_cap).
+retries = 2
+backoff_base = 0.1
+backoff_cap = 2.0
+# After breaker_threshold failed requests in a row to a host, its requests
+# fail at once for breaker_cooldown seconds instead of each waiting for a
+# timeout. Then one request is let through to see if it's back.
+breaker_threshold = 3
+breaker_cooldown = 30.0
+
+# How long Ollama keeps the model (and its cache of the evaluated system
+# prompt) in memory after a request. Its default of 5 minutes is shorter than
+# a typical pause between two commits.
+keep_alive = "30m"
+
+# The background load of the default model started with the session, until
+# a generation has waited for it.
+preload: Future[bool] | None = None
+
+# Timings of the last generation, as Ollama reported them.
+last_stats: dict[str, int] = {}
+stat_keys = (
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+)
+
+# The model runs with one context window (num_ctx) per session: the smallest
+# of these that holds a full prompt (packing.token_budget of diff) and the
+# longest answer, within the model's own limit. It only grows, to the next
+# size that holds a larger prompt, since Ollama reloads the model (and drops
+# its cached system prompt) whenever the window changes.
+context_buckets = (2048, 4096, 8192, 16384, 32768, 65536, 131072)
+context_window: int | None = None
+_window_lock = threading.Lock()
+# The prompt estimate is a guess, and the chat template adds some tokens.
+context_margin = 1.15
+# The most tokens a commit message may take (num_predict), so a model that
+# rambles on stops early.
+max_new_tokens = 512
+# Each model's context length, as the server reports it (None if it doesn't).
+context_limits: dict[str, int | None] = {}
+# The prompt estimate and the window and answer size picked for the last
+# generation.
+last_sizing: dict[str, int] = {}
+
+# The model is unloaded after this many seconds without a generation, so the
+# RAM goes back to the rest of the machine between bursts of commits. Set with
+# "idle_unload_minutes" in the config; 0 only unloads on exit.
+idle_unload_seconds = 600.0
+# Unload early when less than this fraction of the RAM is available.
+min_available_memory = 0.1
+# How often the lifecycle watcher wakes up to check the above, in seconds.
+watch_interval = 15.0
+
+# The model this session loaded and hasn't unloaded yet, when it was last
+# used, and how many generations are running on it.
+loaded_model: str | None = None
+last_used = 0.0
+in_flight = 0
+_lifecycle_lock = threading.Lock()
+_watcher: threading.Thread | None = None
+_stop_watching = threading.Event()
+
+# A generation that hasn't produced its first token by the hedge deadline
+# gets a second request racing it, to the "fallback_model" in the config or,
+# with several hosts, to another host. The deadline is "hedge_after" seconds
+# if that's set, else the hedge_percentile of the recent times to first
+# token (hedge_default until there are hedge_min_samples of them).
+hedge_percentile = 0.95
+hedge_min_samples = 10
+hedge_default = 30.0
+# never sooner than this, however fast the server usually is
+hedge_floor = 1.0
+first_token_times: deque[float] = deque(maxlen=100)
+
+# Per thread: the hedged request (see Attempt) the thread is running.
+thread_state = threading.local()
+
+# The server we talk to, set up from the config on first use.
+provider: Provider | None = None
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
 # Ironically enough, I've used Chat-GPT to write a prompt to prompt other
 # Models (or even itself in the future!)
 generation_prompt = """
@@ -28,6 +152,18 @@ Here is the diff:
 """
 
 
+# What each (negative) HttpResponse return code means.
+error_messages = {
+    -1: "can't connect to the server",
+    -2: "HTTP error occurred",
+    -3: "too many redirects",
+    -4: "the request timed out",
+    -5: "the request failed",
+    -6: "the server refused the connection",
+    -7: "the server keeps failing, so it's left alone for a while",
+}
+
+
 class HttpResponse:
     def __init__(self, response, return_code):
         self.response = response
@@ -40,66 +176,1067 @@ class HttpResponse:
     def err_message(self) -> str:
         if not self.is_error():
             return ""
-        err_dict = {
-            -1: "can't connect to the server",
-            -2: "HTTP error occurred",
-            -3: "too many redirects",
-            -4: "the request timed out",
+        return error_messages[self.return_code]
+
+
+class Attempt:
+    """
+    One of the requests racing in a hedged generation, or a generation in
+    the background. Cancelling it closes its response, so the server stops
+    generating for it. A request still waiting for the response to start
+    (Ollama sends nothing until the prompt is evaluated) has its connection
+    shut down instead. Its stats and sizing are kept here rather than in
+    last_stats and last_sizing, which only the winner's go to.
+    """
+
+    __slots__ = (
+        "_lock",
+        "cancelled",
+        "connection",
+        "model",
+        "response",
+        "sizing",
+        "started",
+        "stats",
+    )
+
+    def __init__(self, model: str):
+        self.model = model
+        self.cancelled = False
+        self.response: requests.Response | None = None
+        # the connection while it waits for the response to start
+        self.connection: HTTPConnection | None = None
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.stats: dict[str, int] = {}
+        self.sizing: dict[str, int] = {}
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            if self.connection is not None:
+                abort(self.connection)
+        response = self.response
+        if response is not None:
+            response.close()
+
+    def waiting(self, connection: HTTPConnection | None) -> None:
+        """
+        Record the connection the request waits on for its response (None
+        once the response has started), shutting it down if the attempt
+        was already cancelled.
+        """
+        with self._lock:
+            self.connection = connection
+            if connection is not None and self.cancelled:
+                abort(connection)
+
+
+def abort(connection: HTTPConnection) -> None:
+    """
+    Shut a connection down from another thread, so a read blocked on it
+    fails at once and the server sees the client go away.
+    """
+    sock = connection.sock
+    if sock is not None:
+        # already closed, or never connected
+        with contextlib.suppress(OSError):
+            sock.shutdown(socket.SHUT_RDWR)
+
+
+class AbortableHTTPConnection(HTTPConnection):
+    """
+    A connection the thread's Attempt can shut down while it waits for the
+    response to start.
+    """
+
+    def getresponse(self, *args: Any, **kwargs: Any) -> Any:
+        attempt: Attempt | None = getattr(thread_state, "attempt", None)
+        if attempt is None:
+            return super().getresponse(*args, **kwargs)
+        attempt.waiting(self)
+        try:
+            return super().getresponse(*args, **kwargs)
+        finally:
+            # the connection goes back to the pool for other requests
+            attempt.waiting(None)
+
+
+class AbortableHTTPSConnection(AbortableHTTPConnection, HTTPSConnection):
+    pass
+
+
+class AbortableHTTPPool(HTTPConnectionPool):
+    ConnectionCls = AbortableHTTPConnection
+
+
+class AbortableHTTPSPool(HTTPSConnectionPool):
+    ConnectionCls = AbortableHTTPSConnection
+
+
+class AbortableAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter whose connections a cancelled Attempt can shut down.
+    """
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": AbortableHTTPPool,
+            "https": AbortableHTTPSPool,
         }
-        return err_dict[self.return_code]
 
 
-def http_request(method: str, url: str, **kwargs) -> HttpResponse:
-    resp = None
+class CircuitOpen(requests.RequestException):
+    """
+    Raised instead of sending a request to a host whose breaker is open.
+    """
+
+
+class Breaker:
+    """
+    The circuit breaker of one host, see breaker_threshold.
+    """
+
+    __slots__ = ("failures", "open_until", "probing")
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        """
+        Whether a request may go to the host now.
+        """
+        with _breaker_lock:
+            if self.open_until == 0.0:
+                return True
+            if self.probing or time.monotonic() < self.open_until:
+                return False
+            # cooled down: this request finds out if the host is back
+            self.probing = True
+            return True
+
+    def abandon(self) -> None:
+        """
+        Forget a request that was given up on, without counting it.
+        """
+        with _breaker_lock:
+            self.probing = False
+
+    def record(self, ok: bool) -> None:
+        """
+        Count the outcome of a request to the host.
+        """
+        with _breaker_lock:
+            if ok:
+                self.failures = 0
+                self.open_until = 0.0
+            else:
+                self.failures += 1
+                if self.probing or self.failures >= breaker_threshold:
+                    self.open_until = time.monotonic() + breaker_cooldown
+            self.probing = False
+
+
+# the breaker of each host, by scheme and host:port
+breakers: dict[str, Breaker] = {}
+_breaker_lock = threading.Lock()
+
+
+def breaker_for(url: str) -> Breaker:
+    parts = urlsplit(url)
+    key = f"{parts.scheme}://{parts.netloc}"
+    with _breaker_lock:
+        return breakers.setdefault(key, Breaker())
+
+
+def backoff(attempt: int) -> float:
+    """
+    How long to wait before retry number attempt + 1: "full jitter", so
+    clients that failed together don't all come back at the same moment.
+    """
+    return random.uniform(0, min(backoff_cap, backoff_base * 2**attempt))
+
+
+def get_session() -> requests.Session:
+    """
+    The HTTP session shared by every request to Ollama. It keeps connections
+    alive and pools them, so repeated calls skip the TCP handshake. Safe to
+    call from several threads.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            # a pool per host, or hosts take turns evicting each other's
+            hosts = max(2, get_provider().host_count)
+            session = requests.Session()
+            adapter = AbortableAdapter(
+                pool_connections=hosts, pool_maxsize=pool_size
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def close_session() -> None:
+    """
+    Close the pooled connections. A later request opens a new session.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def endpoint_timeout(url: str) -> tuple[float, float]:
+    """
+    The (connect, read) timeout for a request to the given URL.
+    """
+    return timeouts.get(urlsplit(url).path, default_timeout)
+
+
+def send(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Send a request on the shared session, with the endpoint's timeout,
+    retries (see retries) and the host's circuit breaker.
+
+    Raises:
+        requests.RequestException: the request failed, or CircuitOpen if
+            the host's breaker kept it from being sent
+    """
+    kwargs.setdefault("timeout", endpoint_timeout(url))
+    breaker = breaker_for(url)
+    if not breaker.allow():
+        raise CircuitOpen(url)
+    do = getattr(get_session(), method.lower())
+    current: Attempt | None = getattr(thread_state, "attempt", None)
+    attempt = 0
     try:
-        if method.upper() == "GET":
-            r = requests.get(url, **kwargs)  # noqa: S113
-        elif method.upper() == "POST":
-            r = requests.post(url, **kwargs)  # noqa: S113
+        while True:
+            try:
+                r = do(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                retry = isinstance(e, requests.ConnectionError) or (
+                    method.upper() == "GET"
+                )
+                if current is not None and current.cancelled:
+                    retry = False
+                if not retry or attempt >= retries:
+                    raise
+            else:
+                if r.status_code != 503 or attempt >= retries:
+                    breaker.record(r.status_code < 500)
+                    return r
+                r.close()
+            time.sleep(backoff(attempt))
+            attempt += 1
+    except BaseException:
+        # whatever went wrong, or a half-open breaker would wait on this
+        # request forever. Cancelling says nothing about the host.
+        if current is not None and current.cancelled:
+            breaker.abandon()
+        else:
+            breaker.record(False)
+        raise
+
 
+def http_request(method: str, url: str, **kwargs) -> HttpResponse:
+    resp = None
+    if method.upper() not in ("GET", "POST"):
+        if method.upper() in ("PUT", "DELETE", "PATCH"):
+            raise NotImplementedError(f"{method} is not implemented.")
         else:
-            if method.upper() in ("PUT", "DELETE", "PATCH"):
-                raise NotImplementedError(f"{method} is not implemented.")
-            else:
-                raise ValueError(f"{method} is not a valid method.")
+            raise ValueError(f"{method} is not a valid method.")
+    try:
+        r = send(method, url, **kwargs)
         try:
             resp = r.json()
         except requests.exceptions.JSONDecodeError:
             resp = r.text
         ret_val = r.status_code
-    except requests.ConnectionError:
-        ret_val = -1
-    except requests.HTTPError:
-        ret_val = -2
-    except requests.TooManyRedirects:
-        ret_val = -3
-    except requests.Timeout:
-        ret_val = -4
-    except requests.RequestException:
-        ret_val = -5
+    except requests.RequestException as e:
+        ret_val = request_error_code(e)
     return HttpResponse(resp, ret_val)
 
 
-def init_model_list() -> None:
+def request_error_code(error: requests.RequestException) -> int:
+    """
+    The (negative) HttpResponse return code for a failed request.
+    """
+    if isinstance(error, CircuitOpen):
+        return -7
+    if isinstance(error, requests.ConnectionError):
+        return -6 if was_refused(error) else -1
+    if isinstance(error, requests.HTTPError):
+        return -2
+    if isinstance(error, requests.TooManyRedirects):
+        return -3
+    if isinstance(error, requests.Timeout):
+        return -4
+    return -5
+
+
+def was_refused(error: BaseException) -> bool:
+    """
+    Whether a connection error comes down to the server refusing the
+    connection (nothing listening on the port), as opposed to, say, a
+    failed DNS lookup or a reset.
+    """
+    seen: set[int] = set()
+    stack: list[object] = [error]
+    while stack:
+        cause = stack.pop()
+        if not isinstance(cause, BaseException) or id(cause) in seen:
+            continue
+        if isinstance(cause, ConnectionRefusedError):
+            return True
+        seen.add(id(cause))
+        # requests and urllib3 keep the cause in args or .reason
+        stack.extend(cause.args)
+        stack.extend((getattr(cause, "reason", None), cause.__cause__))
+        stack.append(cause.__context__)
+    return False
+
+
+class ModelInfo:
     """
-    Initialize the list of available models inside the available_models global
-    variable.
+    What the server reports about one local model. ``size`` is in bytes, and
+    ``parameter_size`` is as Ollama spells it ("8.0B").
     """
-    global available_models
-    available_models = list_locals()
+
+    __slots__ = ("digest", "name", "parameter_size", "quantization", "size")
+
+    def __init__(
+        self,
+        name: str,
+        digest: str = "",
+        size: int = 0,
+        parameter_size: str = "",
+        quantization: str = "",
+    ):
+        self.name = name
+        self.digest = digest
+        self.size = size
+        self.parameter_size = parameter_size
+        self.quantization = quantization
+
+    @classmethod
+    def from_tags(cls, entry: dict) -> ModelInfo:
+        """
+        Read one entry of the ``/api/tags`` model list.
+        """
+        details = entry.get("details") or {}
+        return cls(
+            entry["name"],
+            entry.get("digest") or "",
+            entry.get("size") or 0,
+            details.get("parameter_size") or "",
+            details.get("quantization_level") or "",
+        )
 
 
-# TODO: see issue #10
-def list_locals() -> list[str] | None:
+class Provider:
     """
-    return a list of available local AI models
+    How to talk to one kind of inference server at ``host``. Requests go
+    through http_request and the shared session, so every provider gets the
+    same connection pool and timeouts.
     """
-    url = "http://localhost:11434/api/tags"
-    r = http_request("GET", url, timeout=0.3)
-    if r.is_error():
+
+    name = ""
+    default_host = ""
+    # the port of a host given without one
+    default_port: int | None = None
+
+    def __init__(self, host: str | None = None, api_key: str | None = None):
+        self.host = (host or self.default_host).rstrip("/")
+        self.api_key = api_key
+
+    def url(self, path: str) -> str:
+        return self.host + path
+
+    @property
+    def host_count(self) -> int:
+        """
+        How many servers this provider spreads requests over.
+        """
+        return 1
+
+    def auth(self) -> dict:
+        """
+        Extra request arguments that authenticate us, if the server wants a
+        key.
+        """
+        if not self.api_key:
+            return {}
+        return {"headers": {"Authorization": f"Bearer {self.api_key}"}}
+
+    def is_available(self) -> bool:
+        """
+        Whether the server is up and answering.
+        """
+        raise NotImplementedError
+
+    def list_models(self) -> list[ModelInfo] | None:
+        """
+        Returns:
+            the models the server has, or None if it couldn't be asked
+        """
+        raise NotImplementedError
+
+    def load(self, model: str) -> HttpResponse:
+        """
+        Get a model into memory, ready for generation.
+        """
+        raise NotImplementedError
+
+    def unload(self, model: str) -> HttpResponse:
+        """
+        Give the memory a model takes back.
+        """
+        raise NotImplementedError
+
+    def generate(
+        self,
+        model: str,
+        system: str,
+        prompt: str,
+        options: dict | None = None,
+        on_token: Callable[[str], object] | None = None,
+    ) -> tuple[int, str]:
+        """
+        Run one generation, streamed to on_token if it's given, and record
+        its token counts in last_stats. Options use Ollama's names (seed,
+        temperature, num_predict, ...).
+
+        Returns:
+            the same as generate
+        """
+        raise NotImplementedError
+
+    def metrics(self) -> dict[str, float] | None:
+        """
+        Numbers the server reports about its load, or None if it can't be
+        asked.
+        """
+        raise NotImplementedError
+
+    def context_length(self, model: str) -> int | None:
+        """
+        The most tokens the model can take in one context window, or None if
+        the server doesn't say (or sets the window itself).
+        """
         return None
-    r = r.response["models"]
-    return [model["name"] for model in r]
+
+
+class OllamaProvider(Provider):
+    """
+    An Ollama server, through its native API.
+    """
+
+    name = "ollama"
+    default_host = "http://localhost:11434"
+    default_port = 11434
+
+    def is_available(self) -> bool:
+        # Very rare for a server to run on this port AND have this endpoint.
+        r = http_request("GET", self.url("/api/version"), **self.auth())
+        return (
+            (r.return_code == 200)
+            and (isinstance(r.response, dict))
+            and ("version" in r.response)
+        )
+
+    def list_models(self) -> list[ModelInfo] | None:
+        r = http_request("GET", self.url("/api/tags"), **self.auth())
+        if r.is_error() or not isinstance(r.response, dict):
+            return None
+        try:
+            return [
+                ModelInfo.from_tags(entry)
+                for entry in r.response.get("models", [])
+            ]
+        except (KeyError, TypeError, AttributeError):
+            return None
+
+    def load(self, model: str) -> HttpResponse:
+        # with the window generations use, so the first one doesn't reload
+        payload = {
+            "model": model,
+            "keep_alive": keep_alive,
+            "options": {"num_ctx": window_size(model)},
+        }
+        url = self.url("/api/generate")
+        return http_request("POST", url, json=payload, **self.auth())
+
+    def unload(self, model: str) -> HttpResponse:
+        payload = {"model": model, "keep_alive": 0}
+        url = self.url("/api/generate")
+        return http_request("POST", url, json=payload, **self.auth())
+
+    def generate(
+        self,
+        model: str,
+        system: str,
+        prompt: str,
+        options: dict | None = None,
+        on_token: Callable[[str], object] | None = None,
+    ) -> tuple[int, str]:
+        # As long as the model stays loaded (see keep_alive), Ollama keeps
+        # the system prompt evaluated in its cache and only has to process
+        # the diff.
+        url = self.url("/api/generate")
+        payload: dict = {
+            "model": model,
+            "system": system,
+            "prompt": prompt,
+            "keep_alive": keep_alive,
+        }
+        if options:
+            payload["options"] = options
+        if on_token is not None:
+            payload["stream"] = True
+            return stream_generate(url, payload, on_token, json.loads, self)
+        payload["stream"] = False
+        r = http_request("POST", url, json=payload, **self.auth())
+        if r.is_error():
+            return 1, r.err_message()
+        elif r.return_code == 200:
+            record_stats(r.response)
+            return 0, r.response.get("response")
+        else:
+            error_msg = get_error_message(r.return_code)
+            return r.return_code, error_msg
+
+    def metrics(self) -> dict[str, float] | None:
+        r = http_request("GET", self.url("/api/ps"), **self.auth())
+        if r.is_error() or not isinstance(r.response, dict):
+            return None
+        models = r.response.get("models") or []
+        return {
+            "loaded_models": len(models),
+            "ram_bytes": sum(m.get("size") or 0 for m in models),
+            "vram_bytes": sum(m.get("size_vram") or 0 for m in models),
+        }
+
+    def context_length(self, model: str) -> int | None:
+        url = self.url("/api/show")
+        r = http_request("POST", url, json={"model": model}, **self.auth())
+        if r.return_code != 200 or not isinstance(r.response, dict):
+            return None
+        # keyed by architecture, e.g. "llama.context_length"
+        info = r.response.get("model_info") or {}
+        for key, value in info.items():
+            if key.endswith(".context_length") and isinstance(value, int):
+                return value
+        return None
+
+
+# Ollama option names, and what the OpenAI API calls them. Others (num_ctx,
+# say) are set when such a server starts, not per request.
+openai_options = {
+    "seed": "seed",
+    "temperature": "temperature",
+    "top_p": "top_p",
+    "num_predict": "max_tokens",
+    "stop": "stop",
+}
+
+
+class OpenAIProvider(Provider):
+    """
+    A server with an OpenAI-compatible API: llama.cpp's llama-server, vLLM,
+    and the like. They load their models when they start, so there's
+    nothing to load or unload.
+    """
+
+    name = "openai"
+    default_host = "http://localhost:8080"
+
+    def is_available(self) -> bool:
+        r = http_request("GET", self.url("/v1/models"), **self.auth())
+        return (
+            r.return_code == 200
+            and isinstance(r.response, dict)
+            and isinstance(r.response.get("data"), list)
+        )
+
+    def list_models(self) -> list[ModelInfo] | None:
+        r = http_request("GET", self.url("/v1/models"), **self.auth())
+        if r.is_error() or not isinstance(r.response, dict):
+            return None
+        try:
+            return [ModelInfo(entry["id"]) for entry in r.response["data"]]
+        except (KeyError, TypeError):
+            return None
+
+    def load(self, model: str) -> HttpResponse:
+        return HttpResponse({"done_reason": "load"}, 200)
+
+    def unload(self, model: str) -> HttpResponse:
+        return HttpResponse({}, 200)
+
+    def generate(
+        self,
+        model: str,
+        system: str,
+        prompt: str,
+        options: dict | None = None,
+        on_token: Callable[[str], object] | None = None,
+    ) -> tuple[int, str]:
+        url = self.url("/v1/chat/completions")
+        payload: dict = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system},
+                {"role": "user", "content": prompt},
+            ],
+        }
+        for key, value in (options or {}).items():
+            if key in openai_options:
+                payload[openai_options[key]] = value
+        if on_token is not None:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+            return stream_generate(
+                url, payload, on_token, self.read_event, self
+            )
+        payload["stream"] = False
+        r = http_request("POST", url, json=payload, **self.auth())
+        if r.is_error():
+            return 1, r.err_message()
+        if r.return_code != 200:
+            return r.return_code, get_error_message(r.return_code)
+        try:
+            content = r.response["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            return 1, "the server sent a malformed response"
+        record_stats(self.usage_stats(r.response))
+        return 0, content or ""
+
+    @staticmethod
+    def usage_stats(response: dict) -> dict:
+        """
+        The token counts of an OpenAI response, under Ollama's names.
+        """
+        usage = response.get("usage") or {}
+        return {
+            "prompt_eval_count": usage.get("prompt_tokens"),
+            "eval_count": usage.get("completion_tokens"),
+        }
+
+    def read_event(self, line: bytes) -> dict | None:
+        """
+        Turn one line of a server-sent event stream into an Ollama-style
+        chunk, or None for lines that carry nothing.
+        """
+        if not line.startswith(b"data:"):
+            return None
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            return {"done": True}
+        event = json.loads(data)
+        if "error" in event:
+            error = event["error"]
+            return {"error": error.get("message", str(error))}
+        chunk: dict = {}
+        for choice in event.get("choices") or []:
+            delta = choice.get("delta") or {}
+            chunk["response"] = delta.get("content") or ""
+        if event.get("usage"):
+            chunk.update(self.usage_stats(event))
+        return chunk
+
+    def metrics(self) -> dict[str, float] | None:
+        r = http_request("GET", self.url("/metrics"), **self.auth())
+        if r.is_error() or r.return_code != 200:
+            return None
+        return parse_prometheus(str(r.response))
+
+
+def parse_prometheus(text: str) -> dict[str, float]:
+    """
+    Read Prometheus' text format (what llama.cpp and vLLM serve on
+    /metrics): each metric's value, summed over its labels.
+    """
+    values: dict[str, float] = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        if "}" in line:
+            # label values may hold spaces; the value follows the brace
+            name, rest = line.split("{", 1)[0], line.rsplit("}", 1)[1]
+        else:
+            name, _, rest = line.partition(" ")
+        try:
+            value = float(rest.split()[0])
+        except (IndexError, ValueError):
+            continue
+        values[name] = values.get(name, 0.0) + value
+    return values
+
+
+# failures that say a host is down rather than the request being wrong
+unreachable = {error_messages[code] for code in (-1, -4, -6, -7)}
+
+
+class HostPool(Provider):
+    """
+    Several servers of one kind, used as one. Each request goes to the
+    healthy host with the fewest requests in flight, the fastest one on a
+    tie. A host that can't be reached or fails with a server error is left
+    out for ``retry_after`` seconds, and the request moves on to the next
+    one. After that, a health check lets it back in.
+    """
+
+    retry_after = 30.0
+
+    def __init__(self, members: list[Provider]):
+        super().__init__(members[0].host, members[0].api_key)
+        self.name = members[0].name
+        self.members = members
+        self._lock = threading.Lock()
+        self._outstanding = [0] * len(members)
+        # moving average of each host's request time, in seconds
+        self._latency = [0.0] * len(members)
+        self._down_until = [0.0] * len(members)
+        # the models each host had when last asked, None until then
+        self._models: list[set[str] | None] = [None] * len(members)
+
+    @property
+    def host_count(self) -> int:
+        return len(self.members)
+
+    def outstanding(self) -> list[int]:
+        """
+        Requests in flight on each host.
+        """
+        with self._lock:
+            return list(self._outstanding)
+
+    def mark(self, i: int, up: bool) -> None:
+        """
+        Record whether a host just worked.
+        """
+        until = 0.0 if up else time.monotonic() + self.retry_after
+        with self._lock:
+            self._down_until[i] = until
+
+    def acquire(self, model: str | None, tried: set[int]) -> int | None:
+        """
+        Pick the host for the next request and count it as in flight.
+
+        Returns:
+            the host's index, or None if no host is left to try
+        """
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                usable = [
+                    i
+                    for i in range(len(self.members))
+                    if i not in tried
+                    and self._down_until[i] <= now
+                    and self.has_model(i, model)
+                ]
+                if not usable:
+                    return None
+                i = min(
+                    usable,
+                    key=lambda i: (self._outstanding[i], self._latency[i]),
+                )
+                self._outstanding[i] += 1
+                check = self._down_until[i] > 0
+            if not check or self.members[i].is_available():
+                return i
+            self.release(i)
+            self.mark(i, False)
+            tried.add(i)
+
+    def has_model(self, i: int, model: str | None) -> bool:
+        """
+        Whether host i may have the model: it had it when last asked, or it
+        hasn't been asked yet.
+        """
+        models = self._models[i]
+        return model is None or models is None or model in models
+
+    def release(self, i: int, seconds: float | None = None) -> None:
+        """
+        Count a request as done, and how long it took if it worked.
+        """
+        with self._lock:
+            self._outstanding[i] -= 1
+            if seconds is not None:
+                old = self._latency[i] or seconds
+                self._latency[i] = 0.7 * old + 0.3 * seconds
+
+    def each(self, func: Callable[[Provider], object]) -> list:
+        """
+        Call func on every host at once.
+
+        Returns:
+            the results, in host order
+        """
+        with ThreadPoolExecutor(max_workers=len(self.members)) as pool:
+            return list(pool.map(func, self.members))
+
+    def is_available(self) -> bool:
+        results = self.each(lambda member: member.is_available())
+        for i, up in enumerate(results):
+            self.mark(i, up)
+        return any(results)
+
+    def list_models(self) -> list[ModelInfo] | None:
+        results = self.each(lambda member: member.list_models())
+        merged: dict[str, ModelInfo] = {}
+        for i, listed in enumerate(results):
+            if listed is None:
+                self.mark(i, False)
+                continue
+            self._models[i] = {info.name for info in listed}
+            for info in listed:
+                merged.setdefault(info.name, info)
+        if all(listed is None for listed in results):
+            return None
+        return list(merged.values())
+
+    def load(self, model: str) -> HttpResponse:
+        # every host that has the model loads it, so any of them can answer
+        results = self.each(lambda member: member.load(model))
+        for r in results:
+            if not r.is_error() and r.return_code == 200:
+                return r
+        return results[0]
+
+    def unload(self, model: str) -> HttpResponse:
+        results = self.each(lambda member: member.unload(model))
+        for r in results:
+            if not r.is_error() and r.return_code == 200:
+                return r
+        return results[0]
+
+    def context_length(self, model: str) -> int | None:
+        # the request may go to any of them
+        lengths = self.each(lambda member: member.context_length(model))
+        known = [length for length in lengths if length is not None]
+        return min(known) if known else None
+
+    def generate(
+        self,
+        model: str,
+        system: str,
+        prompt: str,
+        options: dict | None = None,
+        on_token: Callable[[str], object] | None = None,
+    ) -> tuple[int, str]:
+        result = (1, error_messages[-1])
+        tried: set[int] = set()
+        streamed: list[str] = []
+
+        def forward(token: str) -> None:
+            streamed.append(token)
+            if on_token is not None:
+                on_token(token)
+
+        while (i := self.acquire(model, tried)) is not None:
+            tried.add(i)
+            start = time.monotonic()
+            try:
+                result = self.members[i].generate(
+                    model,
+                    system,
+                    prompt,
+                    options,
+                    None if on_token is None else forward,
+                )
+            except BaseException:
+                self.release(i)
+                raise
+            stat, res = result
+            if stat == 0:
+                self.release(i, time.monotonic() - start)
+                self.mark(i, True)
+                return result
+            self.release(i)
+            if stat >= 500 or res in unreachable:
+                self.mark(i, False)
+            if streamed:
+                # part of this answer is already on screen
+                return result
+            attempt: Attempt | None = getattr(thread_state, "attempt", None)
+            if res == "cancelled" or (
+                attempt is not None and attempt.cancelled
+            ):
+                # nobody wants the answer, so no other host should start on it
+                return result
+        return result
+
+    def metrics(self) -> dict[str, float] | None:
+        results = self.each(lambda member: member.metrics())
+        if all(values is None for values in results):
+            return None
+        total: dict[str, float] = {"hosts_up": 0}
+        for values in results:
+            if values is None:
+                continue
+            total["hosts_up"] += 1
+            for key, value in values.items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+
+providers: dict[str, type[Provider]] = {
+    OllamaProvider.name: OllamaProvider,
+    OpenAIProvider.name: OpenAIProvider,
+}
+
+
+def make_provider(settings: dict) -> Provider:
+    """
+    Set up the provider the settings ask for: "provider" (ollama or openai),
+    "host" (its base URL) or "hosts" (a list of them, used as a HostPool),
+    and "api_key". Without a host, Ollama honors OLLAMA_HOST, read the way
+    its own client does (see host_url).
+    """
+    name = settings.get("provider") or OllamaProvider.name
+    cls = providers.get(name)
+    if cls is None:
+        output.print_warning(f"Unknown provider {name!r}, using ollama.")
+        cls = OllamaProvider
+    hosts = settings.get("hosts")
+    if not isinstance(hosts, list) or not hosts:
+        hosts = [settings.get("host")]
+    if hosts == [None] and cls is OllamaProvider:
+        hosts = [os.environ.get("OLLAMA_HOST")]
+    members = [
+        cls(host_url(host, cls.default_port), settings.get("api_key"))
+        for host in hosts
+    ]
+    return members[0] if len(members) == 1 else HostPool(members)
+
+
+def host_url(host: str | None, default_port: int | None = None) -> str | None:
+    """
+    The base URL for a host given as "name", "name:port" or a full URL. A
+    host without a scheme gets default_port if it has no port, and
+    127.0.0.1 if it has no name, like Ollama's client does with OLLAMA_HOST
+    (so "0.0.0.0" and ":11434" both work). A full URL is used as it is.
+    """
+    host = (host or "").strip()
+    if not host:
+        return None
+    if "://" in host:
+        return host
+    hostport, slash, path = host.partition("/")
+    # an IPv6 address without a port still has colons: "[::1]"
+    if hostport.endswith("]") or ":" not in hostport:
+        name, port = hostport, ""
+    else:
+        name, _, port = hostport.rpartition(":")
+    name = name or "127.0.0.1"
+    if not port and default_port is not None:
+        port = str(default_port)
+    netloc = f"{name}:{port}" if port else name
+    return f"http://{netloc}{slash}{path}"
+
+
+def get_provider() -> Provider:
+    """
+    The provider every request goes to, set up from the config the first
+    time it's needed.
+    """
+    global provider
+    if provider is None:
+        provider = make_provider(config.load())
+    return provider
+
+
+class ModelCatalog:
+    """
+    The server's models, fetched from the provider and trusted for ``ttl``
+    seconds. After that the old list is still served while a background
+    refresh fetches a new one, so only a lookup with nothing to serve yet
+    waits on the server.
+    """
+
+    def __init__(self, ttl: float = 60.0):
+        self.ttl = ttl
+        self._models: dict[str, ModelInfo] | None = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refresher: threading.Thread | None = None
+
+    def models(self) -> dict[str, ModelInfo] | None:
+        """
+        Returns:
+            the local models by name, or None if they couldn't be listed
+        """
+        with self._lock:
+            models = self._models
+            stale = time.monotonic() - self._fetched_at >= self.ttl
+        if models is None:
+            # a refresh may already be on its way; share it
+            self.refresh_async().join()
+            with self._lock:
+                return self._models
+        if stale:
+            self.refresh_async()
+        return models
+
+    def names(self) -> list[str] | None:
+        """
+        Returns:
+            the names of the local models, or None if they couldn't be listed
+        """
+        models = self.models()
+        return None if models is None else list(models)
+
+    def get(self, name: str) -> ModelInfo | None:
+        """
+        Returns:
+            what's known about the model, or None if the server doesn't have it
+        """
+        models = self.models()
+        return None if models is None else models.get(name)
+
+    def refresh(self) -> bool:
+        """
+        Fetch the model list now. On failure the old list, if any, is kept.
+
+        Returns:
+            whether the list was fetched
+        """
+        listed = get_provider().list_models()
+        if listed is None:
+            return False
+        with self._lock:
+            self._models = {info.name: info for info in listed}
+            self._fetched_at = time.monotonic()
+        return True
+
+    def refresh_async(self) -> threading.Thread:
+        """
+        Start refreshing in a background thread, unless a refresh is already
+        running.
+
+        Returns:
+            the thread doing the refresh
+        """
+        with self._lock:
+            if self._refresher is None or not self._refresher.is_alive():
+                self._refresher = threading.Thread(
+                    target=self.refresh, name="model-catalog", daemon=True
+                )
+                self._refresher.start()
+            return self._refresher
+
+
+# the models the server has, shared by everything that needs to know
+catalog = ModelCatalog()
 
 
 def select_model(select_str: str) -> None:
@@ -109,10 +1246,48 @@ def select_model(select_str: str) -> None:
     global selected_model
     selected_model = select_str
     load_res = load_model(selected_model)
+    if load_res:
+        # the next session starts loading it right away
+        config.save("default_model", selected_model)
     if load_res.get("done_reason") == "load":
         output.print_success(f"{selected_model} loaded.")
 
 
+def default_model() -> str | None:
+    """
+    The model picked with `start` in an earlier session, if any.
+    """
+    name = config.get("default_model")
+    return name if isinstance(name, str) and name else None
+
+
+def preload_model(model_name: str) -> bool:
+    """
+    Load a model into RAM without printing anything, so it can run in the
+    background while the user gets going.
+
+    Returns:
+        whether the model was loaded
+    """
+    out = get_provider().load(model_name)
+    ok = not out.is_error() and out.return_code == 200
+    if ok:
+        mark_used(model_name)
+    return ok
+
+
+def wait_for_preload() -> None:
+    """
+    Block until the background load of the default model is over, if one is
+    running. A generation sent earlier would only queue behind it.
+    """
+    global preload
+    future = preload
+    if future is not None:
+        future.result()
+        preload = None
+
+
 def load_model(model_name: str) -> dict:
     """
     Load the local model into RAM
@@ -120,32 +1295,136 @@ def load_model(model_name: str) -> dict:
         model_name: name of the model to load
 
     Returns:
-        a dict of the POST request
+        a dict of the POST request, empty if the model didn't load
     """
     print("Loading local model...")
-    payload = {"model": selected_model}
-    url = "http://localhost:11434/api/generate"
-    out = http_request("POST", url, json=payload)
+    out = get_provider().load(str(selected_model))
     if out.is_error():
         output.print_error(f"Failed to load {model_name}. Is ollama running?")
         return {}
+    if out.return_code != 200:
+        # a misspelled or broken model, say
+        output.print_error(get_error_message(out.return_code))
+        return {}
+    mark_used(model_name)
     return out.response
 
 
+def mark_used(model_name: str) -> None:
+    """
+    Record that the model is loaded and was just used, which restarts its
+    idle time.
+    """
+    global loaded_model, last_used
+    with _lifecycle_lock:
+        loaded_model = model_name
+        last_used = time.monotonic()
+
+
+def memory_pressure(meminfo: str = "/proc/meminfo") -> bool:
+    """
+    Whether the machine is running low on RAM: less than min_available_memory
+    of it is available, according to the kernel. Always False where there's
+    no /proc/meminfo to ask.
+    """
+    fields = {}
+    try:
+        with Path(meminfo).open(encoding="ascii") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                fields[name] = value.strip().split(" ")[0]
+        total = int(fields["MemTotal"])
+        available = int(fields["MemAvailable"])
+    except (OSError, KeyError, ValueError):
+        return False
+    return total > 0 and available < total * min_available_memory
+
+
+def release_model() -> bool:
+    """
+    Quietly unload the model this session loaded, if it still has one.
+
+    Returns:
+        whether a model was unloaded
+    """
+    global loaded_model
+    with _lifecycle_lock:
+        model = loaded_model
+        loaded_model = None
+    if model is None:
+        return False
+    out = get_provider().unload(model)
+    return not out.is_error() and out.return_code == 200
+
+
+def check_idle() -> bool:
+    """
+    Unload the model if it has sat idle for idle_unload_seconds, or right
+    away if memory is tight. A model in the middle of a generation stays.
+
+    Returns:
+        whether the model was unloaded
+    """
+    with _lifecycle_lock:
+        if loaded_model is None or in_flight:
+            return False
+        idle = time.monotonic() - last_used
+    if 0 < idle_unload_seconds <= idle or memory_pressure():
+        return release_model()
+    return False
+
+
+def start_lifecycle() -> None:
+    """
+    Start watching the loaded model in a background thread, see check_idle.
+    """
+    global _watcher, idle_unload_seconds
+    minutes = config.get("idle_unload_minutes")
+    if isinstance(minutes, (int, float)) and minutes >= 0:
+        idle_unload_seconds = minutes * 60
+    if _watcher is not None:
+        return
+    _stop_watching.clear()
+
+    def watch() -> None:
+        while not _stop_watching.wait(watch_interval):
+            check_idle()
+
+    _watcher = threading.Thread(target=watch, name="model-lifecycle")
+    _watcher.daemon = True
+    _watcher.start()
+
+
+def stop_lifecycle() -> None:
+    """
+    Stop the watcher and unload the model, at the end of the session. A
+    background load still running is waited for, so it gets unloaded too.
+    """
+    global _watcher
+    _stop_watching.set()
+    if _watcher is not None:
+        _watcher.join()
+        _watcher = None
+    if preload is not None:
+        preload.result()
+    release_model()
+
+
 def unload_model() -> None:
     """
     Unload the local model from RAM
     """
-    global selected_model
+    global selected_model, loaded_model
     if selected_model is None:
         print("No model to unload.")
         return
-    url = "http://localhost:11434/api/generate"
-    payload = {"model": selected_model, "keep_alive": 0}
-    response = http_request("POST", url, json=payload)
+    response = get_provider().unload(selected_model)
     if response.is_error():
         output.print_error(f"Failed to unload model: {response.err_message()}")
     else:
+        with _lifecycle_lock:
+            if loaded_model == selected_model:
+                loaded_model = None
         selected_model = None
         output.print_success("Model unloaded successfully.")
 
@@ -229,27 +1508,391 @@ def get_error_message(status_code: int) -> str:
         )
 
 
+def model_digest(model: str) -> str | None:
+    """
+    The digest of a local model, which changes whenever it's pulled again.
+
+    Returns:
+        the digest, or None if the server doesn't know the model
+    """
+    info = catalog.get(model)
+    return info.digest if info is not None and info.digest else None
+
+
 # TODO: see issues #11 and #15
-def generate(prompt: str) -> tuple[int, str]:
+def generate(
+    prompt: str,
+    on_token: Callable[[str], object] | None = None,
+    options: dict | None = None,
+    cache: bool = True,
+    system: str | None = None,
+    hedged: bool = True,
+) -> tuple[int, str]:
     """
     generates a response by prompting the selected_model.
     Args:
         prompt: the prompt to send to the LLM.
+        on_token: if given, the response is streamed and this is called with
+            each piece of text as soon as the model produces it.
+        options: Ollama model options (seed, temperature, ...) for this call.
+        cache: answer from the response cache if the same request was made
+            before. Requests with a seed ask for a fresh sample, so they're
+            never cached.
+        system: the instructions to send ahead of the prompt, if not
+            generation_prompt.
+        hedged: race a second request if this one is slow to start, see
+            hedged_generate.
     Returns:
         a tuple of the return code and the response. The return code is 0 if the
         response is ok, 1 otherwise. The response is the error message if the
         request fails and the return code is 1.
     """
-    url = "http://localhost:11434/api/generate"
-    payload = {"model": selected_model, "prompt": prompt, "stream": False}
-    r = http_request("POST", url, json=payload)
-    if r.is_error():
-        return 1, r.err_message()
-    elif r.return_code == 200:
-        return 0, r.response.get("response")
+    global last_stats, in_flight
+    key = None
+    if cache and response_cache.enabled and "seed" not in (options or {}):
+        digest = model_digest(str(selected_model))
+        if digest is not None:
+            key = response_cache.cache_key(
+                str(selected_model),
+                digest,
+                (system or generation_prompt) + prompt,
+                options,
+            )
+            cached = response_cache.get(key)
+            if cached is not None:
+                last_stats = {}
+                last_sizing.clear()
+                if on_token is not None:
+                    on_token(cached)
+                return 0, cached
+    wait_for_preload()
+    with _lifecycle_lock:
+        in_flight += 1
+    model = str(selected_model)
+    try:
+        hedge = hedge_model() if hedged else None
+        if hedge is None:
+            stat, res = request_generate(prompt, on_token, options, system)
+        else:
+            stat, res, model = hedged_generate(
+                prompt, on_token, options, system, hedge
+            )
+    finally:
+        with _lifecycle_lock:
+            in_flight -= 1
+    if stat == 0:
+        mark_used(str(selected_model))
+    # a fallback model's answer isn't the selected model's to cache
+    if stat == 0 and key is not None and model == selected_model:
+        response_cache.put(key, res)
+    return stat, res
+
+
+def hedge_model() -> str | None:
+    """
+    The model a hedged request would go to: the configured fallback model,
+    or with several hosts the same model on another one.
+
+    Returns:
+        the model, or None if there's nowhere useful to send a hedge
+    """
+    fallback = config.get("fallback_model")
+    if isinstance(fallback, str) and fallback and fallback != selected_model:
+        return fallback
+    if get_provider().host_count > 1:
+        return str(selected_model)
+    return None
+
+
+def hedge_deadline() -> float:
+    """
+    How long to wait for the first token before hedging, in seconds.
+    """
+    configured = config.get("hedge_after")
+    if isinstance(configured, (int, float)) and configured > 0:
+        return float(configured)
+    samples = sorted(first_token_times)
+    if len(samples) < hedge_min_samples:
+        return hedge_default
+    index = math.ceil(hedge_percentile * len(samples)) - 1
+    return max(samples[index], hedge_floor)
+
+
+def hedged_generate(
+    prompt: str,
+    on_token: Callable[[str], object] | None,
+    options: dict | None,
+    system: str | None,
+    hedge_with: str,
+) -> tuple[int, str, str]:
+    """
+    Generate with a deadline on the first token: if the selected model
+    hasn't started answering by hedge_deadline(), the same request also goes
+    to hedge_with. The first request to produce a token wins, and the other
+    one is cancelled. Both always stream, so the first token is seen.
+
+    Returns:
+        the return code, the response, and the model that answered
+    """
+    global last_stats, last_sizing
+    events: queue.Queue = queue.Queue()
+
+    def run(attempt: Attempt) -> None:
+        thread_state.attempt = attempt
+        result = request_generate(
+            prompt,
+            lambda token: events.put((attempt, token, None)),
+            options,
+            system,
+            attempt.model,
+        )
+        events.put((attempt, None, result))
+
+    def launch(model: str) -> Attempt:
+        attempt = Attempt(model)
+        threading.Thread(target=run, args=(attempt,), daemon=True).start()
+        return attempt
+
+    attempts = [launch(str(selected_model))]
+    deadline = attempts[0].started + hedge_deadline()
+    winner: Attempt | None = None
+    finished = 0
+    while True:
+        timeout = None
+        if winner is None and len(attempts) == 1:
+            timeout = max(deadline - time.monotonic(), 0)
+        try:
+            attempt, token, result = events.get(timeout=timeout)
+        except queue.Empty:
+            attempts.append(launch(hedge_with))
+            continue
+        if attempt.cancelled:
+            continue
+        if token is None:
+            finished += 1
+            if winner is None and result[0] != 0 and finished < len(attempts):
+                # the other request may still answer
+                continue
+        if winner is None:
+            winner = attempt
+            if token is not None:
+                first_token_times.append(time.monotonic() - attempt.started)
+            for other in attempts:
+                if other is not attempt:
+                    other.cancel()
+        if attempt is not winner:
+            continue
+        if token is None:
+            last_stats, last_sizing = attempt.stats, attempt.sizing
+            return *result, attempt.model
+        if on_token is not None:
+            on_token(token)
+
+
+def request_generate(
+    prompt: str,
+    on_token: Callable[[str], object] | None = None,
+    options: dict | None = None,
+    system: str | None = None,
+    model: str | None = None,
+) -> tuple[int, str]:
+    """
+    Send a generation request to the provider, see generate. The fixed
+    instructions go in the system prompt, ahead of the prompt. It goes to
+    selected_model unless another model is given.
+    """
+    global last_stats, last_sizing
+    model = model or str(selected_model)
+    system = system or generation_prompt
+    options, sizing = size_options(model, system, prompt, options)
+    attempt: Attempt | None = getattr(thread_state, "attempt", None)
+    if attempt is None:
+        last_stats, last_sizing = {}, sizing
+    else:
+        attempt.stats, attempt.sizing = {}, sizing
+    return get_provider().generate(model, system, prompt, options, on_token)
+
+
+def context_limit(model: str) -> int | None:
+    """
+    The model's context length, asked of the server once per model.
+    """
+    if model not in context_limits:
+        context_limits[model] = get_provider().context_length(model)
+    return context_limits[model]
+
+
+def window_size(model: str, needed: int = 0) -> int:
+    """
+    The context window to run the model with, grown to hold needed tokens
+    if it doesn't yet, see context_window.
+    """
+    global context_window
+    default = (
+        math.ceil(
+            (packing.token_budget + packing.estimate_tokens(generation_prompt))
+            * context_margin
+        )
+        + max_new_tokens
+    )
+    fits = [size for size in context_buckets if size >= max(needed, default)]
+    with _window_lock:
+        context_window = max(
+            context_window or 0, fits[0] if fits else context_buckets[-1]
+        )
+        window = context_window
+    limit = context_limit(model)
+    return min(window, limit) if limit else window
+
+
+def size_options(
+    model: str, system: str, prompt: str, options: dict | None
+) -> tuple[dict, dict[str, int]]:
+    """
+    Fill in num_predict (max_new_tokens) and num_ctx (see context_window)
+    for a generation, unless the caller set them. Without them, Ollama uses
+    its default window whatever the prompt: a large diff is cut off.
+
+    Returns:
+        the options to send, and the prompt estimate with the sizes picked
+    """
+    sized = dict(options or {})
+    estimate = packing.estimate_tokens(system) + packing.estimate_tokens(prompt)
+    sized.setdefault("num_predict", max_new_tokens)
+    if "num_ctx" not in sized:
+        needed = math.ceil(estimate * context_margin) + sized["num_predict"]
+        sized["num_ctx"] = window_size(model, needed)
+    sizing = {
+        "prompt_estimate": estimate,
+        "num_ctx": sized["num_ctx"],
+        "num_predict": sized["num_predict"],
+    }
+    return sized, sizing
+
+
+def record_stats(response: dict) -> None:
+    """
+    Keep the token counts and timings reported at the end of a generation in
+    last_stats (or the thread's Attempt), under Ollama's names.
+    """
+    global last_stats
+    stats = {
+        key: response[key]
+        for key in stat_keys
+        if isinstance(response.get(key), int)
+    }
+    attempt: Attempt | None = getattr(thread_state, "attempt", None)
+    if attempt is None:
+        last_stats = stats
     else:
-        error_msg = get_error_message(r.return_code)
-        return r.return_code, error_msg
+        attempt.stats = stats
+
+
+def stream_generate(
+    url: str,
+    payload: dict,
+    on_token: Callable[[str], object],
+    read_line: Callable[[bytes], dict | None] = json.loads,
+    server: Provider | None = None,
+) -> tuple[int, str]:
+    """
+    Read a streamed generation: the server sends one line at a time, each
+    holding the next piece of the response, until one says it's done.
+
+    Args:
+        read_line: turns a line into an Ollama-style chunk ("response",
+            "done", "error" and the stats), or None to skip it. Raises
+            ValueError if the line makes no sense.
+        server: the provider, for its credentials
+
+    Returns:
+        the same as generate, with the whole response text on success
+    """
+    parts: list[str] = []
+    extra = server.auth() if server is not None else {}
+    attempt: Attempt | None = getattr(thread_state, "attempt", None)
+    try:
+        with send("POST", url, json=payload, stream=True, **extra) as r:
+            if attempt is not None:
+                attempt.response = r
+                if attempt.cancelled:
+                    return 1, "cancelled"
+            if r.status_code != 200:
+                return r.status_code, get_error_message(r.status_code)
+            for line in r.iter_lines():
+                if attempt is not None and attempt.cancelled:
+                    return 1, "cancelled"
+                if not line:
+                    continue
+                chunk = read_line(line)
+                if chunk is None:
+                    continue
+                if "error" in chunk:
+                    return 1, chunk["error"]
+                token = chunk.get("response", "")
+                if token:
+                    parts.append(token)
+                    on_token(token)
+                if any(key in chunk for key in stat_keys):
+                    record_stats(chunk)
+                if chunk.get("done"):
+                    break
+    except requests.RequestException as e:
+        if attempt is not None and attempt.cancelled:
+            return 1, "cancelled"
+        return 1, HttpResponse(None, request_error_code(e)).err_message()
+    except (ValueError, TypeError, AttributeError):
+        if attempt is not None and attempt.cancelled:
+            return 1, "cancelled"
+        return 1, "the server sent a malformed response"
+    return 0, "".join(parts)
+
+
+def parallel_requests() -> int:
+    """
+    How many generations to send at once: OLLAMA_NUM_PARALLEL (the server
+    reads the same variable, default 4) for each host of the provider.
+    Sending more than that only queues them on the servers.
+    """
+    try:
+        value = max(int(os.environ.get("OLLAMA_NUM_PARALLEL", "")), 1)
+    except ValueError:
+        value = 4
+    return value * get_provider().host_count
+
+
+def generate_candidates(
+    prompt: str,
+    count: int,
+    on_done: Callable[[int, int, str], object] | None = None,
+) -> list[tuple[int, str]]:
+    """
+    Generate several messages for the same prompt at once. Each request gets
+    its own seed, so they don't all sample the same message.
+
+    Args:
+        prompt: the prompt to send to the LLM.
+        count: how many messages to generate.
+        on_done: called with (index, return code, response) as each request
+            finishes, in the order they finish.
+
+    Returns:
+        the (return code, response) of each request, in request order
+    """
+    seed = secrets.randbits(31)
+    results: list[tuple[int, str]] = [(1, "")] * count
+    workers = min(count, parallel_requests())
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(generate, prompt, None, {"seed": seed + i}): i
+            for i in range(count)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if on_done is not None:
+                on_done(i, *results[i])
+    return results
 
 
 def regenerate(prompt: str) -> None:
@@ -1,8 +1,15 @@
 from __future__ import annotations
 
 import textwrap
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
 
 from rich.console import Console
+from rich.live import Live
+from rich.text import Text
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator
 
 console = Console()
 
@@ -29,6 +36,13 @@ def print_warning(message: str) -> None:
     console.print(f"[yellow]Warning: {message}[/yellow]")
 
 
+def print_info(message: str) -> None:
+    """
+    prints secondary information dimmed
+    """
+    console.print(f"[dim]{message}[/dim]")
+
+
 def print_generated(message: str) -> None:
     """
     prints generated message in blue color
@@ -36,6 +50,20 @@ def print_generated(message: str) -> None:
     console.print(f"[blue]{message}[/blue]")
 
 
+@contextmanager
+def live_text() -> Iterator[Callable[[str], object]]:
+    """
+    Show text as it's produced, piece by piece. The text goes away when the
+    block ends, so the finished version can be printed in its place.
+
+    Yields:
+        a function that appends a piece of text to the display
+    """
+    text = Text(style="blue")
+    with Live(text, console=console, transient=True, refresh_per_second=15):
+        yield text.append
+
+
 # fixme: this function destroys bulletin board outputs. We shouldn't blindly
 #        wrap these lists into each-other.
 def wrap_text(text: str, width: int = 70) -> str:
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+from pathlib import PurePosixPath
+from typing import TYPE_CHECKING
+
+from . import diff_parser
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+    from .diff_parser import FileDiff, Hunk
+
+# How many tokens of diff we put in a prompt, unless `gen --budget` says
+# otherwise. Together with the fixed instructions, this bounds prompt size.
+token_budget = 4096
+
+# Rough average for code and English with the BPE tokenizers local models use.
+chars_per_token = 4
+
+lockfile_names = {
+    "package-lock.json",
+    "npm-shrinkwrap.json",
+    "yarn.lock",
+    "pnpm-lock.yaml",
+    "bun.lockb",
+    "poetry.lock",
+    "pdm.lock",
+    "uv.lock",
+    "Pipfile.lock",
+    "Cargo.lock",
+    "Gemfile.lock",
+    "composer.lock",
+    "go.sum",
+    "flake.lock",
+    "mix.lock",
+    "pubspec.lock",
+    "Podfile.lock",
+    "packages.lock.json",
+}
+generated_suffixes = (".min.js", ".min.css", ".map", ".snap", ".pb.go")
+doc_suffixes = {".md", ".rst", ".txt", ".adoc"}
+config_suffixes = {".json", ".yaml", ".yml", ".toml", ".ini", ".cfg", ".xml"}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheaply estimate how many tokens a model will see for the text.
+    """
+    return -(-len(text) // chars_per_token)
+
+
+def file_rank(file: FileDiff) -> int:
+    """
+    How much a file's diff tells the model, lower is more useful:
+    0 source, 1 tests, 2 docs and config, 3 lockfiles and generated
+    files, 4 binaries.
+    """
+    if file.binary:
+        return 4
+    path = PurePosixPath(file.path or "")
+    if path.name in lockfile_names or path.name.endswith(generated_suffixes):
+        return 3
+    if path.suffix in doc_suffixes or path.suffix in config_suffixes:
+        return 2
+    if any(part.startswith("test") for part in path.parts):
+        return 1
+    return 0
+
+
+def is_bulk(hunk: Hunk) -> bool:
+    """
+    Whether a hunk looks like bulk churn (reformatting, renames across a
+    file): large, and rewriting about as many lines as it adds.
+    """
+    changed = hunk.added + hunk.removed
+    if changed < 40:
+        return False
+    return min(hunk.added, hunk.removed) >= 0.8 * max(hunk.added, hunk.removed)
+
+
+def hunk_key(hunk: Hunk) -> tuple[bool, int]:
+    # small focused hunks first, bulk churn last
+    return is_bulk(hunk), hunk.added + hunk.removed
+
+
+def stat_summary(file: FileDiff) -> str:
+    """
+    One line describing a file we couldn't fit in the prompt.
+    """
+    path = file.path or "(unknown file)"
+    if file.binary:
+        return f"{path} | binary"
+    return f"{path} | +{file.added} -{file.removed}"
+
+
+def lines_cost(lines: Sequence[str]) -> int:
+    """
+    The estimated tokens of the lines, joined into prompt text.
+    """
+    return estimate_tokens("\n".join(lines)) + 1
+
+
+def _pack_file(file: FileDiff, budget: int) -> list[str] | None:
+    """
+    Fit as much of one file as possible into the budget, preferring its most
+    useful hunks.
+
+    Returns:
+        the lines to show, or None if not even one hunk fits
+    """
+    full = list(diff_parser.iter_render([file]))
+    if lines_cost(full) <= budget:
+        return full
+
+    remaining = (
+        budget - lines_cost(file.headers) - lines_cost(["[99 hunks omitted]"])
+    )
+    chosen: set[int] = set()
+    for i in sorted(
+        range(len(file.hunks)), key=lambda i: hunk_key(file.hunks[i])
+    ):
+        hunk = file.hunks[i]
+        cost = lines_cost([hunk.header, *hunk.lines])
+        if cost <= remaining:
+            chosen.add(i)
+            remaining -= cost
+    if not chosen:
+        return None
+
+    lines = list(file.headers)
+    for i, hunk in enumerate(file.hunks):
+        if i in chosen:
+            lines.append(hunk.header)
+            lines.extend(hunk.lines)
+    lines.append(f"[{len(file.hunks) - len(chosen)} hunks omitted]")
+    return lines
+
+
+def pack_diff(files: Sequence[FileDiff], budget: int | None = None) -> str:
+    """
+    Render the diff so that it fits in a token budget. Files are admitted
+    most useful first (source before tests, docs and lockfiles, small changes
+    before big ones); a file that doesn't fit is cut down to its most useful
+    hunks, or replaced by a one-line stat summary.
+
+    Args:
+        files: the parsed diff
+        budget: the token budget, token_budget if None
+
+    Returns:
+        the diff text, in git's file order, followed by the summaries of the
+        files left out. Its estimated size never exceeds the budget.
+    """
+    if budget is None:
+        budget = token_budget
+    summaries = [lines_cost([stat_summary(file)]) for file in files]
+    # room for the summaries of every file is reserved up front, and handed
+    # back as files get in.
+    remaining = budget - sum(summaries) - lines_cost(["Other changed files:"])
+
+    order = sorted(
+        range(len(files)),
+        key=lambda i: (file_rank(files[i]), files[i].added + files[i].removed),
+    )
+    packed: dict[int, list[str]] = {}
+    for i in order:
+        if remaining <= 0:
+            break
+        lines = _pack_file(files[i], remaining + summaries[i])
+        if lines is not None:
+            packed[i] = lines
+            remaining -= lines_cost(lines) - summaries[i]
+
+    out: list[str] = []
+    for i in range(len(files)):
+        out.extend(packed.get(i, ()))
+    left_out = [i for i in order if i not in packed]
+    if left_out:
+        out.append("Other changed files:")
+        # when even the summaries don't fit, the least useful files go
+        left = budget - lines_cost(out) - lines_cost(["[999999 more files]"])
+        shown = 0
+        for i in left_out:
+            if summaries[i] > left:
+                break
+            out.append(stat_summary(files[i]))
+            left -= summaries[i]
+            shown += 1
+        if shown < len(left_out):
+            out.append(f"[{len(left_out) - shown} more files]")
+    return "\n".join(out).strip()
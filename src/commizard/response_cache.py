@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+# Reuse a model's earlier answer to the exact same request, across sessions.
+# Turned off for one generation with `gen --no-cache`.
+enabled = True
+
+# The cache is trimmed back to this many bytes, least recently used first.
+max_bytes = 32 << 20
+
+
+def cache_dir() -> Path:
+    """
+    Where cached responses live: $XDG_CACHE_HOME/commizard/responses, or
+    ~/.cache/commizard/responses.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "commizard" / "responses"
+
+
+def cache_key(
+    model: str, digest: str, prompt: str, options: dict | None
+) -> str:
+    """
+    Name a request by its content. The model digest changes when the model is
+    pulled again, so a new version never gets an old version's answers.
+    """
+    blob = json.dumps([model, digest, prompt, options or {}], sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def get(key: str) -> str | None:
+    """
+    Look up a cached response, and mark it as recently used.
+
+    Returns:
+        the response text, or None on a miss
+    """
+    path = cache_dir() / f"{key}.json"
+    try:
+        with path.open(encoding="utf-8") as f:
+            response = json.load(f)["response"]
+        os.utime(path)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return response if isinstance(response, str) else None
+
+
+def put(key: str, response: str) -> None:
+    """
+    Store a response. The file is written under a temporary name and renamed
+    into place, so other processes never read half of it. Failing to write
+    is not an error: the cache is only an optimization.
+    """
+    directory = cache_dir()
+    tmp = None
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=directory, suffix=".tmp", delete=False
+        ) as f:
+            tmp = Path(f.name)
+            json.dump({"response": response}, f)
+        tmp.replace(directory / f"{key}.json")
+    except OSError:
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+        return
+    evict()
+
+
+def evict() -> None:
+    """
+    Delete the least recently used responses until the cache fits in
+    max_bytes. Entries another process removes meanwhile are skipped.
+    """
+    entries = []
+    for path in cache_dir().glob("*.json"):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import threading
+import time
+
+from . import config, git_utils, llm_providers, packing
+
+# How long (in seconds) the repo fingerprint has to stay the same before the
+# changes count as settled and a message is written for them.
+settle_seconds = 5.0
+# How often the watcher fingerprints the repo, in seconds.
+poll_interval = 1.0
+
+# The fingerprint the watcher saw last, and since when.
+_seen: str | None = None
+_seen_since = 0.0
+# The message being written, or written last, in the background.
+latest: Speculation | None = None
+_lock = threading.Lock()
+_watcher: threading.Thread | None = None
+_stop_watching = threading.Event()
+
+
+class Speculation:
+    """
+    A message written in the background for the repo as it was at
+    ``fingerprint``, from the same prompt a plain `gen` would send. ``done``
+    is set once ``result`` is in.
+    """
+
+    __slots__ = ("attempt", "done", "fingerprint", "model", "prompt", "result")
+
+    def __init__(self, fingerprint: str, model: str, prompt: str):
+        self.fingerprint = fingerprint
+        self.model = model
+        self.prompt = prompt
+        self.attempt = llm_providers.Attempt(model)
+        self.done = threading.Event()
+        self.result: tuple[int, str] = (1, "cancelled")
+
+    def run(self) -> None:
+        """
+        Generate the message, in the calling thread. It's not hedged: a
+        guess isn't worth a second request.
+        """
+        llm_providers.thread_state.attempt = self.attempt
+        try:
+            self.result = llm_providers.generate(
+                self.prompt, lambda token: None, hedged=False
+            )
+        finally:
+            llm_providers.thread_state.attempt = None
+            self.done.set()
+
+    def cancel(self) -> None:
+        """
+        Stop generating, so the server is free for a request someone is
+        waiting for.
+        """
+        if not self.done.is_set():
+            self.attempt.cancel()
+
+
+def check() -> Speculation | None:
+    """
+    Take one look at the repo. Once its fingerprint has held still for
+    settle_seconds, write a message for it, unless there already is one or
+    a generation is running.
+
+    Returns:
+        the speculation that was run, if any
+    """
+    global _seen, _seen_since, latest
+    fingerprint = git_utils.repo_fingerprint(worktree=not git_utils.staged_only)
+    now = time.monotonic()
+    if fingerprint != _seen:
+        # None while files are still being written, see repo_fingerprint
+        _seen, _seen_since = fingerprint, now
+        return None
+    model = llm_providers.selected_model
+    if fingerprint is None or model is None:
+        return None
+    if now - _seen_since < settle_seconds or llm_providers.in_flight:
+        return None
+    with _lock:
+        if (
+            latest is not None
+            and latest.fingerprint == fingerprint
+            and latest.model == model
+        ):
+            return None
+    snapshot = git_utils.get_snapshot()
+    prompt = packing.pack_diff(snapshot.files)
+    with _lock:
+        if prompt == "" or llm_providers.in_flight:
+            return None
+        spec = Speculation(fingerprint, model, prompt)
+        latest = spec
+    spec.run()
+    return spec
+
+
+def take(prompt: str) -> str | None:
+    """
+    The message written in the background for this prompt, waiting for it
+    if it's still being written. One for an outdated state of the repo, or
+    another model, is cancelled instead, so it doesn't hold up the
+    generation that replaces it.
+
+    Returns:
+        the message, or None if there's no usable one
+    """
+    with _lock:
+        spec = latest
+    if spec is None:
+        return None
+    if spec.model != llm_providers.selected_model:
+        spec.cancel()
+        return None
+    if spec.prompt != prompt:
+        # a gen for some paths, say, leaves one for the whole diff alone
+        fingerprint = git_utils.repo_fingerprint(
+            worktree=not git_utils.staged_only
+        )
+        if fingerprint != spec.fingerprint:
+            spec.cancel()
+        return None
+    spec.done.wait()
+    stat, res = spec.result
+    return res if stat == 0 else None
+
+
+def start() -> None:
+    """
+    Start watching the repo in a background thread, if "speculate" is on in
+    the config.
+    """
+    global _watcher
+    if config.get("speculate") is not True or _watcher is not None:
+        return
+    _stop_watching.clear()
+
+    def watch() -> None:
+        while not _stop_watching.wait(poll_interval):
+            check()
+
+    _watcher = threading.Thread(target=watch, name="speculate")
+    _watcher.daemon = True
+    _watcher.start()
+
+
+def stop() -> None:
+    """
+    Stop the watcher, cancelling the message it's writing.
+    """
+    global _watcher
+    _stop_watching.set()
+    with _lock:
+        spec = latest
+    if spec is not None:
+        spec.cancel()
+    if _watcher is not None:
+        _watcher.join()
+        _watcher = None
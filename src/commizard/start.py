@@ -86,16 +86,9 @@ def check_git_installed() -> bool:
 
 def local_ai_available() -> bool:
     """
-    Check if there's an ollama server running.
+    Check if the configured inference server (Ollama by default) is running.
     """
-    # Very rare for a server to run on this port AND have this api endpoint.
-    url = "http://localhost:11434/api/version"
-    r = llm_providers.http_request("get", url, timeout=0.3)
-    return (
-        (r.return_code == 200)
-        and (isinstance(r.response, dict))
-        and ("version" in r.response)
-    )
+    return llm_providers.get_provider().is_available()
 
 
 def is_inside_working_tree() -> bool:
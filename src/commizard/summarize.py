@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from . import diff_parser, llm_providers, packing
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Sequence
+
+    from .diff_parser import FileDiff
+
+# How many tokens of diff go into each part summarized on its own. Small
+# enough for a quick prompt, large enough that most files fit in one part.
+part_budget = 1024
+
+# The most tokens the model may write about one part.
+summary_tokens = 96
+
+summary_prompt = """
+You summarize one part of a Git diff for someone who is about to write the
+commit message for the whole change.
+
+Guidelines:
+- In one to three short sentences, say what changed and, if the diff shows
+it, why.
+- Name the files, functions or settings involved.
+- Do not guess beyond the diff, and do not write a commit message.
+- Do not use Markdown formatting.
+
+Here is the part of the diff:
+"""
+
+
+class Part:
+    """
+    A piece of the diff summarized on its own: whole small files, or a run
+    of hunks from a large one.
+    """
+
+    __slots__ = ("lines", "paths")
+
+    def __init__(self):
+        self.lines: list[str] = []
+        self.paths: list[str] = []
+
+    def add(self, path: str, lines: Sequence[str]) -> None:
+        self.lines.extend(lines)
+        if path not in self.paths:
+            self.paths.append(path)
+
+
+def cut_hunk(lines: Sequence[str], budget: int) -> list[str]:
+    """
+    Keep the first lines of a hunk that fit in the budget.
+    """
+    kept: list[str] = []
+    left = budget - packing.lines_cost(["[hunk truncated]"])
+    for line in lines:
+        cost = packing.estimate_tokens(line) + 1
+        if cost > left:
+            kept.append("[hunk truncated]")
+            break
+        kept.append(line)
+        left -= cost
+    return kept
+
+
+def split_file(file: FileDiff, budget: int) -> list[list[str]]:
+    """
+    Render one file in pieces of at most budget tokens, cut between hunks.
+    Each piece starts with the file's headers, so it reads on its own.
+    """
+    headers = list(file.headers)
+    room = budget - packing.lines_cost(headers)
+    pieces: list[list[str]] = []
+    current = list(headers)
+    for hunk in file.hunks:
+        lines = [hunk.header, *hunk.lines]
+        if packing.lines_cost(lines) > room:
+            lines = cut_hunk(lines, room)
+        if (
+            len(current) > len(headers)
+            and packing.lines_cost(current) + packing.lines_cost(lines) > budget
+        ):
+            pieces.append(current)
+            current = list(headers)
+        current.extend(lines)
+    if file.truncated:
+        current.append("[diff truncated]")
+    pieces.append(current)
+    return pieces
+
+
+def split_parts(files: Sequence[FileDiff], budget: int) -> list[Part]:
+    """
+    Divide the diff into parts of at most budget tokens, in git's file
+    order. Small files share a part; large ones are split between hunks.
+    Files whose text was never read (see FileDiff.skipped) have nothing to
+    summarize and are left out.
+    """
+    parts: list[Part] = []
+    current = Part()
+    for file in files:
+        if file.skipped is not None:
+            continue
+        for piece in split_file(file, budget):
+            if current.lines and (
+                packing.lines_cost(current.lines) + packing.lines_cost(piece)
+                > budget
+            ):
+                parts.append(current)
+                current = Part()
+            current.add(file.path or "(unknown file)", piece)
+    if current.lines:
+        parts.append(current)
+    return parts
+
+
+def summarize_parts(
+    parts: Sequence[Part], cache: bool = True
+) -> list[tuple[int, str]]:
+    """
+    Summarize every part at once, as many in parallel as Ollama runs. Each
+    summary is cached by the part's content, so after a small edit only the
+    parts that changed go to the model again.
+
+    Returns:
+        the (return code, summary) of each part, in order
+    """
+    if not parts:
+        return []
+    options = {"num_predict": summary_tokens}
+    workers = min(len(parts), llm_providers.parallel_requests())
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                llm_providers.generate,
+                "\n".join(part.lines),
+                None,
+                options,
+                cache,
+                summary_prompt,
+            )
+            for part in parts
+        ]
+        return [future.result() for future in futures]
+
+
+def combine(
+    files: Sequence[FileDiff],
+    parts: Sequence[Part],
+    summaries: Sequence[str],
+    budget: int,
+) -> str:
+    """
+    Build the prompt for the final message out of the part summaries and a
+    stat line for each file that wasn't summarized, within the budget.
+    """
+    out = ["The diff is too large to show whole. Each part of it in short:"]
+    not_shown = list(
+        diff_parser.iter_render(f for f in files if f.skipped is not None)
+    )
+    reserved = packing.lines_cost(["Not shown:", *not_shown])
+    reserved += packing.lines_cost(["[9999 more parts]"])
+    for i, (part, summary) in enumerate(zip(parts, summaries)):
+        entry = ["", f"{', '.join(part.paths)}:", summary.strip()]
+        if packing.lines_cost(out + entry) + reserved > budget:
+            out.append(f"[{len(parts) - i} more parts]")
+            break
+        out.extend(entry)
+    if not_shown:
+        out.extend(["", "Not shown:", *not_shown])
+    return "\n".join(out)
+
+
+def summarize_diff(
+    files: Sequence[FileDiff],
+    budget: int | None = None,
+    on_parts: Callable[[int], object] | None = None,
+    cache: bool = True,
+) -> tuple[int, str]:
+    """
+    Describe a diff too large for one prompt: summarize its parts in
+    parallel, then put the summaries together into a prompt for the message.
+
+    Args:
+        files: the parsed diff
+        budget: the token budget of the final prompt, packing.token_budget
+            if None
+        on_parts: called with the number of parts before they're sent
+        cache: reuse cached summaries of parts that haven't changed
+
+    Returns:
+        a return code and the prompt, or the first error
+    """
+    if budget is None:
+        budget = packing.token_budget
+    parts = split_parts(files, part_budget)
+    if on_parts is not None:
+        on_parts(len(parts))
+    results = summarize_parts(parts, cache)
+    for stat, res in results:
+        if stat != 0:
+            return stat, res
+    summaries = [res for _, res in results]
+    return 0, combine(files, parts, summaries, budget)
@@ -0,0 +1,28 @@
+import pytest
+
+from commizard import llm_providers, response_cache, speculate
+
+
+@pytest.fixture(autouse=True)
+def isolated_user_files(tmp_path, monkeypatch):
+    """
+    Keep tests away from the real config, response cache and Ollama. The
+    cache is off unless a test turns it on, and both live in a temporary
+    directory. No model counts as loaded, so nothing tries to unload one, and
+    each test starts with an empty model catalog and the default provider.
+    Failed requests aren't retried and every circuit breaker starts closed,
+    unless a test sets them up. Nothing was written in the background.
+    """
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    monkeypatch.setattr(response_cache, "enabled", False)
+    monkeypatch.setattr(llm_providers, "loaded_model", None)
+    monkeypatch.setattr(llm_providers, "catalog", llm_providers.ModelCatalog())
+    monkeypatch.setattr(llm_providers, "provider", None)
+    monkeypatch.delenv("OLLAMA_HOST", raising=False)
+    monkeypatch.setattr(llm_providers, "retries", 0)
+    monkeypatch.setattr(llm_providers, "breakers", {})
+    monkeypatch.setattr(llm_providers, "context_limits", {})
+    monkeypatch.setattr(llm_providers, "context_window", None)
+    monkeypatch.setattr(speculate, "latest", None)
+    monkeypatch.setattr(speculate, "_seen", None)
@@ -5,6 +5,16 @@ import pytest
 from commizard import cli
 
 
+@pytest.fixture(autouse=True)
+def no_catalog_prefetch(monkeypatch):
+    """
+    main() starts fetching the model list; keep that away from the network.
+    """
+    monkeypatch.setattr(
+        cli.llm_providers.catalog, "refresh_async", lambda: None
+    )
+
+
 @pytest.mark.parametrize(
     "argv,expected_print,expect_exit",
     [
@@ -35,6 +45,22 @@ def test_handle_args(
         mock_exit.assert_not_called()
 
 
+@pytest.mark.parametrize(
+    "argv, staged_only",
+    [
+        (["prog"], False),
+        (["prog", "--staged"], True),
+        (["prog", "-s"], True),
+        (["prog", "ignored", "-s"], True),
+    ],
+)
+def test_handle_args_staged(argv, staged_only, monkeypatch):
+    monkeypatch.setattr(cli.sys, "argv", argv)
+    monkeypatch.setattr(cli.git_utils, "staged_only", False)
+    cli.handle_args()
+    assert cli.git_utils.staged_only == staged_only
+
+
 @pytest.mark.parametrize(
     "git_installed, local_ai_avail, inside_work_tree, user_inputs, num_parse",
     [
@@ -152,7 +178,91 @@ def test_main_exception_handling(expected_exception):
         print_mocks["print"].side_effect = None  # optional, just to be explicit
         print_mocks["input"].side_effect = expected_exception
 
-        out = cli.main()
+        with patch("commizard.cli.llm_providers.close_session") as mock_close:
+            out = cli.main()
 
         assert out == 0
         print_mocks["print"].assert_called_once_with("\nGoodbye!")
+        mock_close.assert_called_once()
+
+
+@patch("commizard.cli.start.check_git_installed", return_value=True)
+@patch("commizard.cli.start.local_ai_available", return_value=True)
+@patch("commizard.cli.start.is_inside_working_tree", return_value=True)
+@patch("commizard.cli.start.print_welcome")
+@patch("commizard.cli.output.print_info")
+@patch("commizard.cli.input", side_effect=["exit"])
+@patch("commizard.cli.print")
+@patch("commizard.cli.handle_args")
+@patch("commizard.cli.llm_providers.preload_model")
+def test_main_preloads_default_model(
+    mock_preload,
+    mock_args,
+    mock_print,
+    mock_input,
+    mock_info,
+    mock_welcome,
+    mock_worktree,
+    mock_ai,
+    mock_git,
+    monkeypatch,
+):
+    monkeypatch.setattr(cli.llm_providers, "selected_model", None)
+    monkeypatch.setattr(cli.llm_providers, "preload", None)
+    cli.llm_providers.config.save("default_model", "llama3:8b")
+    mock_preload.return_value = True
+
+    assert cli.main() == 0
+
+    assert cli.llm_providers.selected_model == "llama3:8b"
+    assert cli.llm_providers.preload.result() is True
+    mock_preload.assert_called_once_with("llama3:8b")
+    mock_info.assert_called_once_with("Loading llama3:8b in the background.")
+
+
+@patch("commizard.cli.start.check_git_installed", return_value=True)
+@patch("commizard.cli.start.local_ai_available", return_value=True)
+@patch("commizard.cli.start.is_inside_working_tree", return_value=True)
+@patch("commizard.cli.start.print_welcome")
+@patch("commizard.cli.input", side_effect=["exit"])
+@patch("commizard.cli.print")
+@patch("commizard.cli.handle_args")
+@patch("commizard.cli.llm_providers.preload_model")
+def test_main_without_default_model(
+    mock_preload,
+    mock_args,
+    mock_print,
+    mock_input,
+    mock_welcome,
+    mock_worktree,
+    mock_ai,
+    mock_git,
+    monkeypatch,
+):
+    monkeypatch.setattr(cli.llm_providers, "preload", None)
+    assert cli.main() == 0
+    mock_preload.assert_not_called()
+    assert cli.llm_providers.preload is None
+
+
+@patch("commizard.cli.start.check_git_installed", return_value=True)
+@patch("commizard.cli.start.local_ai_available", return_value=True)
+@patch("commizard.cli.start.is_inside_working_tree", return_value=False)
+@patch("commizard.cli.output.print_error")
+@patch("commizard.cli.handle_args")
+@patch("commizard.cli.llm_providers.preload_model")
+def test_main_no_preload_outside_repo(
+    mock_preload,
+    mock_args,
+    mock_error,
+    mock_worktree,
+    mock_ai,
+    mock_git,
+    monkeypatch,
+):
+    # the session never starts, so nothing would unload the model
+    monkeypatch.setattr(cli.llm_providers, "preload", None)
+    cli.llm_providers.config.save("default_model", "llama3:8b")
+    assert cli.main() == 1
+    mock_preload.assert_not_called()
+    assert cli.llm_providers.preload is None
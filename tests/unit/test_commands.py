@@ -1,8 +1,9 @@
-from unittest.mock import patch
+from concurrent.futures import Future
+from unittest.mock import ANY, call, patch
 
 import pytest
 
-from commizard import commands, llm_providers
+from commizard import commands, diff_parser, llm_providers
 
 
 @pytest.mark.parametrize(
@@ -38,6 +39,7 @@ def test_handle_commit_req(
     monkeypatch,
 ):
     monkeypatch.setattr(llm_providers, "gen_message", gen_message)
+    monkeypatch.setattr(commands.git_utils, "snapshot", None)
     if commit_ret is not None:
         mock_commit.return_value = commit_ret
 
@@ -51,6 +53,74 @@ def test_handle_commit_req(
         mock_print_success.assert_not_called()
 
 
+@patch("commizard.commands.output.print_success")
+@patch("commizard.commands.git_utils.commit")
+@patch("commizard.commands.git_utils.commit_snapshot")
+def test_handle_commit_req_snapshot(
+    mock_snapshot_commit, mock_commit, mock_success, monkeypatch
+):
+    snap = object()
+    monkeypatch.setattr(llm_providers, "gen_message", "Generated msg")
+    monkeypatch.setattr(commands.git_utils, "snapshot", snap)
+    mock_snapshot_commit.return_value = (0, "[abc1234] Generated msg")
+
+    commands.handle_commit_req([])
+
+    mock_snapshot_commit.assert_called_once_with(snap, "Generated msg")
+    mock_commit.assert_not_called()
+    mock_success.assert_called_once_with("[abc1234] Generated msg")
+
+
+@pytest.mark.parametrize(
+    "opts, snapshot_paths, expected",
+    [
+        ([], ("services/billing",), "commit_snapshot"),
+        (["services/billing"], ("services/billing",), "commit_snapshot"),
+        (["services/other"], ("services/billing",), "print_warning"),
+        (["services/billing"], None, "commit"),
+    ],
+)
+@patch("commizard.commands.output.print_warning")
+@patch("commizard.commands.git_utils.commit")
+@patch("commizard.commands.git_utils.commit_snapshot")
+def test_handle_commit_req_paths(
+    mock_snapshot_commit,
+    mock_commit,
+    mock_warning,
+    opts,
+    snapshot_paths,
+    expected,
+    monkeypatch,
+):
+    snap = None
+    if snapshot_paths is not None:
+        snap = commands.git_utils.Snapshot("tree", "parent", [], snapshot_paths)
+    monkeypatch.setattr(llm_providers, "gen_message", "Generated msg")
+    monkeypatch.setattr(commands.git_utils, "snapshot", snap)
+    mock_snapshot_commit.return_value = mock_commit.return_value = (1, "")
+
+    commands.handle_commit_req(opts)
+
+    if expected == "commit_snapshot":
+        mock_snapshot_commit.assert_called_once_with(snap, "Generated msg")
+    elif expected == "commit":
+        mock_commit.assert_called_once_with("Generated msg", opts)
+    else:
+        mock_snapshot_commit.assert_not_called()
+        mock_warning.assert_called_once_with(
+            "The message was generated for other paths. Run "
+            "`gen services/other` first."
+        )
+
+
+@patch("commizard.commands.output.print_error")
+@patch("commizard.commands.git_utils.commit")
+def test_handle_commit_req_bad_opts(mock_commit, mock_error):
+    commands.handle_commit_req(["--amend"])
+    mock_error.assert_called_once()
+    mock_commit.assert_not_called()
+
+
 @pytest.mark.parametrize(
     "gen_message, opts, expect_warning",
     [
@@ -86,44 +156,42 @@ def test_copy_command(
 
 
 @pytest.mark.parametrize(
-    "available_models, opts, expect_init, expect_error, expect_select",
+    "listed, refreshed, opts, expect_refresh, expect_error, expect_select",
     [
-        # init_model_list called
-        (None, ["grok"], True, False, True),
+        # the list couldn't be fetched; let the server decide
+        (None, None, ["grok"], False, False, True),
         # print_error called
-        (["gpt-1", "gpt-2"], ["gpt-3"], False, True, False),
+        (["gpt-1", "gpt-2"], ["gpt-1", "gpt-2"], ["gpt-3"], True, True, False),
         # select_model called
-        (["gpt-1", "gpt-2"], ["gpt-2"], False, False, True),
+        (["gpt-1", "gpt-2"], None, ["gpt-2"], False, False, True),
+        # pulled since the list was fetched
+        (["gpt-1"], ["gpt-1", "gpt-2"], ["gpt-2"], True, False, True),
         # incorrect user input
-        (None, [], True, True, False),
-        (["gpt-1", "gpt-2"], [], False, True, False),
+        (None, None, [], False, True, False),
+        (["gpt-1", "gpt-2"], None, [], False, True, False),
     ],
 )
 @patch("commizard.llm_providers.output.print_error")
 @patch("commizard.llm_providers.select_model")
-@patch("commizard.llm_providers.init_model_list")
+@patch("commizard.llm_providers.catalog")
 def test_start_model(
-    mock_init,
+    mock_catalog,
     mock_select,
     mock_error,
-    monkeypatch,
-    available_models,
+    listed,
+    refreshed,
     opts,
-    expect_init,
+    expect_refresh,
     expect_error,
     expect_select,
 ):
-    # set available_models dynamically
-    monkeypatch.setattr(llm_providers, "available_models", available_models)
-
-    # mock the behavior of mock_init
-    def fake_init():
-        monkeypatch.setattr(llm_providers, "available_models", ["grok", "GPT"])
-
-    mock_init.side_effect = fake_init
+    mock_catalog.names.return_value = listed
+    mock_catalog.refresh.side_effect = lambda: setattr(
+        mock_catalog.names, "return_value", refreshed
+    )
     commands.start_model(opts)
 
-    assert mock_init.called == expect_init
+    assert mock_catalog.refresh.called == expect_refresh
     assert mock_error.called == expect_error
 
     if expect_select:
@@ -141,16 +209,14 @@ def test_start_model(
     ],
 )
 @patch("builtins.print")  # thanks chat-GPT. I never would've found this.
-@patch("commizard.commands.llm_providers.init_model_list")
+@patch("commizard.commands.llm_providers.catalog")
 def test_print_available_models_correct(
-    mock_init, mock_print, available_models, opts, monkeypatch
+    mock_catalog, mock_print, available_models, opts
 ):
-    mock_init.side_effect = lambda: monkeypatch.setattr(
-        llm_providers, "available_models", available_models
-    )
+    mock_catalog.names.return_value = available_models
     commands.print_available_models(opts)
 
-    mock_init.assert_called_once()
+    mock_catalog.names.assert_called_once()
 
     # assert prints match number of models
     assert mock_print.call_count == len(available_models)
@@ -169,13 +235,11 @@ def test_print_available_models_correct(
 @patch("commizard.llm_providers.output.print_warning")
 @patch("commizard.llm_providers.output.print_error")
 @patch("builtins.print")
-@patch("commizard.commands.llm_providers.init_model_list")
+@patch("commizard.commands.llm_providers.catalog")
 def test_print_available_models_error_behavior(
-    mock_init, mock_print, mock_err, mock_warn, available_models, expect_err
+    mock_catalog, mock_print, mock_err, mock_warn, available_models, expect_err
 ):
-    mock_init.side_effect = lambda: setattr(
-        llm_providers, "available_models", available_models
-    )
+    mock_catalog.names.return_value = available_models
     commands.print_available_models([])
     mock_print.assert_not_called()
     if expect_err:
@@ -184,53 +248,317 @@ def test_print_available_models_error_behavior(
         mock_warn.assert_called_once()
 
 
+@patch("commizard.commands.git_utils.get_snapshot")
 @patch("commizard.commands.output.print_warning")
-@patch("commizard.commands.git_utils.get_clean_diff")
-def test_generate_message_no_diff(mock_diff, mock_output, monkeypatch):
+@patch("commizard.commands.packing.pack_diff")
+def test_generate_message_no_diff(
+    mock_diff, mock_output, mock_files, monkeypatch
+):
     mock_diff.return_value = ""
     monkeypatch.setattr(commands.llm_providers, "gen_message", None)
 
-    commands.generate_message(["--dummy"])
+    commands.generate_message([])
 
     mock_output.assert_called_once_with("No changes to the repository.")
     assert commands.llm_providers.gen_message is None
 
 
+@pytest.mark.parametrize(
+    "opts, budget",
+    [([], None), (["--budget", "300"], 300), (["--budget=20"], 20)],
+)
+@patch("commizard.commands.llm_providers.generate")
+@patch("commizard.commands.git_utils.get_snapshot")
+@patch("commizard.commands.packing.pack_diff")
+def test_generate_message_budget(mock_pack, mock_files, mock_gen, opts, budget):
+    mock_pack.return_value = ""
+    commands.generate_message(opts)
+    mock_pack.assert_called_once_with(mock_files.return_value.files, budget)
+    mock_gen.assert_not_called()
+
+
+@pytest.mark.parametrize("opts, cache", [([], True), (["--no-cache"], False)])
+@patch("commizard.commands.git_utils.get_snapshot")
+@patch("commizard.commands.packing.pack_diff")
+@patch("commizard.commands.llm_providers.generate")
+def test_generate_message_no_cache(
+    mock_gen, mock_diff, mock_snapshot, opts, cache
+):
+    mock_diff.return_value = "some diff"
+    mock_gen.return_value = (1, "offline")
+    commands.generate_message(opts)
+    assert mock_gen.call_args.kwargs == {"cache": cache}
+
+
+@pytest.mark.parametrize(
+    "opts, paths",
+    [
+        ([], []),
+        (["services/billing"], ["services/billing"]),
+        (["--budget", "300", "a.py", "b/"], ["a.py", "b/"]),
+    ],
+)
+@patch("commizard.commands.git_utils.get_snapshot")
+@patch("commizard.commands.packing.pack_diff")
+def test_generate_message_paths(mock_pack, mock_snapshot, opts, paths):
+    mock_pack.return_value = ""
+    commands.generate_message(opts)
+    mock_snapshot.assert_called_once_with(paths)
+
+
+@pytest.mark.parametrize(
+    "opts", [["--dummy"], ["--budget", "0"], ["--budget", "lots"]]
+)
 @patch("commizard.commands.output.print_error")
-@patch("commizard.commands.git_utils.get_clean_diff")
+@patch("commizard.commands.git_utils.get_snapshot")
+def test_generate_message_bad_opts(mock_files, mock_error, opts):
+    commands.generate_message(opts)
+    mock_error.assert_called_once()
+    mock_files.assert_not_called()
+
+
+@patch("commizard.commands.git_utils.get_snapshot")
+@patch("commizard.commands.output.print_error")
+@patch("commizard.commands.packing.pack_diff")
 @patch("commizard.commands.llm_providers.generate")
-def test_generate_message_err(mock_gen, mock_diff, mock_output, monkeypatch):
+def test_generate_message_err(
+    mock_gen, mock_diff, mock_output, mock_files, monkeypatch
+):
     mock_diff.return_value = "some diff"
     mock_gen.return_value = (1, "Error happened")
-    monkeypatch.setattr(commands.llm_providers, "generation_prompt", "PROMPT:")
     monkeypatch.setattr(commands.llm_providers, "gen_message", None)
 
-    commands.generate_message(["--dummy"])
+    commands.generate_message([])
 
-    mock_gen.assert_called_once_with("PROMPT:some diff")
+    mock_gen.assert_called_once_with("some diff", ANY, cache=True)
     mock_output.assert_called_once_with("Error happened")
     assert commands.llm_providers.gen_message is None
 
 
+@patch("commizard.commands.git_utils.get_snapshot")
 @patch("commizard.commands.output.wrap_text")
 @patch("commizard.commands.output.print_generated")
-@patch("commizard.commands.git_utils.get_clean_diff")
+@patch("commizard.commands.packing.pack_diff")
 @patch("commizard.commands.llm_providers.generate")
 def test_generate_message_success(
-    mock_gen, mock_diff, mock_output, mock_wrap, monkeypatch
+    mock_gen, mock_diff, mock_output, mock_wrap, mock_files, monkeypatch
 ):
     mock_diff.return_value = "some diff"
     mock_gen.return_value = (0, "The generated commit message")
-    monkeypatch.setattr(commands.llm_providers, "generation_prompt", "PROMPT:")
     monkeypatch.setattr(commands.llm_providers, "gen_message", None)
+    monkeypatch.setattr(commands.git_utils, "snapshot", None)
     mock_wrap.side_effect = lambda text, width: f"WRAPPED({text})"
 
-    commands.generate_message(["--dummy"])
+    commands.generate_message([])
 
-    mock_gen.assert_called_once_with("PROMPT:some diff")
+    mock_gen.assert_called_once_with("some diff", ANY, cache=True)
     mock_wrap.assert_called_once_with("The generated commit message", 72)
     mock_output.assert_called_once_with("WRAPPED(The generated commit message)")
     assert llm_providers.gen_message == "WRAPPED(The generated commit message)"
+    assert commands.git_utils.snapshot is mock_files.return_value
+
+
+@patch("commizard.commands.git_utils.get_snapshot")
+@patch("commizard.commands.output.live_text")
+@patch("commizard.commands.packing.pack_diff")
+@patch("commizard.commands.llm_providers.generate")
+def test_generate_message_streams(
+    mock_gen, mock_diff, mock_live, mock_snapshot, monkeypatch
+):
+    shown = []
+    mock_live.return_value.__enter__.return_value = shown.append
+    mock_diff.return_value = "some diff"
+
+    def fake_generate(prompt, on_token, cache):
+        on_token("Fix ")
+        on_token("parser")
+        return 0, "Fix parser"
+
+    mock_gen.side_effect = fake_generate
+    monkeypatch.setattr(commands.llm_providers, "gen_message", None)
+    monkeypatch.setattr(commands.git_utils, "snapshot", None)
+
+    commands.generate_message([])
+
+    assert shown == ["Fix ", "parser"]
+    mock_live.return_value.__exit__.assert_called_once()
+    assert llm_providers.gen_message == "Fix parser"
+
+
+@pytest.mark.parametrize(
+    "summary, expect_generate",
+    [((0, "part summaries"), True), ((1, "offline"), False)],
+)
+@patch("commizard.commands.git_utils.get_snapshot")
+@patch("commizard.commands.packing.pack_diff", return_value="some diff")
+@patch("commizard.commands.summarize.summarize_diff")
+@patch("commizard.commands.output.print_info")
+@patch("commizard.commands.output.print_error")
+@patch("commizard.commands.llm_providers.generate")
+def test_generate_message_summarize(
+    mock_gen,
+    mock_error,
+    mock_info,
+    mock_summarize,
+    mock_diff,
+    mock_snapshot,
+    summary,
+    expect_generate,
+    monkeypatch,
+):
+    monkeypatch.setattr(llm_providers, "preload", None)
+    monkeypatch.setattr(llm_providers, "last_stats", {})
+    mock_gen.return_value = (0, "Rework everything")
+
+    def fake_summarize(files, budget, on_parts, cache):
+        on_parts(3)
+        return summary
+
+    mock_summarize.side_effect = fake_summarize
+
+    commands.generate_message(["--summarize", "--budget", "900"])
+
+    mock_summarize.assert_called_once_with(
+        mock_snapshot.return_value.files, 900, ANY, cache=True
+    )
+    mock_info.assert_any_call("Summarizing 3 parts of the diff...")
+    if expect_generate:
+        mock_gen.assert_called_once_with("part summaries", ANY, cache=True)
+        mock_error.assert_not_called()
+    else:
+        mock_gen.assert_not_called()
+        mock_error.assert_called_once_with("offline")
+
+
+@pytest.mark.parametrize("done", [True, False])
+@patch("commizard.commands.git_utils.get_snapshot")
+@patch("commizard.commands.packing.pack_diff")
+@patch("commizard.commands.output.print_info")
+@patch("commizard.commands.llm_providers.generate")
+def test_generate_message_waits_for_preload(
+    mock_gen, mock_info, mock_diff, mock_snapshot, done, monkeypatch
+):
+    preload = Future()
+    if done:
+        preload.set_result(True)
+    monkeypatch.setattr(llm_providers, "preload", preload)
+    monkeypatch.setattr(llm_providers, "selected_model", "llama3")
+    mock_diff.return_value = "some diff"
+    mock_gen.return_value = (1, "offline")
+
+    commands.generate_message([])
+
+    waiting = "Waiting for llama3 to finish loading..."
+    assert (mock_info.call_args_list == [call(waiting)]) is not done
+
+
+@pytest.mark.parametrize(
+    "stats, expected",
+    [
+        (
+            {"prompt_eval_count": 812, "prompt_eval_duration": 1_250_000_000},
+            "Prompt: 812 tokens evaluated in 1.25s",
+        ),
+        ({"eval_count": 20}, "Prompt: 0 tokens"),
+        ({"prompt_eval_count": 31, "eval_count": 20}, "Prompt: 31 tokens"),
+    ],
+)
+@patch("commizard.commands.output.print_info")
+def test_print_prompt_stats(mock_info, stats, expected):
+    commands.print_prompt_stats(stats)
+    mock_info.assert_called_once_with(expected)
+
+
+@patch("commizard.commands.output.print_info")
+def test_print_prompt_stats_sizing(mock_info):
+    sizing = {"prompt_estimate": 2900, "num_ctx": 4096, "num_predict": 512}
+    commands.print_prompt_stats({"prompt_eval_count": 3012}, sizing)
+    mock_info.assert_called_once_with(
+        "Prompt: 3012 tokens (estimated ~2900, context window 4096, "
+        "at most 512 new)"
+    )
+
+
+@patch("commizard.commands.git_utils.get_snapshot")
+@patch("commizard.commands.packing.pack_diff")
+@patch("commizard.commands.print_prompt_stats")
+@patch("commizard.commands.llm_providers.generate")
+def test_generate_message_reports_stats(
+    mock_gen, mock_stats, mock_diff, mock_snapshot, monkeypatch
+):
+    mock_diff.return_value = "some diff"
+    mock_gen.return_value = (0, "Fix parser")
+    monkeypatch.setattr(commands.git_utils, "snapshot", None)
+    monkeypatch.setattr(llm_providers, "last_stats", {"prompt_eval_count": 9})
+    monkeypatch.setattr(llm_providers, "last_sizing", {"num_ctx": 2048})
+    commands.generate_message([])
+    mock_stats.assert_called_once_with(
+        {"prompt_eval_count": 9}, {"num_ctx": 2048}
+    )
+
+    # nothing to report for a cached response
+    mock_stats.reset_mock()
+    monkeypatch.setattr(llm_providers, "last_stats", {})
+    commands.generate_message([])
+    mock_stats.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "results, answers, expected",
+    [
+        # shown in the order they finish; the user picks the 2nd shown
+        ([(0, "first"), (1, "timeout"), (0, "second")], ["2"], (0, "second")),
+        ([(0, "a"), (0, "b")], ["", "9", "x", "1"], (0, "a")),
+        ([(1, "timeout"), (0, "only")], [], (0, "only")),
+        ([(1, "timeout"), (1, "refused")], [], (1, "timeout")),
+        ([(0, "a"), (0, "b")], [EOFError], (1, "No message picked.")),
+    ],
+)
+@patch("commizard.commands.input")
+@patch("commizard.commands.output.print_generated")
+@patch("commizard.commands.output.print_warning")
+@patch("commizard.commands.llm_providers.generate_candidates")
+def test_pick_candidate(
+    mock_candidates,
+    mock_warning,
+    mock_generated,
+    mock_input,
+    results,
+    answers,
+    expected,
+):
+    def fake_candidates(prompt, count, on_done):
+        for i, result in enumerate(results):
+            on_done(i, *result)
+        return results
+
+    mock_candidates.side_effect = fake_candidates
+    mock_input.side_effect = answers
+
+    assert commands.pick_candidate("PROMPT", len(results)) == expected
+    mock_candidates.assert_called_once_with("PROMPT", len(results), ANY)
+    shown = [res for stat, res in results if stat == 0]
+    assert mock_generated.call_count == len(shown)
+    assert mock_input.call_count == len(answers)
+
+
+@patch("commizard.commands.git_utils.get_snapshot")
+@patch("commizard.commands.packing.pack_diff")
+@patch("commizard.commands.llm_providers.generate")
+@patch("commizard.commands.pick_candidate")
+def test_generate_message_candidates(
+    mock_pick, mock_gen, mock_diff, mock_snapshot, monkeypatch
+):
+    mock_diff.return_value = "some diff"
+    mock_pick.return_value = (0, "Picked message")
+    monkeypatch.setattr(commands.llm_providers, "gen_message", None)
+    monkeypatch.setattr(commands.git_utils, "snapshot", None)
+
+    commands.generate_message(["-n", "4"])
+
+    mock_pick.assert_called_once_with("some diff", 4)
+    mock_gen.assert_not_called()
+    assert llm_providers.gen_message == "Picked message"
 
 
 @pytest.mark.parametrize(
@@ -394,3 +722,49 @@ def test_parser_clear_and_cls(monkeypatch, cmd):
         result = commands.parser(cmd)
         assert result == 0
         assert called["v"] is True
+
+
+@patch("commizard.commands.llm_providers.generate")
+@patch("commizard.commands.output.print_info")
+@patch("commizard.commands.git_utils.get_snapshot")
+def test_generate_message_reports_skipped(mock_files, mock_info, mock_gen):
+    lockfile = diff_parser.FileDiff("yarn.lock", "yarn.lock")
+    lockfile.skipped = "lockfile"
+    lockfile.counts = (100, 28)
+    mock_files.return_value.files = [lockfile]
+    mock_gen.return_value = (1, "offline")
+
+    commands.generate_message([])
+
+    mock_info.assert_called_once_with(
+        "Left out 1 generated, vendored, binary or lock files "
+        "(~5.0 KiB, ~1280 tokens saved)"
+    )
+    mock_gen.assert_called_once()
+
+
+@patch("commizard.commands.git_utils.get_snapshot")
+@patch("commizard.commands.packing.pack_diff", return_value="some diff")
+@patch("commizard.commands.speculate.take")
+@patch("commizard.commands.llm_providers.generate")
+def test_generate_message_speculated(
+    mock_gen, mock_take, mock_diff, mock_snapshot, monkeypatch
+):
+    monkeypatch.setattr(commands.git_utils, "snapshot", None)
+    mock_take.return_value = "Fix parser"
+    commands.generate_message([])
+    mock_take.assert_called_once_with("some diff")
+    mock_gen.assert_not_called()
+    assert llm_providers.gen_message == "Fix parser"
+    assert commands.git_utils.snapshot is mock_snapshot.return_value
+
+    # nothing written in the background for it
+    mock_take.return_value = None
+    mock_gen.return_value = (0, "Fix lexer")
+    commands.generate_message([])
+    assert llm_providers.gen_message == "Fix lexer"
+
+    # asked for a fresh answer
+    mock_take.reset_mock()
+    commands.generate_message(["--no-cache"])
+    mock_take.assert_not_called()
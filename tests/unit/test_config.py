@@ -0,0 +1,42 @@
+import pytest
+
+from commizard import config
+
+
+def test_config_path(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path))
+    assert config.config_path() == tmp_path / "commizard" / "config.json"
+    monkeypatch.delenv("XDG_CONFIG_HOME")
+    monkeypatch.setenv("HOME", str(tmp_path))
+    assert config.config_path() == (
+        tmp_path / ".config" / "commizard" / "config.json"
+    )
+
+
+def test_save_and_load():
+    assert config.load() == {}
+    assert config.get("default_model", "none") == "none"
+    assert config.save("default_model", "llama3:8b")
+    assert config.save("other", 1)
+    assert config.load() == {"default_model": "llama3:8b", "other": 1}
+    assert config.get("default_model") == "llama3:8b"
+    # replaced atomically: no temporary files stay behind
+    assert [p.name for p in config.config_path().parent.iterdir()] == [
+        "config.json"
+    ]
+
+
+@pytest.mark.parametrize("content", ["{broken", "[1, 2]"])
+def test_load_bad_file(content):
+    config.config_path().parent.mkdir(parents=True)
+    config.config_path().write_text(content)
+    assert config.load() == {}
+    assert config.save("key", "value")
+    assert config.load() == {"key": "value"}
+
+
+def test_save_unwritable(monkeypatch, tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(blocker))
+    assert not config.save("key", "value")
@@ -0,0 +1,121 @@
+import pytest
+
+from commizard import diff_parser
+
+sample_diff = """\
+diff --git a/src/app.py b/src/app.py
+index 83db48f..bf269f4 100644
+--- a/src/app.py
++++ b/src/app.py
+@@ -1,3 +1,4 @@
+ import os
+-import sys
++import re
++import json
+ print(os)
+@@ -10 +11 @@ def main():
+--- a/not/a/header
++++ b/not/a/header
+diff --git a/new.txt b/new.txt
+new file mode 100644
+index 0000000..3b18e51
+--- /dev/null
++++ b/new.txt
+@@ -0,0 +1 @@
++hello world
+\\ No newline at end of file
+diff --git a/logo.png b/logo.png
+index 1111111..2222222 100644
+Binary files a/logo.png and b/logo.png differ
+diff --git a/gone.py b/gone.py
+deleted file mode 100644
+index e69de29..0000000
+--- a/gone.py
++++ /dev/null
+@@ -1 +0,0 @@
+-bye
+"""
+
+
+def test_parse_diff_structure():
+    files = diff_parser.parse_diff(sample_diff.splitlines())
+    assert [f.path for f in files] == [
+        "src/app.py",
+        "new.txt",
+        "logo.png",
+        "gone.py",
+    ]
+
+    app, new, logo, gone = files
+    assert app.headers == ["--- a/src/app.py", "+++ b/src/app.py"]
+    assert len(app.hunks) == 2
+    first, second = app.hunks
+    assert first.old == diff_parser.LineRange(1, 3)
+    assert first.new == diff_parser.LineRange(1, 4)
+    assert (first.added, first.removed) == (2, 1)
+    # lines inside a hunk are never mistaken for file headers
+    assert second.old == diff_parser.LineRange(10, 1)
+    assert second.lines == ["--- a/not/a/header", "+++ b/not/a/header"]
+    assert (app.added, app.removed) == (3, 2)
+
+    assert new.old_path is None
+    assert new.new_path == "new.txt"
+    assert new.hunks[0].lines[-1] == "\\ No newline at end of file"
+    assert new.added == 1
+
+    assert logo.binary
+    assert logo.hunks == []
+
+    assert gone.new_path is None
+    assert gone.path == "gone.py"
+    assert gone.removed == 1
+
+
+def test_slots():
+    file = diff_parser.FileDiff("a", "b")
+    with pytest.raises(AttributeError):
+        file.extra = 1  # type: ignore[attr-defined]
+    assert not hasattr(file, "__dict__")
+    assert repr(diff_parser.LineRange(3, 4)) == "LineRange(3, 4)"
+    assert diff_parser.LineRange(1, 2) != (1, 2)
+    assert len({diff_parser.LineRange(1, 2), diff_parser.LineRange(1, 2)}) == 1
+
+
+@pytest.mark.parametrize(
+    "header, old_path, new_path",
+    [
+        ("diff --git a/x.py b/x.py", "x.py", "x.py"),
+        ("diff --git a/old name b/new name", "old name", "new name"),
+        ("diff --git nonsense", None, None),
+    ],
+)
+def test_git_header_paths(header, old_path, new_path):
+    (file,) = diff_parser.parse_diff([header])
+    assert (file.old_path, file.new_path) == (old_path, new_path)
+
+
+def test_render():
+    files = diff_parser.parse_diff(sample_diff.splitlines())
+    rendered = diff_parser.render(files)
+    expected = "\n".join(
+        line
+        for line in sample_diff.splitlines()
+        if not line.startswith(("diff --git", "index "))
+    )
+    assert rendered == expected
+
+    files[-1].truncated = True
+    assert diff_parser.render(files).endswith("-bye\n[diff truncated]")
+
+
+@pytest.mark.parametrize(
+    "lines, expected",
+    [
+        ([], ""),
+        (["warning: LF will be replaced by CRLF"], ""),
+        (["+orphan line", "@@ not a hunk"], "+orphan line\n@@ not a hunk"),
+        (["  ", ""], ""),
+    ],
+)
+def test_render_odd_input(lines, expected):
+    assert diff_parser.render(diff_parser.parse_diff(lines)) == expected
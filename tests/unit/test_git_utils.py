@@ -1,9 +1,14 @@
+import os
+import signal
 import subprocess
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, patch
 
 import pytest
 
-from commizard import git_utils
+from commizard import diff_parser, git_utils
 
 
 # TODO: add valid test cases that mock actual returns or subprocess.run
@@ -65,6 +70,8 @@ def test_run_git_command(mock_run, args, mock_result, raised_exception):
             text=True,
             encoding="utf-8",
             errors="ignore",
+            input=None,
+            env=None,
         )
         return
 
@@ -77,6 +84,8 @@ def test_run_git_command(mock_run, args, mock_result, raised_exception):
         text=True,
         encoding="utf-8",
         errors="ignore",
+        input=None,
+        env=None,
     )
     assert result is mock_result
 
@@ -163,37 +172,37 @@ def test_is_changed(mock_run, mock_val, expected):
     assert res == expected
 
 
+@patch("commizard.git_utils.run_git_command")
+def test_is_changed_staged(mock_run, monkeypatch):
+    monkeypatch.setattr(git_utils, "staged_only", True)
+    git_utils.is_changed()
+    mock_run.assert_called_once_with(["diff", "--cached", "--name-only"])
+
+
 @pytest.mark.parametrize(
-    "is_changed_return, run_git_returncode, run_git_stdout, expected_output",
+    "run_git_returncode, run_git_stdout, expected_output",
     [
-        # No changes detected
-        (False, 0, "some diff", ""),
-        # Changes detected, git diff succeeds
+        # git diff succeeds
         (
-            True,
             0,
             "diff --git a/file.py b/file.py\n+new line\n-old line\n\n",
             "diff --git a/file.py b/file.py\n+new line\n-old line",
         ),
-        # Changes detected, git diff fails (non-zero return code)
-        (True, 1, "error output", None),
-        # Changes detected, git diff succeeds but stdout is empty
-        (True, 0, "", ""),
-        # Changes detected, git diff succeeds with whitespace-only output
-        (True, 0, "   \n\t  ", ""),
+        # git diff fails (non-zero return code)
+        (1, "error output", None),
+        # no changes
+        (0, "", ""),
+        # whitespace-only output
+        (0, "   \n\t  ", ""),
     ],
 )
 @patch("commizard.git_utils.run_git_command")
-@patch("commizard.git_utils.is_changed")
 def test_get_diff(
-    mock_is_changed,
     mock_run_git_command,
-    is_changed_return,
     run_git_returncode,
     run_git_stdout,
     expected_output,
 ):
-    mock_is_changed.return_value = is_changed_return
     mock_result = MagicMock()
     mock_result.returncode = run_git_returncode
     mock_result.stdout = run_git_stdout
@@ -201,16 +210,68 @@ def test_get_diff(
 
     result = git_utils.get_diff()
 
-    if is_changed_return:
-        mock_run_git_command.assert_called_once_with(
-            ["--no-pager", "diff", "--no-color"]
-        )
-    else:
-        mock_run_git_command.assert_not_called()
-
+    mock_run_git_command.assert_called_once_with(
+        ["--no-pager", "diff", "--no-color"]
+    )
     assert result == expected_output
 
 
+@pytest.fixture
+def git_repo(tmp_path, monkeypatch):
+    """
+    A throwaway repository with a single commit, used as the working
+    directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(git_utils, "_repo_paths", None)
+    monkeypatch.setattr(git_utils, "diff_cache", OrderedDict())
+    for args in (
+        ["init", "-q"],
+        ["config", "user.email", "wizard@example.com"],
+        ["config", "user.name", "Wizard"],
+    ):
+        subprocess.run(["git", *args], check=True)  # noqa: S603
+    (tmp_path / "file.txt").write_text("hello\n")
+    subprocess.run(["git", "add", "file.txt"], check=True)
+    subprocess.run(["git", "commit", "-q", "-m", "init"], check=True)
+    yield tmp_path
+    git_utils.close_workers()
+
+
+def test_cat_file_workers(git_repo):
+    head = subprocess.run(
+        ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+    assert git_utils.rev_parse("HEAD") == head
+    assert git_utils.rev_parse("HEAD") == head
+    assert git_utils.rev_parse("no-such-rev") is None
+    assert git_utils.rev_parse("HEAD\nHEAD") is None
+
+    # one warm process, reused across queries
+    pid = git_utils.workers["check"].pid
+    assert pid is not None
+    git_utils.rev_parse("HEAD")
+    assert git_utils.workers["check"].pid == pid
+
+    git_utils.close_workers()
+    assert git_utils.workers["check"].pid is None
+    # restarted on demand
+    assert git_utils.rev_parse("HEAD") == head
+
+
+def test_cat_file_dead_worker(git_repo):
+    worker = git_utils.CatFile()
+    assert worker.query("HEAD") is not None
+    os.kill(worker.pid, signal.SIGKILL)
+    while worker.pid is not None:
+        time.sleep(0.01)
+    # a dead process is replaced transparently
+    assert worker.query("HEAD") is not None
+    worker.close()
+    worker.close()
+
+
 @pytest.mark.parametrize(
     "stdout, stderr, expected_ret",
     [
@@ -219,8 +280,24 @@ def test_get_diff(
         ("   \n", "   \n", ""),
     ],
 )
+@pytest.mark.parametrize(
+    "staged_only, expected_args",
+    [
+        (False, ["commit", "-a", "-m", "test message"]),
+        (True, ["commit", "-m", "test message"]),
+    ],
+)
 @patch("commizard.git_utils.run_git_command")
-def test_commit(mock_run_git_command, stdout, stderr, expected_ret):
+def test_commit(
+    mock_run_git_command,
+    stdout,
+    stderr,
+    expected_ret,
+    staged_only,
+    expected_args,
+    monkeypatch,
+):
+    monkeypatch.setattr(git_utils, "staged_only", staged_only)
     # arrange: directly configure the mock return value
     mock_run_git_command.return_value.stdout = stdout
     mock_run_git_command.return_value.stderr = stderr
@@ -228,9 +305,7 @@ def test_commit(mock_run_git_command, stdout, stderr, expected_ret):
 
     code, output = git_utils.commit("test message")
 
-    mock_run_git_command.assert_called_once_with(
-        ["commit", "-a", "-m", "test message"]
-    )
+    mock_run_git_command.assert_called_once_with(expected_args)
     assert code == 42
     assert output == expected_ret
 
@@ -258,8 +333,567 @@ def test_clean_diff(input_diff, expected_output):
     assert result == expected_output
 
 
-@patch("commizard.git_utils.clean_diff")
-@patch("commizard.git_utils.get_diff")
-def test_get_clean_diff(mock_diff, mock_clean_diff):
-    git_utils.get_clean_diff()
-    mock_clean_diff.assert_called_once_with(mock_diff.return_value)
+def test_git_stream(git_repo):
+    stream = git_utils.GitStream(["log", "--format=%s"])
+    assert stream.returncode is None
+    assert list(stream) == ["init"]
+    assert stream.returncode == 0
+
+    stream = git_utils.GitStream(["log", "no-such-rev"])
+    assert list(stream) == []
+    assert stream.returncode != 0
+
+
+def test_git_stream_early_close(git_repo):
+    stream = git_utils.GitStream(["cat-file", "-p", "HEAD"])
+    lines = iter(stream)
+    assert next(lines).startswith("tree ")
+    stream.close()
+    assert stream.returncode == -1
+    stream.close()
+
+
+def test_get_clean_diff(git_repo):
+    assert git_utils.get_clean_diff() == ""
+
+    (git_repo / "file.txt").write_text("hello\nworld\n")
+    diff = git_utils.get_clean_diff()
+    assert "diff --git" not in diff
+    assert "index " not in diff
+    assert diff.startswith("--- a/file.txt\n+++ b/file.txt\n@@")
+    assert diff.endswith("+world")
+
+
+def test_get_clean_diff_truncated(git_repo, monkeypatch):
+    (git_repo / "file.txt").write_text("".join(f"{i}\n" for i in range(500)))
+    monkeypatch.setattr(git_utils, "max_diff_chars", 100)
+    diff = git_utils.get_clean_diff()
+    assert diff.endswith("[diff truncated]")
+    assert len(diff) <= 100 + len("[diff truncated]")
+
+
+@patch("commizard.git_utils.write_snapshot_tree", return_value=None)
+@patch("commizard.git_utils.diff_args")
+def test_get_clean_diff_git_error(mock_args, mock_tree, git_repo):
+    (git_repo / "file.txt").write_text("changed\n")
+    mock_args.return_value = ["diff", "--no-such-option"]
+    assert git_utils.get_clean_diff() == ""
+
+
+def test_repo_paths(git_repo):
+    paths = git_utils.repo_paths()
+    assert paths["toplevel"] == git_repo.resolve()
+    assert paths["index"] == git_repo.resolve() / ".git" / "index"
+    # looked up once per session
+    with patch("commizard.git_utils.run_git_command") as mock_run:
+        assert git_utils.repo_paths() is paths
+        mock_run.assert_not_called()
+
+
+@patch("commizard.git_utils.run_git_command")
+def test_repo_paths_outside_repo(mock_run, monkeypatch):
+    monkeypatch.setattr(git_utils, "_repo_paths", None)
+    mock_run.return_value = subprocess.CompletedProcess(
+        args=[], returncode=128, stdout="", stderr="fatal"
+    )
+    assert git_utils.repo_paths() is None
+    assert git_utils.repo_fingerprint() is None
+
+
+def test_repo_fingerprint(git_repo, monkeypatch):
+    monkeypatch.setattr(git_utils, "racy_window_ns", 0)
+    (git_repo / "other.txt").write_text("other\n")
+    subprocess.run(["git", "add", "other.txt"], check=True)
+    first = git_utils.repo_fingerprint()
+    assert first is not None
+    assert git_utils.repo_fingerprint() == first
+
+    (git_repo / "file.txt").write_text("hello there\n")
+    second = git_utils.repo_fingerprint()
+    assert second != first
+    # a file that was clean until now counts too
+    (git_repo / "other.txt").write_text("edited\n")
+    third = git_utils.repo_fingerprint()
+    assert third not in (first, second)
+    (git_repo / "file.txt").write_text("hello again\n")
+    assert git_utils.repo_fingerprint() != third
+    # the staged diff doesn't depend on unstaged edits
+    staged = git_utils.repo_fingerprint(worktree=False)
+    (git_repo / "other.txt").write_text("edited again\n")
+    assert git_utils.repo_fingerprint(worktree=False) == staged
+
+    subprocess.run(["git", "commit", "-qam", "second"], check=True)
+    assert git_utils.repo_fingerprint() not in (first, second, third)
+
+
+def test_get_snapshot_sees_new_edits(git_repo, monkeypatch):
+    monkeypatch.setattr(git_utils, "racy_window_ns", 0)
+    (git_repo / "b.txt").write_text("b\n")
+    subprocess.run(["git", "add", "b.txt"], check=True)
+    subprocess.run(["git", "commit", "-qm", "add b"], check=True)
+    (git_repo / "file.txt").write_text("hello\nworld\n")
+    snap = git_utils.get_snapshot()
+    assert [f.path for f in snap.files] == ["file.txt"]
+    with patch("commizard.git_utils.take_snapshot") as mock_take:
+        assert git_utils.get_snapshot() is snap
+        mock_take.assert_not_called()
+
+    (git_repo / "b.txt").write_text("b\nmore\n")
+    snap = git_utils.get_snapshot()
+    assert [f.path for f in snap.files] == ["b.txt", "file.txt"]
+    assert git_utils.commit_snapshot(snap, "Edit both")[0] == 0
+    assert git_out("show", "--name-only", "--format=") == "b.txt\nfile.txt"
+
+
+def test_repo_fingerprint_racy(git_repo):
+    # everything in the fixture was written just now
+    assert git_utils.repo_fingerprint() is None
+
+
+def test_get_diff_files_cached(git_repo, monkeypatch):
+    monkeypatch.setattr(git_utils, "racy_window_ns", 0)
+    (git_repo / "file.txt").write_text("hello\nworld\n")
+    files = git_utils.get_diff_files()
+    assert [f.path for f in files] == ["file.txt"]
+
+    # a repeated call doesn't diff again
+    with patch("commizard.git_utils.take_snapshot") as mock_take:
+        assert git_utils.get_diff_files() is files
+        mock_take.assert_not_called()
+
+    (git_repo / "file.txt").write_text("hello\nworld\nagain\n")
+    assert git_utils.get_diff_files() is not files
+    assert len(git_utils.diff_cache) == 2
+
+    git_utils.clear_diff_cache()
+    assert len(git_utils.diff_cache) == 0
+
+
+def test_diff_cache_eviction(git_repo, monkeypatch):
+    monkeypatch.setattr(git_utils, "racy_window_ns", 0)
+    monkeypatch.setattr(git_utils, "diff_cache_size", 2)
+    for i in range(4):
+        (git_repo / "file.txt").write_text("x" * (i + 1))
+        git_utils.get_diff_files()
+    assert len(git_utils.diff_cache) == 2
+
+
+@pytest.mark.parametrize(
+    "stdout, returncode, expected",
+    [
+        ("", 0, []),
+        ("3\t1\tsrc/a.py\0", 0, [(3, 1, "src/a.py", "src/a.py")]),
+        (
+            "-\t-\tlogo.png\x002\t0\tweird\tname.txt\0",
+            0,
+            [
+                (-1, -1, "logo.png", "logo.png"),
+                (2, 0, "weird\tname.txt", "weird\tname.txt"),
+            ],
+        ),
+        # renames carry the old and new paths in their own fields
+        ("1\t1\t\0old.py\0new.py\0", 0, [(1, 1, "new.py", "old.py")]),
+        ("", 128, None),
+    ],
+)
+@patch("commizard.git_utils.run_git_command")
+def test_numstat(mock_run, stdout, returncode, expected):
+    mock_run.return_value = subprocess.CompletedProcess(
+        args=[], returncode=returncode, stdout=stdout, stderr=""
+    )
+    assert git_utils.numstat(["diff"]) == expected
+    mock_run.assert_called_once_with(["diff", "--numstat", "-z"])
+
+
+def test_check_attrs(git_repo):
+    (git_repo / ".gitattributes").write_text(
+        "gen/** linguist-generated\n*.dat -diff\nkeep.py linguist-vendored=false\n"
+    )
+    attrs = git_utils.check_attrs(["gen/x.py", "a.dat", "keep.py", "src.py"])
+    assert attrs == {
+        "gen/x.py": {"linguist-generated": "set"},
+        "a.dat": {"diff": "unset"},
+        "keep.py": {"linguist-vendored": "false"},
+    }
+    assert git_utils.check_attrs([]) == {}
+
+
+@pytest.mark.parametrize(
+    "path, attrs, binary, expected",
+    [
+        ("src/app.py", {}, False, None),
+        ("logo.png", {}, True, "binary"),
+        ("data.bin", {"diff": "unset"}, False, "binary"),
+        ("api/schema.py", {"linguist-generated": "set"}, False, "generated"),
+        ("api/schema.py", {"linguist-generated": "true"}, False, "generated"),
+        ("lib/x.py", {"linguist-vendored": "set"}, False, "vendored"),
+        ("web/package-lock.json", {}, False, "lockfile"),
+        ("Cargo.lock", {}, False, "lockfile"),
+        ("static/app.min.js", {}, False, "generated"),
+        ("vendor/github.com/x/y.go", {}, False, "vendored"),
+        ("web/node_modules/left-pad/index.js", {}, False, "vendored"),
+        # a file that just happens to be called "vendor"
+        ("docs/vendor", {}, False, None),
+    ],
+)
+def test_skip_reason(path, attrs, binary, expected):
+    assert git_utils.skip_reason(path, attrs, binary) == expected
+
+
+def test_read_diff_files_skips(git_repo, monkeypatch):
+    (git_repo / "package-lock.json").write_text("{}\n")
+    (git_repo / "schema.py").write_text("x = 1\n")
+    (git_repo / ".gitattributes").write_text("schema.py linguist-generated\n")
+    subprocess.run(["git", "add", "."], check=True)
+    subprocess.run(["git", "commit", "-qm", "more"], check=True)
+    (git_repo / "package-lock.json").write_text("{\n" + "1,\n" * 50 + "}\n")
+    (git_repo / "schema.py").write_text("x = 2\n")
+    (git_repo / "file.txt").write_text("hello\nworld\n")
+
+    # the skipped files' text is never read from git
+    streamed = []
+    real_stream = git_utils.GitStream
+
+    def spy(args):
+        streamed.append(args)
+        return real_stream(args)
+
+    monkeypatch.setattr(git_utils, "GitStream", spy)
+    files = git_utils.read_diff_files(git_utils.diff_args())
+    assert [(f.path, f.skipped) for f in files] == [
+        ("file.txt", None),
+        ("package-lock.json", "lockfile"),
+        ("schema.py", "generated"),
+    ]
+    assert ":(top,exclude,literal)package-lock.json" in streamed[0]
+    assert files[1].counts == (52, 1)
+    assert git_utils.skipped_savings(files) == (2, 55 * 40, 55 * 10)
+
+    # everything is rendered, the skipped files as one line each
+    rendered = git_utils.diff_parser.render(files)
+    assert "package-lock.json | +52 -1 (lockfile, not shown)" in rendered
+
+    # the long-command-line fallback drops them after reading
+    monkeypatch.setattr(git_utils, "max_pathspec_chars", 0)
+    again = git_utils.read_diff_files(git_utils.diff_args())
+    assert [(f.path, f.skipped) for f in again] == [
+        (f.path, f.skipped) for f in files
+    ]
+
+    monkeypatch.setattr(git_utils, "skip_generated", False)
+    files = git_utils.read_diff_files(git_utils.diff_args())
+    assert [f.skipped for f in files] == [None, None, None]
+
+
+def test_read_diff_files_skips_renamed(git_repo, monkeypatch):
+    monkeypatch.setattr(git_utils, "staged_only", True)
+    (git_repo / "package-lock.json").write_text("1,\n" * 300)
+    subprocess.run(["git", "add", "."], check=True)
+    subprocess.run(["git", "commit", "-qm", "lock"], check=True)
+    (git_repo / "web").mkdir()
+    subprocess.run(
+        ["git", "mv", "package-lock.json", "web/package-lock.json"],
+        check=True,
+    )
+    (git_repo / "file.txt").write_text("hello\nworld\n")
+    subprocess.run(["git", "add", "file.txt"], check=True)
+
+    for chars in (git_utils.max_pathspec_chars, 0):
+        monkeypatch.setattr(git_utils, "max_pathspec_chars", chars)
+        files = git_utils.read_diff_files(git_utils.diff_args())
+        # the old name doesn't come back as a deletion of the whole file
+        assert [(f.old_path, f.path, f.skipped) for f in files] == [
+            ("file.txt", "file.txt", None),
+            ("package-lock.json", "web/package-lock.json", "lockfile"),
+        ]
+
+
+def test_read_diff_files_all_skipped(git_repo, monkeypatch):
+    (git_repo / "logo.png").write_bytes(b"\x89PNG\0\0")
+    subprocess.run(["git", "add", "."], check=True)
+    subprocess.run(["git", "commit", "-qm", "logo"], check=True)
+    (git_repo / "logo.png").write_bytes(b"\x89PNG\0\1")
+    monkeypatch.setattr(git_utils, "GitStream", None)
+    (file,) = git_utils.read_diff_files(git_utils.diff_args())
+    assert (file.path, file.skipped, file.binary) == (
+        "logo.png",
+        "binary",
+        True,
+    )
+    assert git_utils.skipped_savings([file]) == (1, 0, 0)
+    assert (
+        git_utils.diff_parser.render([file]) == "logo.png | binary (not shown)"
+    )
+
+
+@patch("commizard.git_utils.numstat")
+def test_read_diff_files_no_changes(mock_numstat):
+    mock_numstat.return_value = []
+    assert git_utils.read_diff_files(["diff"]) == []
+    mock_numstat.return_value = None
+    assert git_utils.read_diff_files(["diff"]) == []
+
+
+def test_staged_only(git_repo, monkeypatch):
+    monkeypatch.setattr(git_utils, "staged_only", True)
+    monkeypatch.setattr(git_utils, "racy_window_ns", 0)
+    assert git_utils.diff_args()[-1] == "--cached"
+    (git_repo / "file.txt").write_text("unstaged\n")
+    (git_repo / "new.txt").write_text("staged\n")
+    subprocess.run(["git", "add", "new.txt"], check=True)
+
+    files = git_utils.get_diff_files()
+    assert [f.path for f in files] == ["new.txt"]
+
+    # working tree edits don't invalidate a diff of the index...
+    (git_repo / "file.txt").write_text("unstaged, again\n")
+    assert git_utils.get_diff_files() is files
+    # ...but staging does
+    subprocess.run(["git", "add", "file.txt"], check=True)
+    assert [f.path for f in git_utils.get_diff_files()] == [
+        "file.txt",
+        "new.txt",
+    ]
+
+    code, _ = git_utils.commit("staged only")
+    assert code == 0
+    assert git_utils.get_diff_files() == []
+
+
+def git_out(*args):
+    return subprocess.run(  # noqa: S603
+        ["git", *args], capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+
+def test_snapshot_commit(git_repo, monkeypatch):
+    monkeypatch.setattr(git_utils, "racy_window_ns", 0)
+    head = git_out("rev-parse", "HEAD")
+    (git_repo / "file.txt").write_text("hello\nworld\n")
+    (git_repo / "untracked.txt").write_text("not committed\n")
+    index_before = (git_repo / ".git" / "index").read_bytes()
+
+    snap = git_utils.get_snapshot()
+    assert snap.parent == head
+    assert [f.path for f in snap.files] == ["file.txt"]
+    # the real index is left alone, and no temporary index is left behind
+    assert (git_repo / ".git" / "index").read_bytes() == index_before
+    assert not list((git_repo / ".git").glob("commizard-index-*"))
+
+    # edits made after gen don't sneak into the commit
+    (git_repo / "file.txt").write_text("hello\nworld\nlater\n")
+    code, out = git_utils.commit_snapshot(snap, "Add world\n\nBody")
+    assert code == 0
+    new = git_out("rev-parse", "HEAD")
+    assert out == f"[{new[:7]}] Add world"
+    assert git_out("rev-parse", "HEAD^") == head
+    assert git_out("log", "-1", "--format=%B") == "Add world\n\nBody"
+    assert git_out("show", "HEAD:file.txt") == "hello\nworld"
+    assert "commit: Add world" in git_out("reflog", "-1")
+    # the index follows the commit, the later edit stays unstaged
+    assert git_out("diff", "--cached", "--name-only") == ""
+    assert git_out("diff", "--name-only") == "file.txt"
+    assert git_utils.diff_cache == OrderedDict()
+
+    # the snapshot is stale once HEAD moved
+    code, out = git_utils.commit_snapshot(snap, "Again")
+    assert code == 1
+    assert git_out("rev-parse", "HEAD") == new
+
+
+def test_snapshots_in_parallel(git_repo):
+    (git_repo / "file.txt").write_text("hello\nworld\n")
+    expected = git_utils.take_snapshot().tree
+    # the watcher thread and gen each build the tree in their own index
+    with ThreadPoolExecutor(8) as pool:
+        trees = list(
+            pool.map(lambda _: git_utils.take_snapshot().tree, range(16))
+        )
+    assert trees == [expected] * 16
+    assert not list((git_repo / ".git").glob("commizard-index-*"))
+
+
+def test_snapshot_commit_staged(git_repo, monkeypatch):
+    monkeypatch.setattr(git_utils, "staged_only", True)
+    (git_repo / "file.txt").write_text("unstaged\n")
+    (git_repo / "new.txt").write_text("staged\n")
+    subprocess.run(["git", "add", "new.txt"], check=True)
+
+    snap = git_utils.get_snapshot()
+    assert [f.path for f in snap.files] == ["new.txt"]
+    assert git_utils.commit_snapshot(snap, "Add new")[0] == 0
+    assert git_out("show", "--name-only", "--format=") == "new.txt"
+    assert git_out("status", "--porcelain") == "M file.txt"
+
+
+def test_snapshot_first_commit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(git_utils, "_repo_paths", None)
+    monkeypatch.setattr(git_utils, "diff_cache", OrderedDict())
+    monkeypatch.setattr(git_utils, "staged_only", True)
+    subprocess.run(["git", "init", "-q"], check=True)
+    subprocess.run(["git", "config", "user.email", "w@example.com"], check=True)
+    subprocess.run(["git", "config", "user.name", "Wizard"], check=True)
+    (tmp_path / "a.txt").write_text("first\n")
+    subprocess.run(["git", "add", "a.txt"], check=True)
+    try:
+        snap = git_utils.get_snapshot()
+        assert snap.parent is None
+        assert [f.path for f in snap.files] == ["a.txt"]
+        assert git_utils.commit_snapshot(snap, "Initial commit")[0] == 0
+        assert git_out("log", "--format=%s") == "Initial commit"
+    finally:
+        git_utils.close_workers()
+
+
+def test_snapshot_commit_hooks(git_repo):
+    hook = git_repo / ".git" / "hooks" / "commit-msg"
+    hook.parent.mkdir(exist_ok=True)
+    hook.write_text('#!/bin/sh\necho "Signed-off-by: Hook" >> "$1"\n')
+    hook.chmod(0o755)
+    assert git_utils.has_commit_hooks()
+
+    (git_repo / "file.txt").write_text("hooked\n")
+    snap = git_utils.get_snapshot()
+    (git_repo / "file.txt").write_text("hooked, then edited\n")
+    code, _ = git_utils.commit_snapshot(snap, "Hooked")
+    assert code == 0
+    assert git_out("log", "-1", "--format=%B").endswith("Signed-off-by: Hook")
+    assert git_out("show", "HEAD:file.txt") == "hooked"
+    assert git_out("diff", "--cached", "--name-only") == ""
+
+
+@pytest.mark.parametrize("staged_only", [False, True])
+def test_snapshot_pathspecs(git_repo, monkeypatch, staged_only):
+    monkeypatch.setattr(git_utils, "staged_only", staged_only)
+    billing = git_repo / "services" / "billing"
+    billing.mkdir(parents=True)
+    (billing / "invoice.py").write_text("total = 1\n")
+    (billing / "old.py").write_text("gone\n")
+    subprocess.run(["git", "add", "."], check=True)
+    subprocess.run(["git", "commit", "-qm", "billing"], check=True)
+    head = git_out("rev-parse", "HEAD")
+
+    (billing / "invoice.py").write_text("total = 2\n")
+    (git_repo / "file.txt").write_text("unrelated\n")
+    (billing / "new.py").write_text("new\n")
+    subprocess.run(
+        ["git", "add", "file.txt", "services/billing/new.py"], check=True
+    )
+    subprocess.run(["git", "rm", "-q", "services/billing/old.py"], check=True)
+
+    snap = git_utils.get_snapshot(["services/billing"])
+    assert snap.pathspecs == ("services/billing",)
+    expected = ["services/billing/new.py", "services/billing/old.py"]
+    if not staged_only:
+        expected.insert(0, "services/billing/invoice.py")
+    assert sorted(f.path for f in snap.files) == expected
+
+    assert git_utils.commit_snapshot(snap, "Bill")[0] == 0
+    assert git_out("diff", "--name-only", head, "HEAD").split() == expected
+    # the unrelated staged change is still staged, and nothing else moved
+    assert git_out("diff", "--cached", "--name-only") == "file.txt"
+    unstaged = "services/billing/invoice.py" if staged_only else ""
+    assert git_out("diff", "--name-only") == unstaged
+
+
+@patch("commizard.git_utils.run_git_command")
+def test_commit_pathspecs(mock_run):
+    mock_run.return_value.stdout = "done"
+    git_utils.commit("msg", ["a.py", "b/"])
+    mock_run.assert_called_once_with(
+        ["commit", "-m", "msg", "--", "a.py", "b/"]
+    )
+
+
+@patch("commizard.git_utils.write_snapshot_tree", return_value=None)
+def test_snapshot_pathspecs_fallback(mock_tree, git_repo):
+    (git_repo / "file.txt").write_text("changed\n")
+    (git_repo / "other.txt").write_text("new\n")
+    subprocess.run(["git", "add", "other.txt"], check=True)
+    assert [f.path for f in git_utils.get_diff_files(["file.txt"])] == [
+        "file.txt"
+    ]
+    assert git_utils.get_diff_files(["other.txt"]) == []
+
+
+@patch("commizard.git_utils.commit")
+def test_snapshot_without_tree(mock_commit):
+    snap = git_utils.Snapshot(None, "abc", [])
+    mock_commit.return_value = (0, "done")
+    assert git_utils.commit_snapshot(snap, "msg") == (0, "done")
+    mock_commit.assert_called_once_with("msg", ())
+
+
+@pytest.mark.parametrize(
+    "files, workers, shards",
+    [(10, 4, 1), (600, 1, 1), (600, 2, 2), (600, 3, 3), (600, 16, 3)],
+)
+def test_shard_paths(files, workers, shards, monkeypatch):
+    monkeypatch.setattr(git_utils, "diff_workers", workers)
+    stats = [(1, 0, f"f{i:03}", f"f{i:03}") for i in range(files)]
+    result = git_utils.shard_paths(stats)
+    assert len(result) == shards
+    if shards > 1:
+        # contiguous runs, in git's order
+        assert [spec for shard in result for spec in shard] == [
+            f":(top,literal)f{i:03}" for i in range(files)
+        ]
+
+
+def test_shard_paths_long_pathspecs(monkeypatch):
+    monkeypatch.setattr(git_utils, "diff_workers", 2)
+    monkeypatch.setattr(git_utils, "min_shard_files", 1)
+    monkeypatch.setattr(git_utils, "max_pathspec_chars", 100)
+    stats = [(1, 0, "x" * 30, "x" * 30)] * 10 + [(1, 1, "new", "old")]
+    shards = git_utils.shard_paths(stats)
+    assert len(shards) > 2
+    assert shards[-1][-2:] == [":(top,literal)old", ":(top,literal)new"]
+
+
+def test_read_diff_files_parallel(git_repo, monkeypatch):
+    for i in range(12):
+        (git_repo / f"f{i:02}.txt").write_text(f"file {i}\n")
+    (git_repo / "moved.txt").write_text("".join(f"{i}\n" for i in range(20)))
+    subprocess.run(["git", "add", "."], check=True)
+    subprocess.run(["git", "commit", "-qm", "more"], check=True)
+    for i in range(12):
+        (git_repo / f"f{i:02}.txt").write_text(f"file {i}, changed\n")
+    subprocess.run(["git", "mv", "moved.txt", "renamed.txt"], check=True)
+    args = [*git_utils.diff_args(), "HEAD"]
+
+    serial = diff_parser.render(git_utils.read_diff_files(args))
+    monkeypatch.setattr(git_utils, "diff_workers", 4)
+    monkeypatch.setattr(git_utils, "min_shard_files", 2)
+    with patch(
+        "commizard.git_utils.read_shards", wraps=git_utils.read_shards
+    ) as mock_shards:
+        parallel = diff_parser.render(git_utils.read_diff_files(args))
+    assert len(mock_shards.call_args.args[1]) == 4
+    assert parallel == serial
+    assert "rename from moved.txt" in parallel
+
+    monkeypatch.setattr(git_utils, "max_diff_chars", 200)
+    capped = diff_parser.render(git_utils.read_diff_files(args))
+    assert capped.endswith("[diff truncated]")
+    assert len(capped) <= 200 + len("[diff truncated]")
+
+
+def test_read_shards_git_error(git_repo, monkeypatch):
+    shards = [[":(top,literal)file.txt"], [":(top,literal)file.txt"]]
+    assert git_utils.read_shards(["diff", "--no-such-option"], shards) is None
+
+
+def test_trim():
+    (file,) = diff_parser.parse_diff(
+        ["--- a/f", "+++ b/f", "@@ -1,2 +1,2 @@", "-old", "+new", "@@ -9 +9 @@"]
+    )
+    assert git_utils.trim_file(file, 1000) == 54
+    assert not file.truncated
+    assert git_utils.trim_file(file, 40) == 37
+    assert file.truncated
+    assert file.hunks[0].lines == ["-old"]
+    assert (file.added, file.removed) == (0, 1)
+    assert git_utils.trim_file(file, 5) == 0
+    assert file.headers == []
+    assert file.hunks == []
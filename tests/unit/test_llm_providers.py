@@ -1,3 +1,10 @@
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import ClassVar
 from unittest.mock import MagicMock, Mock, patch
 
 import pytest
@@ -84,8 +91,8 @@ def test_http_response(
         ("FOO", None, None, None, None, ValueError),
     ],
 )
-@patch("requests.get")
-@patch("requests.post")
+@patch("requests.Session.get")
+@patch("requests.Session.post")
 def test_http_request(
     mock_post,
     mock_get,
@@ -127,55 +134,123 @@ def test_http_request(
         assert result.return_code == expected_code
 
 
-@patch("commizard.llm_providers.list_locals")
-def test_init_model_list(mock_list, monkeypatch):
-    monkeypatch.setattr(llm, "available_models", None)
-    llm.init_model_list()
-    mock_list.assert_called_once()
+def tags_response(*models):
+    return llm.HttpResponse({"models": list(models)}, 200)
 
 
 @pytest.mark.parametrize(
-    "is_error, response, expected_result, expect_error",
+    "response, expected",
     [
-        # http_request returns error
-        (True, None, [], True),
-        # http_request succeeds with models
+        (llm.HttpResponse(None, -1), None),
+        (llm.HttpResponse("not json", 500), None),
+        (tags_response(), []),
         (
-            False,
-            {"models": [{"name": "model1"}, {"name": "model2"}]},
+            tags_response({"name": "model1"}, {"name": "model2"}),
             ["model1", "model2"],
-            False,
         ),
-        # http_request succeeds but no models
-        (False, {"models": []}, [], False),
+        (tags_response({"size": 1}), None),
     ],
+    ids=["error", "not_json", "empty", "models", "malformed"],
 )
 @patch("commizard.llm_providers.http_request")
-def test_list_locals(
-    mock_http_request,
-    is_error,
-    response,
-    expected_result,
-    expect_error,
-):
-    fake_response = Mock()
-    fake_response.is_error.return_value = is_error
-    fake_response.response = response
-    mock_http_request.return_value = fake_response
+def test_catalog_names(mock_http_request, response, expected):
+    mock_http_request.return_value = response
+    assert llm.catalog.names() == expected
+    mock_http_request.assert_called_once_with(
+        "GET", "http://localhost:11434/api/tags"
+    )
 
-    result = llm.list_locals()
-    if expect_error:
-        assert result is None
-    else:
-        assert result == expected_result
+
+@patch("commizard.llm_providers.http_request")
+def test_catalog_model_info(mock_http_request):
+    mock_http_request.return_value = tags_response(
+        {
+            "name": "llama3:8b",
+            "digest": "sha256:a",
+            "size": 4661224676,
+            "details": {"parameter_size": "8.0B", "quantization_level": "Q4_0"},
+        },
+        {"name": "bare"},
+    )
+    info = llm.catalog.get("llama3:8b")
+    assert (info.digest, info.size) == ("sha256:a", 4661224676)
+    assert (info.parameter_size, info.quantization) == ("8.0B", "Q4_0")
+    bare = llm.catalog.get("bare")
+    assert (bare.digest, bare.size, bare.parameter_size) == ("", 0, "")
+    assert llm.catalog.get("missing") is None
+    mock_http_request.assert_called_once()
+
+
+@patch("commizard.llm_providers.http_request")
+def test_catalog_serves_stale_while_refreshing(mock_http_request):
+    catalog = llm.ModelCatalog(ttl=60.0)
+    mock_http_request.return_value = tags_response({"name": "old"})
+    assert catalog.names() == ["old"]
+    # within the TTL nothing is fetched
+    assert catalog.names() == ["old"]
+    assert mock_http_request.call_count == 1
+
+    release = threading.Event()
+
+    def slow_tags(*args):
+        release.wait(1)
+        return tags_response({"name": "new"})
+
+    mock_http_request.side_effect = slow_tags
+    catalog.ttl = 0.0
+    # stale: the old list comes back at once, a refresh starts behind it
+    assert catalog.names() == ["old"]
+    refresher = catalog.refresh_async()
+    # a second stale read doesn't start another refresh
+    assert catalog.names() == ["old"]
+    assert catalog.refresh_async() is refresher
+    release.set()
+    refresher.join()
+    assert mock_http_request.call_count == 2
+    catalog.ttl = 60.0
+    assert catalog.names() == ["new"]
+
+
+@patch("commizard.llm_providers.http_request")
+def test_catalog_keeps_list_when_refresh_fails(mock_http_request):
+    catalog = llm.ModelCatalog()
+    mock_http_request.return_value = tags_response({"name": "a"})
+    assert catalog.refresh() is True
+    mock_http_request.return_value = llm.HttpResponse(None, -4)
+    assert catalog.refresh() is False
+    assert catalog.names() == ["a"]
+
+
+@patch("commizard.llm_providers.http_request")
+def test_catalog_first_lookup_waits_for_refresh(mock_http_request):
+    catalog = llm.ModelCatalog()
+    started = threading.Event()
+
+    def slow_tags(*args):
+        started.set()
+        time.sleep(0.05)
+        return tags_response({"name": "a"})
+
+    mock_http_request.side_effect = slow_tags
+    catalog.refresh_async()
+    assert started.wait(1)
+    # nothing to serve yet, so it joins the refresh instead of sending another
+    assert catalog.names() == ["a"]
     mock_http_request.assert_called_once()
 
 
 @pytest.mark.parametrize(
-    "is_error, response, expect_error, expected_result",
+    "is_error, return_code, response, expect_error, expected_result",
     [
-        (True, None, True, {}),
-        (False, {"done_reason": "load"}, False, {"done_reason": "load"}),
+        (True, -1, None, "Failed to load test_model. Is ollama running?", {}),
+        (
+            False,
+            404,
+            {"error": "model 'patched_model' not found"},
+            llm.get_error_message(404),
+            {},
+        ),
+        (False, 200, {"done_reason": "load"}, None, {"done_reason": "load"}),
     ],
 )
 @patch("commizard.llm_providers.output.print_error")
@@ -185,26 +260,31 @@ def test_load_model(
     mock_print_error,
     monkeypatch,
     is_error,
+    return_code,
     response,
     expect_error,
     expected_result,
 ):
     fake_response = Mock()
     fake_response.is_error.return_value = is_error
+    fake_response.return_code = return_code
     fake_response.response = response
     mock_http_request.return_value = fake_response
     monkeypatch.setattr(llm, "selected_model", "patched_model")
+    monkeypatch.setitem(llm.context_limits, "patched_model", None)
     result = llm.load_model("test_model")
 
     mock_http_request.assert_called_once_with(
         "POST",
         "http://localhost:11434/api/generate",
-        json={"model": "patched_model"},
+        json={
+            "model": "patched_model",
+            "keep_alive": llm.keep_alive,
+            "options": {"num_ctx": 8192},
+        },
     )
     if expect_error:
-        mock_print_error.assert_called_once_with(
-            "Failed to load test_model. Is ollama running?"
-        )
+        mock_print_error.assert_called_once_with(expect_error)
     else:
         mock_print_error.assert_not_called()
     assert result == expected_result
@@ -301,13 +381,21 @@ def test_generate(
     mock_http_request.return_value = fake_response
 
     monkeypatch.setattr(llm, "selected_model", "mymodel")
+    monkeypatch.setitem(llm.context_limits, "mymodel", None)
 
     result = llm.generate("Test prompt")
 
     mock_http_request.assert_called_once_with(
         "POST",
         "http://localhost:11434/api/generate",
-        json={"model": "mymodel", "prompt": "Test prompt", "stream": False},
+        json={
+            "model": "mymodel",
+            "system": llm.generation_prompt,
+            "prompt": "Test prompt",
+            "keep_alive": llm.keep_alive,
+            "options": {"num_predict": llm.max_new_tokens, "num_ctx": 8192},
+            "stream": False,
+        },
     )
     assert result == expected
 
@@ -337,3 +425,1360 @@ def test_select_model(
         mock_print.assert_called_once_with(f"{llm.selected_model} loaded.")
     else:
         mock_print.assert_not_called()
+
+
+def stream_response(status, lines):
+    resp = MagicMock()
+    resp.status_code = status
+    resp.iter_lines.return_value = [line.encode() for line in lines]
+    resp.__enter__.return_value = resp
+    return resp
+
+
+@pytest.mark.parametrize(
+    "status, lines, expected, tokens",
+    [
+        (
+            200,
+            [
+                '{"response": "Fix ", "done": false}',
+                "",
+                '{"response": "parser", "done": false}',
+                '{"response": "", "done": true, "eval_count": 2}',
+                '{"response": "ignored"}',
+            ],
+            (0, "Fix parser"),
+            ["Fix ", "parser"],
+        ),
+        (
+            200,
+            ['{"response": "Fix"}', '{"error": "model crashed"}'],
+            (1, "model crashed"),
+            ["Fix"],
+        ),
+        (200, ["not json"], (1, "the server sent a malformed response"), []),
+        (404, [], (404, llm.get_error_message(404)), []),
+    ],
+)
+@patch("requests.Session.post")
+def test_generate_stream(
+    mock_post, status, lines, expected, tokens, monkeypatch
+):
+    mock_post.return_value = stream_response(status, lines)
+    monkeypatch.setattr(llm, "selected_model", "mymodel")
+    monkeypatch.setitem(llm.context_limits, "mymodel", None)
+    seen = []
+
+    assert llm.generate("Test prompt", seen.append) == expected
+
+    assert seen == tokens
+    mock_post.assert_called_once_with(
+        "http://localhost:11434/api/generate",
+        json={
+            "model": "mymodel",
+            "system": llm.generation_prompt,
+            "prompt": "Test prompt",
+            "keep_alive": llm.keep_alive,
+            "options": {"num_predict": llm.max_new_tokens, "num_ctx": 8192},
+            "stream": True,
+        },
+        stream=True,
+        timeout=llm.timeouts["/api/generate"],
+    )
+
+
+@patch("requests.Session.post")
+def test_generate_stream_connection_error(mock_post):
+    mock_post.side_effect = requests.ConnectionError
+    assert llm.generate("prompt", print) == (1, "can't connect to the server")
+
+
+class StubInference(BaseHTTPRequestHandler):
+    """
+    A fake inference server: answers each path with a canned (status, body)
+    from ``routes`` after ``delay`` seconds, and records what it was sent.
+    Each server started by stub_hosts gets its own subclass.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # like Ollama (Go sets TCP_NODELAY), or keep-alive hits delayed ACKs
+    disable_nagle_algorithm = True
+    routes: ClassVar[dict] = {}
+    # (path, JSON body, Authorization header) of each request
+    received: ClassVar[list] = []
+    delay = 0.0
+    # TCP connections accepted
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def answer(self, body):
+        time.sleep(self.delay)
+        self.received.append(
+            (self.path, body, self.headers.get("Authorization"))
+        )
+        status, text = self.routes.get(self.path, (404, "404 page not found"))
+        data = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.answer(None)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.answer(json.loads(self.rfile.read(length)))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_hosts():
+    """
+    Start stub inference servers on their own ports: call it with each
+    server's routes (and how long it takes to answer), get back its host
+    and handler class, whose ``received`` lists what it was sent.
+    """
+    servers = []
+    llm.close_session()
+
+    def start(routes, delay=0.0):
+        handler = type(
+            "StubHost",
+            (StubInference,),
+            {"routes": routes, "received": [], "delay": delay},
+        )
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(
+            target=server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+        servers.append(server)
+        return f"127.0.0.1:{server.server_address[1]}", handler
+
+    yield start
+    llm.close_session()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def ollama_routes(answer="ok", models=("llama3",), generate_status=200):
+    tags = {"models": [{"name": name} for name in models]}
+    return {
+        "/api/version": (200, '{"version": "0.12.0"}'),
+        "/api/tags": (200, json.dumps(tags)),
+        "/api/generate": (generate_status, json.dumps({"response": answer})),
+    }
+
+
+def unused_port():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubInference)
+    port = server.server_address[1]
+    server.server_close()
+    return f"127.0.0.1:{port}"
+
+
+def test_session_keeps_connections_alive(stub_hosts):
+    host, stub = stub_hosts({"/api/version": (200, '{"version": "0.0.0"}')})
+    for _ in range(5):
+        r = llm.http_request("GET", f"http://{host}/api/version")
+        assert r.response == {"version": "0.0.0"}
+    assert stub.connections == 1
+
+    # closing drops the pool, the next request connects again
+    session = llm.get_session()
+    llm.close_session()
+    llm.close_session()
+    assert llm.get_session() is not session
+    llm.http_request("GET", f"http://{host}/api/version")
+    assert stub.connections == 2
+
+
+def test_session_pools_every_host(stub_hosts, monkeypatch):
+    servers = [stub_hosts(ollama_routes()) for _ in range(3)]
+    pool = llm.make_provider({"hosts": [host for host, _ in servers]})
+    monkeypatch.setattr(llm, "provider", pool)
+    for _ in range(3):
+        for host, _ in servers:
+            llm.http_request("GET", f"http://{host}/api/version")
+    assert [stub.connections for _, stub in servers] == [1, 1, 1]
+
+
+def test_get_session_threads():
+    llm.close_session()
+    with ThreadPoolExecutor(8) as pool:
+        sessions = set(pool.map(lambda _: llm.get_session(), range(32)))
+    assert len(sessions) == 1
+    llm.close_session()
+
+
+@pytest.mark.parametrize(
+    "url, expected",
+    [
+        ("http://localhost:11434/api/version", (0.3, 2.0)),
+        ("http://localhost:11434/api/tags", (1.0, 5.0)),
+        ("http://localhost:11434/api/generate", (2.0, 600.0)),
+        ("http://localhost:11434/api/ps", llm.default_timeout),
+    ],
+)
+def test_endpoint_timeout(url, expected):
+    assert llm.endpoint_timeout(url) == expected
+
+
+@patch("requests.Session.get")
+def test_http_request_timeout(mock_get):
+    mock_get.return_value.status_code = 200
+    llm.http_request("GET", "http://localhost:11434/api/tags")
+    mock_get.assert_called_once_with(
+        "http://localhost:11434/api/tags", timeout=llm.timeouts["/api/tags"]
+    )
+    mock_get.reset_mock()
+    llm.http_request("GET", "http://localhost:11434/api/tags", timeout=9)
+    mock_get.assert_called_once_with(
+        "http://localhost:11434/api/tags", timeout=9
+    )
+
+
+@pytest.mark.parametrize(
+    "env, expected", [(None, 4), ("2", 2), ("0", 1), ("many", 4)]
+)
+def test_parallel_requests(env, expected, monkeypatch):
+    if env is None:
+        monkeypatch.delenv("OLLAMA_NUM_PARALLEL", raising=False)
+    else:
+        monkeypatch.setenv("OLLAMA_NUM_PARALLEL", env)
+    assert llm.parallel_requests() == expected
+
+
+@patch("commizard.llm_providers.http_request")
+def test_generate_options(mock_http_request, monkeypatch):
+    mock_http_request.return_value = llm.HttpResponse({"response": "ok"}, 200)
+    monkeypatch.setattr(llm, "selected_model", "mymodel")
+    monkeypatch.setitem(llm.context_limits, "mymodel", None)
+    assert llm.generate("prompt", options={"seed": 7}) == (0, "ok")
+    mock_http_request.assert_called_once_with(
+        "POST",
+        "http://localhost:11434/api/generate",
+        json={
+            "model": "mymodel",
+            "system": llm.generation_prompt,
+            "prompt": "prompt",
+            "keep_alive": llm.keep_alive,
+            "options": {"seed": 7, "num_predict": 512, "num_ctx": 8192},
+            "stream": False,
+        },
+    )
+
+
+@patch("commizard.llm_providers.generate")
+def test_generate_candidates(mock_generate, monkeypatch):
+    monkeypatch.setenv("OLLAMA_NUM_PARALLEL", "4")
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def fake_generate(prompt, on_token, options):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        # the first request is the slowest, so it finishes last
+        time.sleep(0.2 if options["seed"] == seeds[0] else 0.05)
+        with lock:
+            running -= 1
+        if options["seed"] == seeds[2]:
+            return 1, "failed"
+        return 0, f"message {options['seed'] - seeds[0]}"
+
+    seeds = list(range(100, 104))
+    with patch("commizard.llm_providers.secrets.randbits", return_value=100):
+        mock_generate.side_effect = fake_generate
+        done = []
+        results = llm.generate_candidates(
+            "prompt", 4, lambda *args: done.append(args)
+        )
+
+    assert results == [
+        (0, "message 0"),
+        (0, "message 1"),
+        (1, "failed"),
+        (0, "message 3"),
+    ]
+    assert peak == 4
+    assert done[-1] == (0, 0, "message 0")
+    assert sorted(done) == [(i, *result) for i, result in enumerate(results)]
+
+
+@patch("commizard.llm_providers.generate")
+def test_generate_candidates_respects_parallel(mock_generate, monkeypatch):
+    monkeypatch.setenv("OLLAMA_NUM_PARALLEL", "1")
+    running = 0
+    peak = 0
+
+    def fake_generate(prompt, on_token, options):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        time.sleep(0.01)
+        running -= 1
+        return 0, "ok"
+
+    mock_generate.side_effect = fake_generate
+    assert llm.generate_candidates("prompt", 3) == [(0, "ok")] * 3
+    assert peak == 1
+
+
+@patch("commizard.llm_providers.http_request")
+def test_model_digest(mock_http_request):
+    mock_http_request.return_value = tags_response(
+        {"name": "a:7b", "digest": "sha256:a"}, {"name": "b"}
+    )
+    assert llm.model_digest("a:7b") == "sha256:a"
+    assert llm.model_digest("a:7b") == "sha256:a"
+    mock_http_request.assert_called_once()
+    assert llm.model_digest("b") is None
+
+    failing = llm.ModelCatalog()
+    mock_http_request.return_value = llm.HttpResponse(None, -1)
+    with patch.object(llm, "catalog", failing):
+        assert llm.model_digest("a:7b") is None
+
+
+@patch("commizard.llm_providers.model_digest", return_value="sha256:a")
+@patch("commizard.llm_providers.request_generate")
+def test_generate_cached(mock_request, mock_digest, monkeypatch):
+    monkeypatch.setattr(llm.response_cache, "enabled", True)
+    monkeypatch.setattr(llm, "selected_model", "a:7b")
+    mock_request.return_value = (0, "Fix parser")
+
+    assert llm.generate("prompt") == (0, "Fix parser")
+    seen = []
+    assert llm.generate("prompt", seen.append) == (0, "Fix parser")
+    assert seen == ["Fix parser"]
+    mock_request.assert_called_once_with("prompt", None, None, None)
+
+    # a different prompt, a seed, or cache=False all go to the server
+    llm.generate("another prompt")
+    llm.generate("prompt", options={"seed": 1})
+    llm.generate("prompt", cache=False)
+    assert mock_request.call_count == 4
+
+
+@patch("commizard.llm_providers.model_digest", return_value="sha256:a")
+@patch("commizard.llm_providers.request_generate")
+def test_generate_errors_not_cached(mock_request, mock_digest, monkeypatch):
+    monkeypatch.setattr(llm.response_cache, "enabled", True)
+    mock_request.return_value = (1, "can't connect to the server")
+    llm.generate("prompt")
+    llm.generate("prompt")
+    assert mock_request.call_count == 2
+
+
+@patch("commizard.llm_providers.http_request")
+def test_generate_records_stats(mock_http_request, monkeypatch):
+    mock_http_request.return_value = llm.HttpResponse(
+        {
+            "response": "Fix parser",
+            "prompt_eval_count": 812,
+            "prompt_eval_duration": 1_250_000_000,
+            "eval_count": 5,
+            "total_duration": "not recorded",
+        },
+        200,
+    )
+    monkeypatch.setattr(llm, "last_stats", {})
+    llm.generate("diff")
+    assert llm.last_stats == {
+        "prompt_eval_count": 812,
+        "prompt_eval_duration": 1_250_000_000,
+        "eval_count": 5,
+    }
+
+
+@patch("requests.Session.post")
+def test_generate_stream_records_stats(mock_post, monkeypatch):
+    mock_post.return_value = stream_response(
+        200,
+        [
+            '{"response": "Fix"}',
+            '{"done": true, "prompt_eval_count": 40, "eval_duration": 7}',
+        ],
+    )
+    monkeypatch.setattr(llm, "last_stats", {})
+    llm.generate("diff", print)
+    assert llm.last_stats == {"prompt_eval_count": 40, "eval_duration": 7}
+
+
+@pytest.mark.parametrize(
+    "load_val, saved", [({"done_reason": "load"}, "llama3"), ({}, None)]
+)
+@patch("commizard.llm_providers.load_model")
+@patch("commizard.llm_providers.output.print_success")
+def test_select_model_remembers_default(
+    mock_print, mock_load, load_val, saved, monkeypatch
+):
+    monkeypatch.setattr(llm, "selected_model", None)
+    mock_load.return_value = load_val
+    llm.select_model("llama3")
+    assert llm.default_model() == saved
+
+
+@patch("commizard.llm_providers.output.print_error")
+@patch("commizard.llm_providers.get_provider")
+def test_select_model_missing_not_remembered(mock_provider, mock_print):
+    mock_provider.return_value.load.return_value = llm.HttpResponse(
+        {"error": "model 'lama3' not found"}, 404
+    )
+    llm.select_model("lama3")
+    # a later session shouldn't keep preloading a model that isn't there
+    assert llm.default_model() is None
+    mock_print.assert_called_once_with(llm.get_error_message(404))
+
+
+@pytest.mark.parametrize(
+    "response, expected",
+    [
+        (llm.HttpResponse({"done_reason": "load"}, 200), True),
+        (llm.HttpResponse({"error": "not found"}, 404), False),
+        (llm.HttpResponse(None, -1), False),
+    ],
+)
+@patch("commizard.llm_providers.http_request")
+def test_preload_model(
+    mock_http_request, response, expected, capsys, monkeypatch
+):
+    monkeypatch.setitem(llm.context_limits, "llama3", 4096)
+    mock_http_request.return_value = response
+    assert llm.preload_model("llama3") is expected
+    # loaded with the window generations will ask for, capped by the model
+    mock_http_request.assert_called_once_with(
+        "POST",
+        "http://localhost:11434/api/generate",
+        json={
+            "model": "llama3",
+            "keep_alive": llm.keep_alive,
+            "options": {"num_ctx": 4096},
+        },
+    )
+    # it runs in the background, so it must stay quiet
+    assert capsys.readouterr() == ("", "")
+
+
+@patch("commizard.llm_providers.request_generate")
+def test_generate_waits_for_preload(mock_request, monkeypatch):
+    order = []
+    future = Future()
+    future.add_done_callback(lambda _: order.append("loaded"))
+    monkeypatch.setattr(llm, "preload", future)
+    mock_request.side_effect = lambda *args: (
+        order.append("generate")
+        or (
+            0,
+            "ok",
+        )
+    )
+
+    threading.Timer(0.05, future.set_result, [True]).start()
+    assert llm.generate("diff") == (0, "ok")
+    assert order == ["loaded", "generate"]
+    assert llm.preload is None
+
+    # a failed load doesn't stop generation from trying
+    failed = Future()
+    failed.set_result(False)
+    monkeypatch.setattr(llm, "preload", failed)
+    assert llm.generate("diff") == (0, "ok")
+
+
+@pytest.mark.parametrize(
+    "meminfo, expected",
+    [
+        ("MemTotal: 16000000 kB\nMemAvailable: 8000000 kB\n", False),
+        ("MemTotal: 16000000 kB\nMemAvailable: 1000000 kB\n", True),
+        ("MemTotal: 16000000 kB\n", False),
+        ("MemTotal: lots\nMemAvailable: some\n", False),
+        (None, False),
+    ],
+    ids=["plenty", "low", "no_available", "garbled", "no_file"],
+)
+def test_memory_pressure(meminfo, expected, tmp_path):
+    path = tmp_path / "meminfo"
+    if meminfo is not None:
+        path.write_text(meminfo)
+    assert llm.memory_pressure(str(path)) is expected
+
+
+@patch("commizard.llm_providers.http_request")
+def test_release_model(mock_http_request, monkeypatch):
+    mock_http_request.return_value = llm.HttpResponse({}, 200)
+    assert llm.release_model() is False
+    mock_http_request.assert_not_called()
+
+    llm.mark_used("llama3")
+    assert llm.release_model() is True
+    mock_http_request.assert_called_once_with(
+        "POST",
+        "http://localhost:11434/api/generate",
+        json={"model": "llama3", "keep_alive": 0},
+    )
+    assert llm.loaded_model is None
+
+
+@pytest.mark.parametrize(
+    "idle, pressure, in_flight, unloaded",
+    [
+        (10, False, 0, False),
+        (700, False, 0, True),
+        (10, True, 0, True),
+        (700, True, 1, False),
+    ],
+    ids=["active", "idle", "memory_pressure", "generating"],
+)
+@patch("commizard.llm_providers.release_model", return_value=True)
+@patch("commizard.llm_providers.memory_pressure")
+def test_check_idle(
+    mock_pressure,
+    mock_release,
+    idle,
+    pressure,
+    in_flight,
+    unloaded,
+    monkeypatch,
+):
+    mock_pressure.return_value = pressure
+    monkeypatch.setattr(llm, "idle_unload_seconds", 600.0)
+    monkeypatch.setattr(llm, "in_flight", in_flight)
+    llm.mark_used("llama3")
+    monkeypatch.setattr(llm, "last_used", time.monotonic() - idle)
+    assert llm.check_idle() is unloaded
+    assert mock_release.called is unloaded
+
+
+@patch("commizard.llm_providers.release_model")
+def test_check_idle_nothing_loaded(mock_release):
+    assert llm.check_idle() is False
+    mock_release.assert_not_called()
+
+
+@patch("commizard.llm_providers.request_generate", return_value=(0, "ok"))
+def test_generate_marks_model_used(mock_request, monkeypatch):
+    monkeypatch.setattr(llm, "selected_model", "llama3")
+    monkeypatch.setattr(llm, "last_used", 0.0)
+    assert llm.generate("diff") == (0, "ok")
+    assert llm.loaded_model == "llama3"
+    assert llm.last_used > 0.0
+    assert llm.in_flight == 0
+
+
+@patch("commizard.llm_providers.release_model")
+@patch("commizard.llm_providers.check_idle")
+def test_lifecycle_watcher(mock_check, mock_release, monkeypatch):
+    monkeypatch.setattr(llm, "watch_interval", 0.01)
+    monkeypatch.setattr(llm, "idle_unload_seconds", 600.0)
+    monkeypatch.setattr(llm, "preload", None)
+    checked = threading.Event()
+    mock_check.side_effect = checked.set
+    llm.config.save("idle_unload_minutes", 5)
+
+    llm.start_lifecycle()
+    assert checked.wait(1)
+    assert llm.idle_unload_seconds == 300
+    llm.stop_lifecycle()
+
+    mock_release.assert_called_once()
+    calls = mock_check.call_count
+    time.sleep(0.05)
+    assert mock_check.call_count == calls
+
+
+def sse(*events):
+    return "".join(f"data: {json.dumps(e)}\n\n" for e in events) + (
+        "data: [DONE]\n\n"
+    )
+
+
+def test_ollama_provider(stub_hosts, monkeypatch):
+    host, stub = stub_hosts({})
+    monkeypatch.setenv("OLLAMA_HOST", host)
+    stub.routes = {
+        "/api/version": (200, '{"version": "0.12.0"}'),
+        "/api/tags": (200, '{"models": [{"name": "llama3", "size": 7}]}'),
+        "/api/generate": (200, '{"response": "Fix parser", "eval_count": 3}'),
+        "/api/ps": (
+            200,
+            '{"models": [{"size": 10, "size_vram": 6}, {"size": 5}]}',
+        ),
+    }
+    provider = llm.get_provider()
+    assert isinstance(provider, llm.OllamaProvider)
+    assert provider.host == f"http://{host}"
+    assert provider.is_available()
+    assert [(m.name, m.size) for m in provider.list_models()] == [("llama3", 7)]
+    assert provider.generate("llama3", "sys", "diff", {"seed": 1}) == (
+        0,
+        "Fix parser",
+    )
+    assert llm.last_stats == {"eval_count": 3}
+    assert stub.received[-1][1] == {
+        "model": "llama3",
+        "system": "sys",
+        "prompt": "diff",
+        "keep_alive": llm.keep_alive,
+        "options": {"seed": 1},
+        "stream": False,
+    }
+    assert provider.unload("llama3").return_code == 200
+    assert provider.metrics() == {
+        "loaded_models": 2,
+        "ram_bytes": 15,
+        "vram_bytes": 6,
+    }
+
+
+def test_openai_provider(stub_hosts):
+    host, stub = stub_hosts({})
+    llm.config.save("provider", "openai")
+    llm.config.save("host", host)
+    llm.config.save("api_key", "secret")
+    completion = {
+        "choices": [{"message": {"content": "Add cache"}}],
+        "usage": {"prompt_tokens": 40, "completion_tokens": 3},
+    }
+    stub.routes = {
+        "/v1/models": (200, '{"data": [{"id": "qwen2.5-coder"}]}'),
+        "/v1/chat/completions": (200, json.dumps(completion)),
+        "/metrics": (
+            200,
+            (
+                "# HELP requests_processing Requests in flight\n"
+                "requests_processing 2\n"
+                'vllm:num_requests_waiting{model_name="a b"} 3\n'
+                'vllm:num_requests_waiting{model_name="c"} 1\n'
+            ),
+        ),
+    }
+    provider = llm.get_provider()
+    assert isinstance(provider, llm.OpenAIProvider)
+    assert provider.is_available()
+    assert [m.name for m in provider.list_models()] == ["qwen2.5-coder"]
+    # the server loaded its model when it started
+    sent = len(stub.received)
+    assert provider.load("qwen2.5-coder").return_code == 200
+    assert len(stub.received) == sent
+
+    result = provider.generate(
+        "qwen2.5-coder", "sys", "diff", {"num_predict": 60, "num_ctx": 8192}
+    )
+    assert result == (0, "Add cache")
+    assert llm.last_stats == {"prompt_eval_count": 40, "eval_count": 3}
+    path, body, auth = stub.received[-1]
+    assert (path, auth) == ("/v1/chat/completions", "Bearer secret")
+    assert body == {
+        "model": "qwen2.5-coder",
+        "messages": [
+            {"role": "system", "content": "sys"},
+            {"role": "user", "content": "diff"},
+        ],
+        "max_tokens": 60,
+        "stream": False,
+    }
+    assert provider.metrics() == {
+        "requests_processing": 2.0,
+        "vllm:num_requests_waiting": 4.0,
+    }
+
+
+@pytest.mark.parametrize(
+    "route, expected, tokens",
+    [
+        (
+            (
+                200,
+                sse(
+                    {"choices": [{"delta": {"role": "assistant"}}]},
+                    {"choices": [{"delta": {"content": "Add "}}]},
+                    {"choices": [{"delta": {"content": "cache"}}]},
+                    {"choices": [], "usage": {"prompt_tokens": 9}},
+                ),
+            ),
+            (0, "Add cache"),
+            ["Add ", "cache"],
+        ),
+        (
+            (200, sse({"error": {"message": "model not found"}})),
+            (1, "model not found"),
+            [],
+        ),
+        (
+            (200, "data: {oops\n\n"),
+            (1, "the server sent a malformed response"),
+            [],
+        ),
+        ((503, ""), (503, llm.get_error_message(503)), []),
+    ],
+    ids=["tokens", "error_event", "malformed", "unavailable"],
+)
+def test_openai_provider_stream(stub_hosts, route, expected, tokens):
+    host, stub = stub_hosts({})
+    llm.config.save("provider", "openai")
+    llm.config.save("host", f"http://{host}/")
+    stub.routes = {"/v1/chat/completions": route}
+    seen = []
+    provider = llm.get_provider()
+    assert provider.generate("m", "sys", "diff", None, seen.append) == expected
+    assert seen == tokens
+    body = stub.received[0][1]
+    assert body["stream"] is True
+    assert body["stream_options"] == {"include_usage": True}
+    if expected[0] == 0:
+        assert llm.last_stats == {"prompt_eval_count": 9}
+
+
+def test_generate_through_provider(stub_hosts, monkeypatch):
+    host, stub = stub_hosts({})
+    llm.config.save("provider", "openai")
+    llm.config.save("host", host)
+    monkeypatch.setattr(llm, "selected_model", "qwen2.5-coder")
+    stub.routes = {
+        "/v1/models": (200, '{"data": [{"id": "qwen2.5-coder"}]}'),
+        "/v1/chat/completions": (
+            200,
+            '{"choices": [{"message": {"content": "Fix typo"}}]}',
+        ),
+    }
+    assert llm.catalog.names() == ["qwen2.5-coder"]
+    assert llm.generate("diff") == (0, "Fix typo")
+    body = stub.received[-1][1]
+    assert body["messages"][0]["content"] == llm.generation_prompt
+
+
+@pytest.mark.parametrize(
+    "settings, env, kind, host",
+    [
+        ({}, None, llm.OllamaProvider, "http://localhost:11434"),
+        ({}, "10.0.0.5:11434", llm.OllamaProvider, "http://10.0.0.5:11434"),
+        ({}, "0.0.0.0", llm.OllamaProvider, "http://0.0.0.0:11434"),  # noqa: S104
+        (
+            {"host": "https://gpu01:11434/"},
+            "ignored:1",
+            llm.OllamaProvider,
+            "https://gpu01:11434",
+        ),
+        (
+            {"provider": "openai"},
+            "ignored:1",
+            llm.OpenAIProvider,
+            "http://localhost:8080",
+        ),
+        (
+            {"provider": "tgi"},
+            None,
+            llm.OllamaProvider,
+            "http://localhost:11434",
+        ),
+    ],
+)
+@patch("commizard.llm_providers.output.print_warning")
+def test_make_provider(mock_warn, settings, env, kind, host, monkeypatch):
+    if env is not None:
+        monkeypatch.setenv("OLLAMA_HOST", env)
+    provider = llm.make_provider(settings)
+    assert type(provider) is kind
+    assert provider.host == host
+    assert mock_warn.called == (settings.get("provider") == "tgi")
+
+
+@pytest.mark.parametrize(
+    "host, expected",
+    [
+        ("0.0.0.0", "http://0.0.0.0:11434"),  # noqa: S104
+        ("localhost", "http://localhost:11434"),
+        (":11434", "http://127.0.0.1:11434"),
+        ("gpu01:8000", "http://gpu01:8000"),
+        ("[::1]", "http://[::1]:11434"),
+        ("[::1]:9000/ollama", "http://[::1]:9000/ollama"),
+        ("http://gpu01", "http://gpu01"),
+        ("  ", None),
+        (None, None),
+    ],
+)
+def test_host_url(host, expected):
+    assert llm.host_url(host, 11434) == expected
+
+
+def test_host_url_without_default_port():
+    assert llm.host_url("gpu01") == "http://gpu01"
+    assert llm.host_url(":8080") == "http://127.0.0.1:8080"
+
+
+def test_parse_prometheus():
+    text = '# TYPE x counter\nx 1\nx{a="1"} 2\nbad\ny{a="}"} nope\n\nz 1e3\n'
+    assert llm.parse_prometheus(text) == {"x": 3.0, "z": 1000.0}
+
+
+def test_make_provider_pool():
+    pool = llm.make_provider({"hosts": ["a:11434", "http://b:11434"]})
+    assert isinstance(pool, llm.HostPool)
+    assert [m.host for m in pool.members] == [
+        "http://a:11434",
+        "http://b:11434",
+    ]
+    assert all(type(m) is llm.OllamaProvider for m in pool.members)
+    assert pool.host_count == 2
+    single = llm.make_provider({"hosts": ["a:11434"]})
+    assert type(single) is llm.OllamaProvider
+
+
+def test_pool_fails_over(stub_hosts):
+    busy, busy_stub = stub_hosts(ollama_routes("busy", generate_status=503))
+    good, good_stub = stub_hosts(ollama_routes("from good"))
+    pool = llm.make_provider({"hosts": [unused_port(), busy, good]})
+
+    assert pool.generate("llama3", "sys", "diff") == (0, "from good")
+    assert len(busy_stub.received) == 1
+    # the failed hosts sit out; the next request goes straight to the good one
+    assert pool.generate("llama3", "sys", "diff") == (0, "from good")
+    assert len(busy_stub.received) == 1
+    assert len(good_stub.received) == 2
+    assert pool.outstanding() == [0, 0, 0]
+
+
+def test_pool_all_down(stub_hosts):
+    busy, _ = stub_hosts(ollama_routes(generate_status=503))
+    pool = llm.make_provider({"hosts": [unused_port(), busy]})
+    assert pool.generate("llama3", "sys", "diff") == (
+        503,
+        llm.get_error_message(503),
+    )
+    # nobody left to ask
+    assert pool.generate("llama3", "sys", "diff") == (
+        1,
+        "can't connect to the server",
+    )
+
+
+def test_pool_lets_host_back_after_health_check(stub_hosts):
+    routes = ollama_routes("back", generate_status=503)
+    host, stub = stub_hosts(routes)
+    other, _ = stub_hosts(ollama_routes("other", generate_status=503))
+    pool = llm.make_provider({"hosts": [host, other]})
+    pool.retry_after = 0.0
+    assert pool.generate("llama3", "sys", "diff")[0] == 503
+
+    routes["/api/generate"] = (200, '{"response": "back"}')
+    stub.received.clear()
+    assert pool.generate("llama3", "sys", "diff") == (0, "back")
+    # it was checked before it got the request
+    assert [path for path, *_ in stub.received] == [
+        "/api/version",
+        "/api/generate",
+    ]
+
+
+def test_pool_spreads_concurrent_requests(stub_hosts):
+    hosts, stubs = zip(
+        *(stub_hosts(ollama_routes(f"host {n}"), delay=0.1) for n in range(2))
+    )
+    pool = llm.make_provider({"hosts": list(hosts)})
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(
+            executor.map(
+                lambda _: pool.generate("llama3", "sys", "diff"), range(4)
+            )
+        )
+    assert sorted(results) == [(0, "host 0")] * 2 + [(0, "host 1")] * 2
+    assert [len(stub.received) for stub in stubs] == [2, 2]
+
+
+def test_pool_prefers_faster_host(stub_hosts):
+    slow, slow_stub = stub_hosts(ollama_routes("slow"), delay=0.1)
+    fast, _ = stub_hosts(ollama_routes("fast"))
+    pool = llm.make_provider({"hosts": [slow, fast]})
+    pool.generate("llama3", "sys", "diff")
+    pool.generate("llama3", "sys", "diff")
+    # both have been timed now; one at a time, the fast host gets them all
+    for _ in range(3):
+        assert pool.generate("llama3", "sys", "diff") == (0, "fast")
+    assert len(slow_stub.received) == 1
+
+
+def test_pool_models(stub_hosts):
+    first, first_stub = stub_hosts(ollama_routes("a", models=["llama3"]))
+    second, second_stub = stub_hosts(
+        ollama_routes("b", models=["llama3", "qwen2.5"])
+    )
+    pool = llm.make_provider({"hosts": [first, second, unused_port()]})
+    assert pool.is_available()
+    assert [m.name for m in pool.list_models()] == ["llama3", "qwen2.5"]
+
+    # only the host that has the model gets asked for it
+    for _ in range(2):
+        assert pool.generate("qwen2.5", "sys", "diff") == (0, "b")
+    assert not [p for p, *_ in first_stub.received if p == "/api/generate"]
+
+    assert pool.load("llama3").return_code == 200
+    loads = [
+        body
+        for stub in (first_stub, second_stub)
+        for path, body, _ in stub.received
+        if path == "/api/generate" and "prompt" not in body
+    ]
+    assert len(loads) == 2
+
+
+def test_pool_stream_no_failover_after_tokens(stub_hosts):
+    broken = (200, '{"response": "Fi"}\n{"error": "model crashed"}\n')
+    first, _ = stub_hosts({"/api/generate": broken})
+    second, second_stub = stub_hosts(ollama_routes("fine"))
+    pool = llm.make_provider({"hosts": [first, second]})
+    seen = []
+    assert pool.generate("llama3", "sys", "diff", None, seen.append) == (
+        1,
+        "model crashed",
+    )
+    assert seen == ["Fi"]
+    assert not second_stub.received
+
+
+def test_pool_cancelled_attempt_stays_on_one_host(stub_hosts):
+    hosts, stubs = zip(
+        *(stub_hosts(ollama_routes(f"host {n}"), delay=0.2) for n in range(3))
+    )
+    pool = llm.make_provider({"hosts": list(hosts)})
+    attempt = llm.Attempt("llama3")
+    llm.thread_state.attempt = attempt
+    threading.Timer(0.05, attempt.cancel).start()
+    start = time.monotonic()
+    try:
+        result = pool.generate("llama3", "sys", "diff", None, lambda _: None)
+    finally:
+        llm.thread_state.attempt = None
+    assert result == (1, "cancelled")
+    # given up without waiting for the answer to start
+    assert time.monotonic() - start < 0.2
+    time.sleep(0.3)
+    assert sum(len(stub.received) for stub in stubs) == 1
+    assert pool.outstanding() == [0, 0, 0]
+
+
+@patch("commizard.llm_providers.get_provider")
+def test_parallel_requests_scales_with_hosts(mock_provider, monkeypatch):
+    monkeypatch.setenv("OLLAMA_NUM_PARALLEL", "2")
+    mock_provider.return_value.host_count = 3
+    assert llm.parallel_requests() == 6
+
+
+@pytest.mark.parametrize(
+    "configured, samples, expected",
+    [
+        (None, [], llm.hedge_default),
+        (None, [0.5] * 9, llm.hedge_default),
+        (None, [float(n) for n in range(1, 21)], 19.0),
+        (None, [0.01] * 20, llm.hedge_floor),
+        (2.5, [float(n) for n in range(1, 21)], 2.5),
+        ("soon", [], llm.hedge_default),
+    ],
+)
+def test_hedge_deadline(configured, samples, expected, monkeypatch):
+    if configured is not None:
+        llm.config.save("hedge_after", configured)
+    monkeypatch.setattr(llm, "first_token_times", deque(samples))
+    assert llm.hedge_deadline() == expected
+
+
+@pytest.mark.parametrize(
+    "fallback, hosts, expected",
+    [
+        (None, 1, None),
+        ("llama3.2:1b", 1, "llama3.2:1b"),
+        ("llama3", 1, None),
+        (None, 2, "llama3"),
+        ("llama3.2:1b", 2, "llama3.2:1b"),
+    ],
+)
+@patch("commizard.llm_providers.get_provider")
+def test_hedge_model(mock_provider, fallback, hosts, expected, monkeypatch):
+    monkeypatch.setattr(llm, "selected_model", "llama3")
+    mock_provider.return_value.host_count = hosts
+    if fallback is not None:
+        llm.config.save("fallback_model", fallback)
+    assert llm.hedge_model() == expected
+
+
+def racing_request(delays):
+    """
+    A fake request_generate whose models answer after the given delays,
+    unless they're cancelled first. Returns it and the attempts it saw.
+    """
+    seen = {}
+
+    def fake(prompt, on_token, options, system, model):
+        attempt = llm.thread_state.attempt
+        seen[model] = attempt
+        end = time.monotonic() + delays[model]
+        while time.monotonic() < end:
+            if attempt.cancelled:
+                return 1, "cancelled"
+            time.sleep(0.005)
+        on_token(f"{model} ")
+        on_token("says hi")
+        return 0, f"{model} says hi"
+
+    return fake, seen
+
+
+@patch("commizard.llm_providers.request_generate")
+def test_hedged_generate_fallback_wins(mock_request, monkeypatch):
+    monkeypatch.setattr(llm, "selected_model", "big")
+    monkeypatch.setattr(llm, "first_token_times", deque())
+    llm.config.save("hedge_after", 0.05)
+    mock_request.side_effect, seen = racing_request({"big": 5, "small": 0})
+    tokens = []
+
+    start = time.monotonic()
+    result = llm.hedged_generate("diff", tokens.append, None, None, "small")
+
+    assert result == (0, "small says hi", "small")
+    assert time.monotonic() - start < 1
+    assert tokens == ["small ", "says hi"]
+    assert seen["big"].cancelled
+    assert not seen["small"].cancelled
+    assert len(llm.first_token_times) == 1
+
+
+@patch("commizard.llm_providers.request_generate")
+def test_hedged_generate_no_hedge_when_fast(mock_request, monkeypatch):
+    monkeypatch.setattr(llm, "selected_model", "big")
+    monkeypatch.setattr(llm, "first_token_times", deque())
+    llm.config.save("hedge_after", 5)
+    mock_request.side_effect, seen = racing_request({"big": 0, "small": 0})
+
+    assert llm.hedged_generate("diff", None, None, None, "small") == (
+        0,
+        "big says hi",
+        "big",
+    )
+    assert list(seen) == ["big"]
+
+
+@patch("commizard.llm_providers.request_generate")
+def test_hedged_generate_survives_failed_primary(mock_request, monkeypatch):
+    monkeypatch.setattr(llm, "selected_model", "big")
+    llm.config.save("hedge_after", 0.01)
+
+    def fake(prompt, on_token, options, system, model):
+        if model == "big":
+            time.sleep(0.05)
+            return 503, "Service Unavailable"
+        time.sleep(0.1)
+        on_token("ok")
+        return 0, "ok"
+
+    mock_request.side_effect = fake
+    assert llm.hedged_generate("diff", None, None, None, "small") == (
+        0,
+        "ok",
+        "small",
+    )
+
+
+@patch("commizard.llm_providers.get_provider")
+def test_hedged_generate_keeps_winner_stats(mock_provider, monkeypatch):
+    monkeypatch.setattr(llm, "selected_model", "big")
+    for model in ("big", "small"):
+        monkeypatch.setitem(llm.context_limits, model, None)
+    llm.config.save("hedge_after", 0.05)
+    loser_done = threading.Event()
+
+    def fake(model, system, prompt, options, on_token):
+        attempt = llm.thread_state.attempt
+        if model == "big":
+            while not attempt.cancelled:
+                time.sleep(0.005)
+            # the loser finishes after the winner has returned
+            time.sleep(0.05)
+            llm.record_stats({"eval_count": 99})
+            loser_done.set()
+            return 1, "cancelled"
+        on_token("hi")
+        llm.record_stats({"eval_count": 3})
+        return 0, "hi"
+
+    mock_provider.return_value.generate.side_effect = fake
+    assert llm.hedged_generate("diff", None, None, None, "small") == (
+        0,
+        "hi",
+        "small",
+    )
+    assert loser_done.wait(1)
+    assert llm.last_stats == {"eval_count": 3}
+    assert llm.last_sizing["num_ctx"] == 8192
+
+
+@patch("commizard.llm_providers.response_cache.put")
+@patch("commizard.llm_providers.model_digest", return_value="sha256:a")
+@patch("commizard.llm_providers.hedged_generate")
+@patch("commizard.llm_providers.hedge_model")
+def test_generate_hedges(
+    mock_hedge_model, mock_hedged, mock_digest, mock_put, monkeypatch
+):
+    monkeypatch.setattr(llm.response_cache, "enabled", True)
+    monkeypatch.setattr(llm, "selected_model", "big")
+    mock_hedge_model.return_value = "small"
+    mock_hedged.return_value = (0, "from small", "small")
+
+    assert llm.generate("diff", print) == (0, "from small")
+    mock_hedged.assert_called_once_with("diff", print, None, None, "small")
+    # the fallback's answer isn't cached as the selected model's
+    mock_put.assert_not_called()
+
+    mock_hedged.return_value = (0, "from big", "big")
+    llm.generate("diff")
+    mock_put.assert_called_once()
+
+
+@patch("requests.Session.post")
+def test_stream_generate_cancelled(mock_post):
+    response = stream_response(200, ['{"response": "Fix"}'] * 3)
+    mock_post.return_value = response
+    attempt = llm.Attempt("m")
+    llm.thread_state.attempt = attempt
+    try:
+        attempt.cancel()
+        assert llm.stream_generate("http://x/api/generate", {}, print) == (
+            1,
+            "cancelled",
+        )
+    finally:
+        llm.thread_state.attempt = None
+    response.close.assert_not_called()
+    assert attempt.response is response
+
+    # cancelling an attempt with a response closes it
+    attempt = llm.Attempt("m")
+    attempt.response = response
+    attempt.cancel()
+    response.close.assert_called_once()
+
+
+def test_cancel_aborts_request_waiting_for_response(stub_hosts, monkeypatch):
+    # like Ollama evaluating a long prompt before its first token
+    host, _ = stub_hosts(ollama_routes(), delay=2)
+    monkeypatch.setenv("OLLAMA_HOST", host)
+    monkeypatch.setattr(llm, "selected_model", "llama3")
+    monkeypatch.setitem(llm.context_limits, "llama3", None)
+    monkeypatch.setattr(llm, "retries", 2)
+    attempt = llm.Attempt("llama3")
+    results = []
+
+    def run():
+        llm.thread_state.attempt = attempt
+        results.append(llm.generate("diff", lambda _: None, hedged=False))
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    attempt.cancel()
+    thread.join(1)
+    assert time.monotonic() - start < 0.5
+    assert results == [(1, "cancelled")]
+    # neither retried nor held against the host
+    assert attempt.connection is None
+    assert llm.breaker_for(f"http://{host}").failures == 0
+
+
+def test_backoff(monkeypatch):
+    monkeypatch.setattr(llm, "backoff_base", 0.1)
+    monkeypatch.setattr(llm, "backoff_cap", 0.5)
+    for attempt, most in [(0, 0.1), (1, 0.2), (2, 0.4), (6, 0.5)]:
+        waits = [llm.backoff(attempt) for _ in range(50)]
+        assert all(0 <= w <= most for w in waits)
+
+
+def test_send_retries_503(stub_hosts, monkeypatch):
+    monkeypatch.setattr(llm, "retries", 2)
+    monkeypatch.setattr(llm, "backoff", lambda attempt: 0)
+    host, stub = stub_hosts(ollama_routes(generate_status=503))
+    url = f"http://{host}/api/generate"
+
+    assert llm.http_request("POST", url, json={}).return_code == 503
+    assert len(stub.received) == 3
+    stub.routes["/api/generate"] = (500, "{}")
+    assert llm.http_request("POST", url, json={}).return_code == 500
+    assert len(stub.received) == 4
+
+
+@pytest.mark.parametrize(
+    "method, error, calls",
+    [
+        ("GET", requests.ConnectionError, 3),
+        ("POST", requests.ConnectionError, 3),
+        ("GET", requests.ReadTimeout, 3),
+        # the server may already be working on it
+        ("POST", requests.ReadTimeout, 1),
+    ],
+)
+def test_send_retries_errors(method, error, calls, monkeypatch):
+    monkeypatch.setattr(llm, "retries", 2)
+    monkeypatch.setattr(llm, "backoff", lambda attempt: 0)
+    with patch(f"requests.Session.{method.lower()}") as mock_send:
+        mock_send.side_effect = error
+        with pytest.raises(error):
+            llm.send(method, "http://localhost:11434/api/generate")
+    assert mock_send.call_count == calls
+
+
+def test_refused_connection():
+    r = llm.http_request("GET", f"http://{unused_port()}/api/version")
+    assert r.return_code == -6
+    assert r.err_message() == "the server refused the connection"
+    assert not llm.was_refused(requests.ConnectionError("name not known"))
+
+
+def test_breaker(monkeypatch):
+    monkeypatch.setattr(llm, "breaker_threshold", 2)
+    monkeypatch.setattr(llm, "breaker_cooldown", 30.0)
+    url = f"http://{unused_port()}/api/version"
+    llm.http_request("GET", url)
+    assert llm.breaker_for(url).allow()
+    llm.http_request("GET", url)
+
+    # open: failing at once, without connecting
+    with patch("requests.Session.get") as mock_get:
+        r = llm.http_request("GET", url)
+    mock_get.assert_not_called()
+    assert r.return_code == -7
+    # other hosts are unaffected
+    assert llm.breaker_for("http://localhost:1/api/version").allow()
+
+    # after the cool-down, a single request finds out if it's back
+    breaker = llm.breaker_for(url)
+    breaker.open_until = time.monotonic() - 1
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False)
+    assert not breaker.allow()
+    breaker.open_until = time.monotonic() - 1
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.allow()
+    assert breaker.failures == 0
+
+
+@pytest.mark.parametrize(
+    "error",
+    [requests.exceptions.ChunkedEncodingError, requests.TooManyRedirects],
+)
+def test_breaker_probe_fails_otherwise(error, monkeypatch):
+    monkeypatch.setattr(llm, "breaker_threshold", 1)
+    url = "http://localhost:11434/api/version"
+    breaker = llm.breaker_for(url)
+    breaker.record(False)
+    breaker.open_until = time.monotonic() - 1
+
+    with patch("requests.Session.get", side_effect=error):
+        assert llm.http_request("GET", url).return_code in (-3, -5)
+    # the probe failed, so the breaker is open again rather than stuck
+    assert not breaker.probing
+    breaker.open_until = time.monotonic() - 1
+    with patch("requests.Session.get") as mock_get:
+        mock_get.return_value.status_code = 200
+        assert llm.http_request("GET", url).return_code == 200
+    assert breaker.failures == 0
+
+
+def test_pool_skips_open_breaker(stub_hosts, monkeypatch):
+    monkeypatch.setattr(llm, "breaker_threshold", 1)
+    good, _ = stub_hosts(ollama_routes("from good"))
+    down = unused_port()
+    llm.http_request("GET", f"http://{down}/api/version")
+    pool = llm.make_provider({"hosts": [down, good]})
+    assert pool.generate("llama3", "sys", "diff") == (0, "from good")
+    assert pool.generate("llama3", "sys", "diff") == (0, "from good")
+    # after the health check failed, nothing more was sent to it
+    assert llm.breaker_for(f"http://{down}").failures == 1
+
+
+@pytest.mark.parametrize(
+    "prompt_chars, options, limit, expected",
+    [
+        (400, None, None, {"num_predict": 512, "num_ctx": 8192}),
+        (60_000, None, None, {"num_predict": 512, "num_ctx": 32768}),
+        (60_000, None, 4096, {"num_predict": 512, "num_ctx": 4096}),
+        (10**7, None, None, {"num_predict": 512, "num_ctx": 131072}),
+        (
+            400,
+            {"num_predict": 96, "seed": 1},
+            None,
+            {"num_predict": 96, "seed": 1, "num_ctx": 8192},
+        ),
+        (
+            20_000,
+            {"num_ctx": 1024},
+            None,
+            {"num_predict": 512, "num_ctx": 1024},
+        ),
+    ],
+)
+def test_size_options(prompt_chars, options, limit, expected, monkeypatch):
+    monkeypatch.setitem(llm.context_limits, "mymodel", limit)
+    monkeypatch.setattr(llm, "max_new_tokens", 512)
+    sized, sizing = llm.size_options("mymodel", "", "x" * prompt_chars, options)
+    assert sized == expected
+    assert sizing == {
+        "prompt_estimate": llm.packing.estimate_tokens("x" * prompt_chars),
+        "num_ctx": expected["num_ctx"],
+        "num_predict": expected["num_predict"],
+    }
+
+
+def test_context_window_only_grows(monkeypatch):
+    monkeypatch.setitem(llm.context_limits, "mymodel", None)
+    sizes = [
+        llm.size_options("mymodel", "", "x" * chars, None)[0]["num_ctx"]
+        for chars in (400, 60_000, 400)
+    ]
+    # a small prompt after a large one keeps the window, so nothing reloads
+    assert sizes == [8192, 32768, 32768]
+    assert llm.window_size("mymodel") == 32768
+    monkeypatch.setitem(llm.context_limits, "mymodel", 16384)
+    assert llm.window_size("mymodel") == 16384
+
+
+def test_context_length(stub_hosts, monkeypatch):
+    host, stub = stub_hosts({})
+    monkeypatch.setenv("OLLAMA_HOST", host)
+    stub.routes = {
+        "/api/show": (
+            200,
+            (
+                '{"model_info": {"general.architecture": "qwen2", '
+                '"qwen2.context_length": 32768}}'
+            ),
+        ),
+        "/api/generate": (200, '{"response": "ok"}'),
+    }
+    monkeypatch.setattr(llm, "selected_model", "qwen2")
+
+    assert llm.generate("diff") == (0, "ok")
+    assert llm.generate("diff") == (0, "ok")
+    # asked once, then remembered
+    assert [path for path, *_ in stub.received].count("/api/show") == 1
+    assert stub.received[-1][1]["options"]["num_ctx"] == 8192
+    assert llm.last_sizing["num_ctx"] == 8192
+
+    stub.routes["/api/show"] = (404, "{}")
+    assert llm.get_provider().context_length("other") is None
+
+
+def test_pool_context_length():
+    members = [MagicMock(), MagicMock(), MagicMock()]
+    for member, length in zip(members, (8192, None, 4096)):
+        member.context_length.return_value = length
+    assert llm.HostPool(members).context_length("m") == 4096
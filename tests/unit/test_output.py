@@ -1,8 +1,10 @@
 import pytest
 
 from commizard.output import (
+    live_text,
     print_error,
     print_generated,
+    print_info,
     print_success,
     print_warning,
     wrap_text,
@@ -39,6 +41,14 @@ def test_print_generated(capsys):
     assert captured.err == ""
 
 
+def test_print_info(capsys):
+    print_info("Just so you know")
+    captured = capsys.readouterr()
+    assert "Just so you know" in captured.out
+    assert "[dim]" not in captured.out
+    assert captured.err == ""
+
+
 @pytest.mark.parametrize(
     "text,width,expected",
     [
@@ -63,3 +73,11 @@ def test_print_generated(capsys):
 def test_wrap_text(text, width, expected):
     result = wrap_text(text, width=width)
     assert result == expected
+
+
+def test_live_text(capsys):
+    with live_text() as show:
+        show("Fix ")
+        show("parser")
+    # the live display is transient: nothing is left behind
+    assert "Fix parser" not in capsys.readouterr().out
@@ -0,0 +1,106 @@
+import pytest
+
+from commizard import diff_parser, packing
+
+
+def make_file(path, hunks, binary=False):
+    """
+    build a FileDiff with one hunk per (added, removed) pair
+    """
+    file = diff_parser.FileDiff(path, path)
+    file.headers = [f"--- a/{path}", f"+++ b/{path}"]
+    file.binary = binary
+    for n, (added, removed) in enumerate(hunks):
+        hunk = diff_parser.Hunk(
+            f"@@ -{n},{removed} +{n},{added} @@",
+            diff_parser.LineRange(n, removed),
+            diff_parser.LineRange(n, added),
+        )
+        for i in range(added):
+            hunk.append(f"+{path} added line {n}.{i}")
+        for i in range(removed):
+            hunk.append(f"-{path} removed line {n}.{i}")
+        file.hunks.append(hunk)
+    return file
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [("", 0), ("abc", 1), ("abcd", 1), ("abcde", 2)],
+)
+def test_estimate_tokens(text, expected):
+    assert packing.estimate_tokens(text) == expected
+
+
+@pytest.mark.parametrize(
+    "path, binary, rank",
+    [
+        ("src/app.py", False, 0),
+        ("tests/unit/test_app.py", False, 1),
+        ("README.md", False, 2),
+        ("pyproject.toml", False, 2),
+        ("frontend/package-lock.json", False, 3),
+        ("static/bundle.min.js", False, 3),
+        ("logo.png", True, 4),
+    ],
+)
+def test_file_rank(path, binary, rank):
+    assert packing.file_rank(make_file(path, [], binary)) == rank
+
+
+@pytest.mark.parametrize(
+    "added, removed, bulk",
+    [(3, 1, False), (50, 48, True), (60, 2, False), (20, 19, False)],
+)
+def test_is_bulk(added, removed, bulk):
+    assert packing.is_bulk(make_file("f", [(added, removed)]).hunks[0]) == bulk
+
+
+def test_stat_summary():
+    assert packing.stat_summary(make_file("a.py", [(3, 1)])) == "a.py | +3 -1"
+    assert (
+        packing.stat_summary(make_file("a.png", [], True)) == "a.png | binary"
+    )
+    assert packing.stat_summary(diff_parser.FileDiff()).startswith("(unknown")
+
+
+def test_pack_diff_fits():
+    files = [make_file("a.py", [(2, 1)]), make_file("b.py", [(1, 0)])]
+    assert packing.pack_diff(files, 10_000) == diff_parser.render(files)
+    assert packing.pack_diff([], 10) == ""
+
+
+def test_pack_diff_prefers_source():
+    files = [
+        make_file("package-lock.json", [(200, 180)]),
+        make_file("src/core.py", [(5, 2)]),
+    ]
+    packed = packing.pack_diff(files, 250)
+    assert "+src/core.py added line 0.0" in packed
+    assert "package-lock.json added line" not in packed
+    assert packed.endswith(
+        "Other changed files:\npackage-lock.json | +200 -180"
+    )
+
+
+def test_pack_diff_keeps_focused_hunks():
+    # one small hunk and one big reformatting hunk in the same file
+    files = [make_file("src/core.py", [(60, 60), (2, 1)])]
+    packed = packing.pack_diff(files, 200)
+    assert "+src/core.py added line 1.0" in packed
+    assert "added line 0.0" not in packed
+    assert packed.endswith("[1 hunks omitted]")
+
+
+@pytest.mark.parametrize("budget", [40, 100, 500, 2000])
+def test_pack_diff_hard_bound(budget):
+    files = [make_file(f"src/mod{i}.py", [(i, i), (3, 0)]) for i in range(80)]
+    packed = packing.pack_diff(files, budget)
+    assert packing.estimate_tokens(packed) <= budget
+    assert packed
+
+
+def test_pack_diff_default_budget(monkeypatch):
+    monkeypatch.setattr(packing, "token_budget", 30)
+    files = [make_file("src/a.py", [(40, 0)])]
+    assert packing.pack_diff(files) == "Other changed files:\nsrc/a.py | +40 -0"
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+from commizard import response_cache
+
+
+def test_cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    assert response_cache.cache_dir() == tmp_path / "commizard" / "responses"
+    monkeypatch.delenv("XDG_CACHE_HOME")
+    monkeypatch.setenv("HOME", str(tmp_path))
+    assert response_cache.cache_dir() == (
+        tmp_path / ".cache" / "commizard" / "responses"
+    )
+
+
+@pytest.mark.parametrize(
+    "other",
+    [
+        ("other-model", "sha256:1", "prompt", None),
+        ("model", "sha256:2", "prompt", None),
+        ("model", "sha256:1", "prompt!", None),
+        ("model", "sha256:1", "prompt", {"temperature": 0}),
+    ],
+)
+def test_cache_key(other):
+    key = response_cache.cache_key("model", "sha256:1", "prompt", None)
+    assert key == response_cache.cache_key("model", "sha256:1", "prompt", {})
+    assert len(key) == 64
+    assert response_cache.cache_key(*other) != key
+
+
+def test_put_get():
+    assert response_cache.get("k1") is None
+    response_cache.put("k1", "Fix parser bug")
+    assert response_cache.get("k1") == "Fix parser bug"
+    # written atomically: no temporary files stay behind
+    assert [p.name for p in response_cache.cache_dir().iterdir()] == ["k1.json"]
+
+
+@pytest.mark.parametrize("content", ["{not json", '{"other": 1}', "[1]"])
+def test_get_corrupt(content):
+    response_cache.cache_dir().mkdir(parents=True)
+    (response_cache.cache_dir() / "bad.json").write_text(content)
+    assert response_cache.get("bad") is None
+
+
+def test_put_unwritable(monkeypatch, tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(blocker))
+    response_cache.put("k", "message")
+    assert response_cache.get("k") is None
+
+
+def test_evict_least_recently_used(monkeypatch):
+    # each entry is 36 bytes: room for three
+    monkeypatch.setattr(response_cache, "max_bytes", 110)
+    for i, key in enumerate(["a", "b", "c"]):
+        response_cache.put(key, "x" * 20)
+        path = response_cache.cache_dir() / f"{key}.json"
+        os.utime(path, ns=(i * 10**9, i * 10**9))
+    # reading "a" makes it the most recently used
+    assert response_cache.get("a") is not None
+    response_cache.put("d", "x" * 20)
+
+    names = sorted(p.stem for p in response_cache.cache_dir().iterdir())
+    assert names == ["a", "c", "d"]
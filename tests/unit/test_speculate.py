@@ -0,0 +1,161 @@
+import threading
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from commizard import config, llm_providers, speculate
+
+
+@pytest.fixture
+def repo(monkeypatch):
+    """
+    A repo whose fingerprint and time the test sets, and a model that
+    answers "Fix parser" to any prompt.
+    """
+    state = SimpleNamespace(fingerprint="a", now=0.0)
+    monkeypatch.setattr(llm_providers, "selected_model", "llama3")
+    monkeypatch.setattr(speculate, "settle_seconds", 5.0)
+    with (
+        patch(
+            "commizard.speculate.git_utils.repo_fingerprint",
+            side_effect=lambda worktree: state.fingerprint,
+        ),
+        patch(
+            "commizard.speculate.time.monotonic",
+            side_effect=lambda: state.now,
+        ),
+        patch("commizard.speculate.git_utils.get_snapshot"),
+        patch(
+            "commizard.speculate.packing.pack_diff", return_value="diff"
+        ) as state.pack_diff,
+        patch(
+            "commizard.speculate.llm_providers.generate",
+            return_value=(0, "Fix parser"),
+        ) as state.generate,
+    ):
+        yield state
+
+
+def test_check_waits_for_changes_to_settle(repo):
+    assert speculate.check() is None
+    repo.now = 4.0
+    assert speculate.check() is None
+    repo.generate.assert_not_called()
+
+    repo.now = 5.0
+    spec = speculate.check()
+    assert spec is speculate.latest
+    assert spec.result == (0, "Fix parser")
+    assert spec.done.is_set()
+    repo.generate.assert_called_once()
+    assert repo.generate.call_args.args[0] == "diff"
+    assert repo.generate.call_args.kwargs == {"hedged": False}
+
+    # once per state
+    repo.now = 20.0
+    assert speculate.check() is None
+    assert repo.generate.call_count == 1
+
+    # a file being written, then a new state settling
+    repo.fingerprint = None
+    assert speculate.check() is None
+    repo.now = 30.0
+    assert speculate.check() is None
+    repo.fingerprint = "b"
+    assert speculate.check() is None
+    repo.now = 34.0
+    assert speculate.check() is None
+    repo.now = 35.0
+    assert speculate.check().fingerprint == "b"
+    assert repo.generate.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "in_flight, model, prompt",
+    [(1, "llama3", "diff"), (0, None, "diff"), (0, "llama3", "")],
+)
+def test_check_skips(repo, in_flight, model, prompt, monkeypatch):
+    monkeypatch.setattr(llm_providers, "in_flight", in_flight)
+    monkeypatch.setattr(llm_providers, "selected_model", model)
+    repo.pack_diff.return_value = prompt
+    speculate.check()
+    repo.now = 10.0
+    assert speculate.check() is None
+    repo.generate.assert_not_called()
+
+
+def test_check_new_model(repo, monkeypatch):
+    speculate.check()
+    repo.now = 5.0
+    speculate.check()
+    monkeypatch.setattr(llm_providers, "selected_model", "qwen3")
+    assert speculate.check().model == "qwen3"
+
+
+def finished(prompt="diff", model="llama3", result=(0, "Fix parser")):
+    spec = speculate.Speculation("a", model, prompt)
+    spec.result = result
+    spec.done.set()
+    return spec
+
+
+def test_take(repo, monkeypatch):
+    assert speculate.take("diff") is None
+
+    monkeypatch.setattr(speculate, "latest", finished())
+    assert speculate.take("diff") == "Fix parser"
+    assert speculate.take("other diff") is None
+
+    monkeypatch.setattr(speculate, "latest", finished(result=(1, "timeout")))
+    assert speculate.take("diff") is None
+
+
+def test_take_waits_for_running(repo, monkeypatch):
+    spec = speculate.Speculation("a", "llama3", "diff")
+    monkeypatch.setattr(speculate, "latest", spec)
+
+    def finish():
+        spec.result = (0, "Fix parser")
+        spec.done.set()
+
+    timer = threading.Timer(0.05, finish)
+    timer.start()
+    assert speculate.take("diff") == "Fix parser"
+    timer.join()
+
+
+@pytest.mark.parametrize(
+    "prompt, model, fingerprint, cancelled",
+    [
+        # the repo changed since
+        ("new diff", "llama3", "b", True),
+        # another model was picked
+        ("diff", "qwen3", "a", True),
+        # a gen for some paths only
+        ("part of the diff", "llama3", "a", False),
+    ],
+)
+def test_take_cancels_outdated(
+    repo, prompt, model, fingerprint, cancelled, monkeypatch
+):
+    spec = speculate.Speculation("a", "llama3", "diff")
+    monkeypatch.setattr(speculate, "latest", spec)
+    monkeypatch.setattr(llm_providers, "selected_model", model)
+    repo.fingerprint = fingerprint
+    assert speculate.take(prompt) is None
+    assert spec.attempt.cancelled == cancelled
+
+
+def test_start_is_opt_in(monkeypatch):
+    monkeypatch.setattr(speculate, "poll_interval", 0.01)
+    checked = threading.Event()
+    with patch("commizard.speculate.check", side_effect=checked.set):
+        speculate.start()
+        assert not checked.wait(0.1)
+        speculate.stop()
+
+        config.save("speculate", True)
+        speculate.start()
+        assert checked.wait(1)
+        speculate.stop()
@@ -0,0 +1,170 @@
+from unittest.mock import patch
+
+import pytest
+
+from commizard import diff_parser, llm_providers, packing, summarize
+
+
+def make_file(path, hunks, skipped=None):
+    """
+    build a FileDiff with one hunk of `size` added lines per entry of hunks
+    """
+    file = diff_parser.FileDiff(path, path)
+    file.headers = [f"--- a/{path}", f"+++ b/{path}"]
+    file.skipped = skipped
+    for n, size in enumerate(hunks):
+        hunk = diff_parser.Hunk(
+            f"@@ -{n},0 +{n},{size} @@",
+            diff_parser.LineRange(n, 0),
+            diff_parser.LineRange(n, size),
+        )
+        for i in range(size):
+            hunk.append(f"+{path} line {n}.{i}")
+        file.hunks.append(hunk)
+    return file
+
+
+def test_split_file_small():
+    file = make_file("a.py", [3, 2])
+    assert summarize.split_file(file, 1000) == [
+        list(diff_parser.iter_render([file]))
+    ]
+
+
+def test_split_file_between_hunks():
+    file = make_file("big.py", [20, 20, 20])
+    pieces = summarize.split_file(file, 150)
+    assert len(pieces) == 3
+    for piece in pieces:
+        assert piece[:2] == file.headers
+        assert packing.lines_cost(piece) <= 150
+    assert [line for piece in pieces for line in piece[2:]] == list(
+        diff_parser.iter_render([file])
+    )[2:]
+
+
+def test_split_file_cuts_huge_hunk():
+    file = make_file("huge.py", [500])
+    file.truncated = True
+    (piece,) = summarize.split_file(file, 100)
+    assert piece[-2:] == ["[hunk truncated]", "[diff truncated]"]
+    assert packing.lines_cost(piece[:-1]) <= 100
+
+
+def test_split_parts():
+    files = [
+        make_file("a.py", [2]),
+        make_file("b.py", [2]),
+        make_file("package-lock.json", [], skipped="lockfile"),
+        make_file("big.py", [40, 40]),
+        make_file("c.py", [1]),
+    ]
+    parts = summarize.split_parts(files, 300)
+    assert [part.paths for part in parts] == [
+        ["a.py", "b.py", "big.py"],
+        ["big.py", "c.py"],
+    ]
+    for part in parts:
+        assert packing.lines_cost(part.lines) <= 300
+    assert summarize.split_parts([], 300) == []
+
+
+@patch("commizard.summarize.llm_providers.generate")
+def test_summarize_parts(mock_generate):
+    mock_generate.side_effect = lambda prompt, *args: (0, f"sum of {prompt}")
+    parts = []
+    for text in ("one", "two", "three"):
+        part = summarize.Part()
+        part.add("f.py", [text])
+        parts.append(part)
+
+    assert summarize.summarize_parts(parts) == [
+        (0, "sum of one"),
+        (0, "sum of two"),
+        (0, "sum of three"),
+    ]
+    mock_generate.assert_any_call(
+        "two",
+        None,
+        {"num_predict": summarize.summary_tokens},
+        True,
+        summarize.summary_prompt,
+    )
+    assert summarize.summarize_parts([]) == []
+
+
+def test_combine():
+    files = [
+        make_file("a.py", [2]),
+        make_file("yarn.lock", [], skipped="lockfile"),
+    ]
+    files[1].counts = (3, 1)
+    part = summarize.Part()
+    part.add("a.py", ["+x"])
+    prompt = summarize.combine(files, [part], ["  Adds x.\n"], 1000)
+    assert prompt.splitlines() == [
+        "The diff is too large to show whole. Each part of it in short:",
+        "",
+        "a.py:",
+        "Adds x.",
+        "",
+        "Not shown:",
+        "yarn.lock | +3 -1 (lockfile, not shown)",
+    ]
+
+
+def test_combine_within_budget():
+    parts = []
+    for i in range(50):
+        part = summarize.Part()
+        part.add(f"f{i}.py", ["+x"])
+        parts.append(part)
+    summaries = ["A fairly long summary of what this part changes."] * 50
+    prompt = summarize.combine([], parts, summaries, 200)
+    assert packing.estimate_tokens(prompt) <= 200
+    assert prompt.endswith("more parts]")
+
+
+@pytest.mark.parametrize(
+    "results, expected_stat",
+    [
+        ([(0, "Adds a."), (0, "Adds b.")], 0),
+        ([(0, "Adds a."), (1, "can't connect to the server")], 1),
+    ],
+)
+@patch("commizard.summarize.summarize_parts")
+def test_summarize_diff(mock_parts, results, expected_stat, monkeypatch):
+    monkeypatch.setattr(summarize, "part_budget", 60)
+    mock_parts.return_value = results
+    counted = []
+    files = [make_file("a.py", [8]), make_file("b.py", [8])]
+
+    stat, res = summarize.summarize_diff(files, 500, counted.append)
+
+    assert counted == [2]
+    assert stat == expected_stat
+    if expected_stat == 0:
+        assert "a.py:\nAdds a." in res
+        assert "b.py:\nAdds b." in res
+    else:
+        assert res == "can't connect to the server"
+
+
+@patch("commizard.llm_providers.model_digest", return_value="sha256:a")
+@patch("commizard.llm_providers.request_generate")
+def test_summarize_diff_reuses_cached_parts(
+    mock_request, mock_digest, monkeypatch
+):
+    monkeypatch.setattr(llm_providers.response_cache, "enabled", True)
+    monkeypatch.setattr(llm_providers, "selected_model", "a:7b")
+    monkeypatch.setattr(summarize, "part_budget", 60)
+    mock_request.side_effect = lambda prompt, *args: (0, "summary")
+    files = [make_file(name, [8]) for name in ("a.py", "b.py", "c.py")]
+
+    summarize.summarize_diff(files)
+    assert mock_request.call_count == 3
+
+    # a small edit to one file only sends that part again
+    files[1].hunks[0].append("+one more line")
+    summarize.summarize_diff(files)
+    assert mock_request.call_count == 4